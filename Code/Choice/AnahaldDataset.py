@@ -16,11 +16,13 @@ import os
 import random
 import pandas as pd
 import csv
+import numpy as np
 from PIL import Image
 
 import torch
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 
 ################## HOW TO LOAD THE CODE #########################################
 # DT2022 - Anaconda:
@@ -42,12 +44,19 @@ SBS_HEIGHT    = 240
 SBS_EXT       = "TIF" # assume all SBS-s have same extension; TODO: case on Linux
 BATCH_SIZE    = 32
 SHUFFLE_IMGS  = True
+NUM_WORKERS   = 0     # DataLoader worker processes; 0 - load in main process
+PREFETCH_FACTOR = 2   # batches prefetched by each worker
+SPLIT_SEED    = 42    # train/validation split and shuffling
+AUGMENT_SEED  = 88    # augmentation generator when loading in main process
 
 NORMALIZE_MEAN=[0.485, 0.456, 0.406]  # matches ImageNet
 NORMALIZE_STD=[0.229, 0.224, 0.225]   # matches ImageNet
 # NORMALIZE_MEAN=[0.5]*3
 # NORMALIZE_STD=[0.5]*3
 
+PREPROC_ARRAY_EXT = ".npy"           # memory-mappable array of resized SBS-s
+PREPROC_INDEX_SUFFIX = "__index.csv" # CSV rows of the array
+
 
 #################################################################################
 class AnahaldDataset(Dataset):
@@ -55,6 +64,7 @@ class AnahaldDataset(Dataset):
         self.sbs_dir = sbs_dir
         self.sbs_ext = sbs_ext
         self.transform = transform
+        self.batch_transform = None  # applied to whole batches by the trainer
         try:
             self.annotations = pd.read_csv(csv_file)
         except Exception as e:
@@ -101,18 +111,95 @@ class AnahaldDataset(Dataset):
 
 
 #################################################################################
-class StereoTransform:
-    def __init__(self, output_size=(SBS_HEIGHT, SBS_WIDTH/2)):
+# Reads SBS images preprocessed by 'PreprocessAnahaldDataset' -
+#   already split, resized and stored as uint8 array rows.
+# 'index_file' has the columns of the original CSV plus row number in the array.
+# Yields uint8 [H, W, 3] tensors; 'transform' should be TensorStereoTransform
+class PreprocessedAnahaldDataset(AnahaldDataset):
+    def __init__(self, array_file, index_file, sbs_ext, transform=None):
+        super().__init__(index_file, "", sbs_ext, transform)
+        self.array_file = array_file
+        self._array = None   # opened lazily - separately in each loader worker
+
+    def __getitem__(self, idx):
+        if ( self._array is None ):
+            self._array = np.load(self.array_file, mmap_mode="r")
+        filename = f"{self.annotations.iloc[idx, 0]}.{self.sbs_ext}"
+        label = self.label2idx[self.annotations.iloc[idx, 1]]
+        row = int(self.annotations["row"].iloc[idx])
+        image = torch.from_numpy(np.array(self._array[row]))  # copy out of mmap
+        if self.transform:
+            image = self.transform(image)
+        return image, label, filename
+#################################################################################
+
+
+
+#################################################################################
+# Random flips and brightness/contrast jitter, identical for both SBS halves.
+# Parameters come from a generator local to the process and DataLoader worker,
+#   so global 'random'/'torch' RNG state is never touched and workers differ.
+class StereoAugmentBase:
+    def __init__(self, hflip_p=0.5, vflip_p=0.2, brightness=0.3, contrast=0.3,
+                 seed=AUGMENT_SEED):
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.seed = seed
+        self._gen = None
+        self._genOwner = None   # (pid, worker-id) the generator belongs to
+
+    # Returns generator of the current process/worker; (re)creates it after fork.
+    # Worker seed is derived by DataLoader from its own generator - reproducible
+    def _rng(self):
+        workerInfo = torch.utils.data.get_worker_info()
+        owner = (os.getpid(), None if (workerInfo is None) else workerInfo.id)
+        if ( owner != self._genOwner ):
+            seed = self.seed  if  (workerInfo is None)  else  workerInfo.seed
+            self._gen = torch.Generator().manual_seed(seed)
+            self._genOwner = owner
+        return(self._gen)
+
+    # State of the generator of the current process/worker - for checkpoints.
+    # Setting it (re)creates the generator for the current owner first,
+    #   so the restored state is not reseeded away on the next draw.
+    def get_rng_state(self):
+        return(self._rng().get_state())
+
+    def set_rng_state(self, state):
+        self._rng().set_state(state)
+
+    # Returns (hflip, vflip, brightnessFactor, contrastFactor, brightnessFirst)
+    def _draw_params(self):
+        r = torch.rand(5, generator=self._rng()).tolist()
+        return((r[0] < self.hflip_p), (r[1] < self.vflip_p),
+               1.0 + self.brightness * (2 * r[2] - 1),
+               1.0 + self.contrast   * (2 * r[3] - 1),
+               (r[4] < 0.5))   # ColorJitter applies its adjustments in random order
+
+    # Applies drawn parameters to PIL image or [C, H, W] float tensor
+    @staticmethod
+    def _augment_half(half, params):
+        (hflip, vflip, bFactor, cFactor, brightnessFirst) = params
+        if ( hflip ):
+            half = TF.hflip(half)
+        if ( vflip ):
+            half = TF.vflip(half)
+        if ( brightnessFirst ):
+            return(TF.adjust_contrast(TF.adjust_brightness(half, bFactor), cFactor))
+        else:
+            return(TF.adjust_brightness(TF.adjust_contrast(half, cFactor), bFactor))
+#################################################################################
+
+
+
+#################################################################################
+class StereoTransform(StereoAugmentBase):
+    def __init__(self, output_size=(SBS_HEIGHT, SBS_WIDTH/2), seed=AUGMENT_SEED):
+        super().__init__(seed=seed)
         self.output_size = output_size
-        
-        # Define shared transforms
-        self.shared_transforms = transforms.Compose([
-            transforms.RandomHorizontalFlip(p=0.5),
-            transforms.RandomVerticalFlip(p=0.2),
-            transforms.ColorJitter(brightness=0.3, contrast=0.3),
-            transforms.Resize((int(output_size[0]), int(output_size[1]))),
-        ])
-        ###MAYBE-ADD:  transforms.ColorJitter(brightness=0.3, contrast=0.3),
+        self.resize = transforms.Resize((int(output_size[0]), int(output_size[1])))
 
         self.to_tensor = transforms.ToTensor()
         self.normalize = transforms.Normalize(mean=NORMALIZE_MEAN,
@@ -124,15 +211,10 @@ class StereoTransform:
         left = stereo_image.crop((0, 0, w // 2, h))
         right = stereo_image.crop((w // 2, 0, w, h))
 
-        # Set random seed to ensure the same transform is applied
-        seed = random.randint(0, 99999)
-        random.seed(seed)
-        torch.manual_seed(seed)
-        left = self.shared_transforms(left)
-
-        random.seed(seed)
-        torch.manual_seed(seed)
-        right = self.shared_transforms(right)
+        # Same random parameters ensure the same transform is applied
+        params = self._draw_params()
+        left  = self.resize(StereoAugmentBase._augment_half(left,  params))
+        right = self.resize(StereoAugmentBase._augment_half(right, params))
 
         # To tensor and normalize
         left = self.normalize(self.to_tensor(left))
@@ -142,7 +224,96 @@ class StereoTransform:
 #################################################################################
 
 
-
+
+#################################################################################
+# Same augmentation as StereoTransform, but for uint8 [H, W, 3] tensors
+#   of SBS-s already resized by 'PreprocessAnahaldDataset'.
+class TensorStereoTransform(StereoAugmentBase):
+    def __init__(self, seed=AUGMENT_SEED):
+        super().__init__(seed=seed)
+        self.normalize = transforms.Normalize(mean=NORMALIZE_MEAN,
+                                              std=NORMALIZE_STD)
+
+    def __call__(self, sbs):
+        img = sbs.permute(2, 0, 1).float().div_(255)
+        w = img.shape[2]
+        params = self._draw_params()
+        halves = [self.normalize(StereoAugmentBase._augment_half(half, params))
+                  for half in (img[:, :, : w // 2], img[:, :, w // 2 :])]
+        return(torch.cat(halves, dim=2))  # return as side-by-side
+#################################################################################
+
+
+
+#################################################################################
+# Per-sample part of batch augmentation - only resizes the halves;
+#   yields uint8 [H, W, 3] tensor to be augmented by BatchStereoAugment
+class ResizedSbsTransform:
+    def __call__(self, stereo_image):
+        return(torch.from_numpy(ResizeSbsHalves(stereo_image)))
+#################################################################################
+
+
+
+#################################################################################
+# Augments and normalizes whole collated uint8 [B, H, W, 3] SBS batches at once.
+# Flip and jitter parameters are drawn per sample and shared by its halves;
+#   contrast is computed per half, as when halves are jittered separately.
+# Brightness is always applied before contrast (ColorJitter randomizes order).
+# Returns float [B, 3, H, W] normalized batch on the device of the input.
+## Example: images = BatchStereoAugment()(uint8Batch.to(device))
+class BatchStereoAugment:
+    def __init__(self, hflip_p=0.5, vflip_p=0.2, brightness=0.3, contrast=0.3,
+                 seed=AUGMENT_SEED, augment=True):
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.augment = augment
+        self._gen = torch.Generator().manual_seed(seed)
+        self._normCache = {}  # device => (mean, std) tensors
+
+    # State of the augmentation generator - for checkpoints
+    def get_rng_state(self):
+        return(self._gen.get_state())
+
+    def set_rng_state(self, state):
+        self._gen.set_state(state)
+
+    def __call__(self, batch):
+        (b, h, w, c) = batch.shape
+        # view as [B, C, H, half, W/2] - halves are processed in one go
+        x = batch.permute(0, 3, 1, 2).float().div_(255).view(b, c, h, 2, w // 2)
+        if ( self.augment ):
+            x = self._augment(x)
+        (mean, std) = self._norm_tensors(x.device)
+        x = x.sub_(mean).div_(std)
+        return(x.view(b, c, h, w))
+
+    def _augment(self, x):
+        b = x.shape[0]
+        r = torch.rand((4, b), generator=self._gen).to(x.device)
+        def per_sample(v):  return(v.view(b, 1, 1, 1, 1))
+        x = torch.where(per_sample(r[0] < self.hflip_p), x.flip(4), x)
+        x = torch.where(per_sample(r[1] < self.vflip_p), x.flip(2), x)
+        bFactor = per_sample(1.0 + self.brightness * (2 * r[2] - 1))
+        cFactor = per_sample(1.0 + self.contrast   * (2 * r[3] - 1))
+        x = x.mul_(bFactor).clamp_(0, 1)
+        # grayscale mean per sample and half - as in TF.adjust_contrast
+        gray = (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2])
+        grayMean = gray.mean(dim=(1, 3), keepdim=True).unsqueeze(1)
+        return(x.mul_(cFactor).add_((1 - cFactor) * grayMean).clamp_(0, 1))
+
+    def _norm_tensors(self, device):
+        if ( device not in self._normCache ):
+            self._normCache[device] = tuple(
+                torch.tensor(v, device=device).view(1, 3, 1, 1, 1)
+                for v in (NORMALIZE_MEAN, NORMALIZE_STD))
+        return(self._normCache[device])
+#################################################################################
+
+
+
 #################################################################################
 class InferenceStereoTransform:
     def __init__(self, output_size=(SBS_HEIGHT, SBS_WIDTH/2)):
@@ -174,8 +345,109 @@ class InferenceStereoTransform:
 #################################################################################
 
 
-# TODO: comment
-def MakeAnahaldDataloaders(csv_file, sbs_dir, shuffle=SHUFFLE_IMGS):
+# Returns uint8 [SBS_HEIGHT, SBS_WIDTH, 3] array with both halves
+#   resized the same way as by StereoTransform
+def LoadSbsHalvesResized(img_path):
+    return(ResizeSbsHalves(Image.open(img_path).convert("RGB")))
+
+
+# Returns uint8 [SBS_HEIGHT, SBS_WIDTH, 3] array made of RGB PIL SBS image
+def ResizeSbsHalves(image):
+    w, h = image.size
+    halves = [image.crop(box).resize((SBS_WIDTH // 2, SBS_HEIGHT), Image.BILINEAR)
+              for box in ((0, 0, w // 2, h), (w // 2, 0, w, h))]
+    return(np.concatenate([np.asarray(half) for half in halves], axis=1))
+
+
+# Returns (arrayPath, indexPath) of preprocessed dataset for 'csv_file'
+def PreprocessedDatasetPaths(csv_file, cache_dir):
+    csvName = os.path.splitext(os.path.basename(csv_file))[0]
+    base = os.path.join(cache_dir, f"{csvName}__sbs_{SBS_HEIGHT}x{SBS_WIDTH}")
+    return(base + PREPROC_ARRAY_EXT, base + PREPROC_INDEX_SUFFIX)
+
+
+# Tells whether preprocessed dataset is newer than the CSV and all its images
+def _is_preprocessed_dataset_fresh(csv_file, annotations, sbs_dir, sbs_ext,
+                                   arrayPath, indexPath):
+    if ( not (os.path.exists(arrayPath) and os.path.exists(indexPath)) ):
+        return(False)
+    try:
+        index = pd.read_csv(indexPath)
+    except Exception:
+        return(False)
+    if ( (len(index) != len(annotations)) or
+         (not index.iloc[:, 0:2].astype(str).equals(
+                                    annotations.iloc[:, 0:2].astype(str))) ):
+        return(False)
+    arrayMtime = os.path.getmtime(arrayPath)
+    if ( os.path.getmtime(csv_file) > arrayMtime ):
+        return(False)
+    for name in annotations.iloc[:, 0]:
+        imgPath = os.path.join(sbs_dir, f"{name}.{sbs_ext}")
+        if ( (not os.path.exists(imgPath)) or
+             (os.path.getmtime(imgPath) > arrayMtime) ):
+            return(False)
+    return(True)
+
+
+# Decodes and resizes all SBS images listed in 'csv_file' once,
+#   storing them in memory-mappable uint8 array under 'cache_dir'.
+# Skips the work if the stored array is up to date unless 'force'.
+# Returns (arrayPath, indexPath) or (None, None) on error.
+## Example: PreprocessAnahaldDataset('sbs_to_hald.csv', 'ALL_SBS_1080', 'SBS_CACHE')
+def PreprocessAnahaldDataset(csv_file, sbs_dir, cache_dir, sbs_ext=SBS_EXT,
+                             force=False):
+    try:
+        annotations = pd.read_csv(csv_file)
+    except Exception as e:
+        print(f"-E- Error reading CSV from '{csv_file}': {e.__str__()}")
+        return(None, None)
+    (arrayPath, indexPath) = PreprocessedDatasetPaths(csv_file, cache_dir)
+    if ( (not force) and _is_preprocessed_dataset_fresh(csv_file, annotations,
+                                 sbs_dir, sbs_ext, arrayPath, indexPath) ):
+        print(f"-I- Preprocessed dataset '{arrayPath}' is up to date")
+        return(arrayPath, indexPath)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    numImgs = len(annotations)
+    tmpPath = arrayPath + ".tmp"
+    # write under temporary name, so that interrupted run leaves no stale array
+    arr = np.lib.format.open_memmap(tmpPath, mode="w+", dtype=np.uint8,
+                                    shape=(numImgs, SBS_HEIGHT, SBS_WIDTH, 3))
+    for i, name in enumerate(annotations.iloc[:, 0]):
+        imgPath = os.path.join(sbs_dir, f"{name}.{sbs_ext}")
+        try:
+            arr[i] = LoadSbsHalvesResized(imgPath)
+        except Exception as e:
+            print(f"-E- Error reading image '{imgPath}': {e.__str__()}")
+            del arr
+            os.remove(tmpPath)
+            return(None, None)
+        if ( (i + 1) % 100 == 0 ):
+            print(f"-I- Preprocessed {i+1} of {numImgs} image(s)")
+    arr.flush()
+    del arr
+    os.replace(tmpPath, arrayPath)
+
+    index = annotations.iloc[:, 0:2].copy()
+    index["row"] = range(numImgs)
+    index.to_csv(indexPath, index=False)
+    print(f"-I- Preprocessed {numImgs} image(s) into '{arrayPath}'")
+    return(arrayPath, indexPath)
+
+
+# Returns (train_loader, val_loader, full_dataset) or (None, None, None) on error.
+# If 'cache_dir' given, images are decoded once by 'PreprocessAnahaldDataset'
+#   and read from there in all epochs.
+# With 'num_workers' > 0 images are loaded in parallel processes;
+#   'pin_memory' defaults to CUDA availability.
+# With 'batch_augment' loaders yield uint8 batches;
+#   the trainer augments them with 'full_dataset.batch_transform'.
+## Example: (trn, val, ds) = MakeAnahaldDataloaders('sbs_to_hald.csv', 'ALL_SBS_1080', num_workers=8)
+def MakeAnahaldDataloaders(csv_file, sbs_dir, shuffle=SHUFFLE_IMGS,
+                           cache_dir=None, num_workers=NUM_WORKERS,
+                           pin_memory=None, persistent_workers=True,
+                           prefetch_factor=PREFETCH_FACTOR, batch_augment=False):
     # transform = transforms.Compose([
     #     transforms.Resize((SBS_HEIGHT, SBS_WIDTH)),
     #     transforms.ToTensor(),
@@ -184,28 +456,51 @@ def MakeAnahaldDataloaders(csv_file, sbs_dir, shuffle=SHUFFLE_IMGS):
     # ])
     # normalized using the same mean and std as ImageNet
 
-    transform = StereoTransform(output_size=(SBS_HEIGHT, int(SBS_WIDTH/2)))
-    
-    full_dataset = AnahaldDataset(
-        csv_file=csv_file,
-        sbs_dir=sbs_dir,
-        sbs_ext=SBS_EXT,
-        transform=transform
-    )
+    if ( cache_dir is None ):
+        transform = ResizedSbsTransform()  if  ( batch_augment )  else  \
+                    StereoTransform(output_size=(SBS_HEIGHT, int(SBS_WIDTH/2)))
+        full_dataset = AnahaldDataset(
+            csv_file=csv_file,
+            sbs_dir=sbs_dir,
+            sbs_ext=SBS_EXT,
+            transform=transform
+        )
+    else:
+        (arrayPath, indexPath) = PreprocessAnahaldDataset(csv_file, sbs_dir,
+                                                          cache_dir)
+        if ( arrayPath is None ):
+            print(f"-E- Failed preprocessing dataset into '{cache_dir}'")
+            return(None, None, None)
+        full_dataset = PreprocessedAnahaldDataset(arrayPath, indexPath, SBS_EXT,
+                            None  if  ( batch_augment )  else  TensorStereoTransform())
     if ( full_dataset.is_valid == False ):
         print(f"-E- Failed loading (full) dataset")
-        return(None, None)
+        return(None, None, None)
+    if ( batch_augment ):
+        full_dataset.batch_transform = BatchStereoAugment()
 
     # Split dataset into training-and validation, create the two DataLoader-s
     train_size = int(0.8 * len(full_dataset))
     val_size = len(full_dataset) - train_size
-    generator = torch.Generator().manual_seed(42)  # for reproducibility
+    generator = torch.Generator().manual_seed(SPLIT_SEED)  # for reproducibility
     train_dataset, val_dataset = torch.utils.data.random_split(full_dataset,
                                    [train_size, val_size], generator=generator)
+
+    if ( pin_memory is None ):
+        pin_memory = torch.cuda.is_available()
+    workerOptions = {}
+    if ( num_workers > 0 ):
+        workerOptions = {"persistent_workers": persistent_workers,
+                         "prefetch_factor": prefetch_factor}
+    # loader generators drive shuffling and per-worker augmentation seeds
     train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE,
-                              shuffle=shuffle)
+                              shuffle=shuffle, num_workers=num_workers,
+                              pin_memory=pin_memory, **workerOptions,
+                  generator=torch.Generator().manual_seed(SPLIT_SEED + 1))
     val_loader   = DataLoader(val_dataset, batch_size=BATCH_SIZE,
-                              shuffle=False)
+                              shuffle=False, num_workers=num_workers,
+                              pin_memory=pin_memory, **workerOptions,
+                  generator=torch.Generator().manual_seed(SPLIT_SEED + 2))
     return(train_loader, val_loader, full_dataset)
 ##
 #################################################################################
@@ -238,3 +533,33 @@ def DEBUG__TestAnahaldDataloaders(csv_file, sbs_dir):
         result &= ListAnahaldDataloader(dataloader, typeStr)
     return(result)
 ##
+
+
+# Checks that augmentation of preprocessed SBS-s uses the shared
+#   StereoAugmentBase and leaves the global torch RNG state unchanged.
+# Builds a tiny preprocessed dataset of random images in 'tmp_dir'.
+## Example: DEBUG__TestTensorStereoTransform('TMP')
+def DEBUG__TestTensorStereoTransform(tmp_dir):
+    if ( not issubclass(TensorStereoTransform, StereoAugmentBase) ):
+        print(f"-E- TensorStereoTransform does not derive from StereoAugmentBase")
+        return(0)
+    os.makedirs(tmp_dir, exist_ok=True)
+    arrayPath = os.path.join(tmp_dir, f"debug_sbs{PREPROC_ARRAY_EXT}")
+    indexPath = os.path.join(tmp_dir, f"debug_sbs{PREPROC_INDEX_SUFFIX}")
+    numImgs = 3
+    np.save(arrayPath, np.random.RandomState(SPLIT_SEED).randint(0, 256,
+                (numImgs, SBS_HEIGHT, SBS_WIDTH, 3), dtype=np.uint8))
+    pd.DataFrame({"filename": [f"IMG{i}" for i in range(numImgs)],
+                  "label":    ["ahg_oleg_id"] * numImgs,
+                  "row":      range(numImgs)}).to_csv(indexPath, index=False)
+    dSet = PreprocessedAnahaldDataset(arrayPath, indexPath, SBS_EXT,
+                                      transform=TensorStereoTransform())
+    rngState = torch.get_rng_state()
+    for i in range(numImgs):
+        dSet[i]
+    if ( not torch.equal(rngState, torch.get_rng_state()) ):
+        print(f"-E- Indexing preprocessed dataset changed global torch RNG state")
+        return(0)
+    print(f"-I- Success testing TensorStereoTransform")
+    return(1)
+##
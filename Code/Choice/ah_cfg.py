@@ -12,9 +12,23 @@
 
 # ah_cfg.py - simplistic configuration file for Anahald Viewer
 
+import os
+
 class AhConfig:
     OUTDIR_NAME = "ANA"
     MAKE_TIFF   = False   # True or False
     WINDOW_WIDTH  = 1024  # must be 800 ... (screen_width  -delta)
     WINDOW_HEIGHT = 640   # must be 600 ... (screen_height -delta)
+    HALD_ENGINE   = "numpy"      # "numpy" (in-process) or "magick" (ImageMagick)
+    HALD_INTERPOLATION = "trilinear"  # "trilinear" or "tetrahedral"
+    LUT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # fits all 7 sample HALD-s (~100 MB each)
+    MODEL_SERVER_PORT = 8765
+    MODEL_SERVER_URL  = ""  # e.g. "http://127.0.0.1:8765"; "" - run model in-process
+    PREVIEW_CACHE_SIZE = 16       # rendered previews kept for instant browsing
+    PREFETCH_NEIGHBOURS = True    # render next/previous image previews in background
+    LIVE_PREVIEW = True           # re-render preview while HALD/gamma change ("numpy" engine only)
+    # auto-choice model - used by the viewer, the server and command-line chooser
+    MODEL_FILENAME = "anahald_model_params__96d5__20250814-231159.pth"
+    MODEL_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "..", "..", "CHOICE_MODELS", MODEL_FILENAME)
 #################################################################################
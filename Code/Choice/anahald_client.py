@@ -0,0 +1,89 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# anahald_client.py - thin client of anahald_server.py; needs no torch
+
+import json
+import os
+import urllib.error
+import urllib.request
+
+from ah_cfg import *
+
+
+CLIENT_TIMEOUT_SEC = 600
+CLIENT_CHUNK_SIZE  = 16   # images per request; server batches concurrent requests too
+
+
+#################################################################################
+## Example:  cl = AnahaldClient();  cl.is_alive() and cl.predict_halds(["ALL_SBS_1080/DSC00033.TIF"])
+class AnahaldClient:
+    def __init__(self, url=None):
+        if ( (url is None) or (url == "") ):
+            url = AhConfig.MODEL_SERVER_URL
+        self.url = url.rstrip("/")
+
+
+    def is_alive(self):
+        return(self.status() is not None)
+
+
+    # Returns server status dictionary or None if unreachable
+    def status(self):
+        return(self._request("GET", "/status", None, timeout=2, loud=False))
+
+
+    # Returns list of (haldId, confidence) or None on error
+    def predict_halds(self, paths):
+        res = self._request("POST", "/predict",
+                            {"paths": [os.path.abspath(p) for p in paths]})
+        return(None  if  (res is None)  else  [tuple(r) for r in res["results"]])
+
+
+    # Same as AnahaldNetBase.apply_hald_make_ana, but runs in the server
+    def apply_hald_make_ana(self, sbsPath, haldId, haldDirs, outDir, *,
+                            gamma=-1, maxWidth=-1, maxHeight=-1, isPreview=False):
+        res = self._request("POST", "/apply", {"sbsPath": os.path.abspath(sbsPath),
+                 "haldId": haldId, "outDir": os.path.abspath(outDir),
+                 "haldDirs": [os.path.abspath(d) for d in haldDirs],
+                 "gamma": gamma, "maxWidth": maxWidth, "maxHeight": maxHeight,
+                 "isPreview": isPreview})
+        return(None  if  (res is None)  else  res["anaPath"])
+
+
+    # Predicts HALD-s and makes anaglyphs;
+    # returns list of (haldId, confidence, anaPath-or-None) or None on error
+    def choose_halds_make_ana(self, paths, haldDirs, outDir):
+        res = self._request("POST", "/choose",
+                            {"paths": [os.path.abspath(p) for p in paths],
+                             "haldDirs": [os.path.abspath(d) for d in haldDirs],
+                             "outDir": os.path.abspath(outDir)})
+        return(None  if  (res is None)  else  [tuple(r) for r in res["results"]])
+
+
+    def _request(self, method, path, obj, timeout=CLIENT_TIMEOUT_SEC, loud=True):
+        data = None  if  (obj is None)  else  json.dumps(obj).encode("utf-8")
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return(json.loads(resp.read()))
+        except urllib.error.HTTPError as e:
+            if ( loud ):
+                print(f"-E- Anahald server error for '{path}': {e.read().decode('utf-8', 'replace')}")
+            return(None)
+        except Exception as e:
+            if ( loud ):
+                print(f"-E- Anahald server at '{self.url}' unreachable: {e}")
+            return(None)
+#################################################################################
@@ -0,0 +1,167 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# anahald_runtime.py - runs HALD-choice model exported by ExportAnahaldResnet()
+#   with TorchScript or ONNX Runtime; needs neither torchvision nor training code.
+# The exported artifact carries label codes and preprocessing constants.
+
+import json
+import os
+import numpy as np
+from PIL import Image
+
+
+################## HOW TO LOAD THE CODE #########################################
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from anahald_runtime import *
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import anahald_runtime;  importlib.reload(anahald_runtime);  from anahald_runtime import *
+#################################################################################
+
+
+RUNTIME_META_NAME = "anahald_meta.json"   # TorchScript extra file / ONNX metadata key
+TORCHSCRIPT_SUFFIX = "__script.pt"
+ONNX_SUFFIX = ".onnx"
+RUNTIME_BATCH_SIZE = 16
+
+
+# Returns (torchScriptPath, onnxPath) of artifacts exported from 'pthPath'
+def ExportedModelPaths(pthPath):
+    base = os.path.splitext(pthPath)[0]
+    return(base + TORCHSCRIPT_SUFFIX, base + ONNX_SUFFIX)
+
+
+# Returns path of existing exported artifact for 'pthPath' - TorchScript
+#   preferred - or None if neither exists
+def FindExportedModel(pthPath):
+    for path in ExportedModelPaths(pthPath):
+        if ( os.path.exists(path) ):
+            return(path)
+    return(None)
+
+
+#################################################################################
+# Same prediction interface as AnahaldNetBase:
+#   predict_hald(), predict_halds(), inference_transforms, _predict_tensor_batch()
+## Example:  rt = AnahaldRuntime("MODELS/anahald_model_params__96d5__20250814-231159__script.pt");  rt.predict_hald("ALL_SBS_1080/DSC00033.TIF")
+class AnahaldRuntime:
+    def __init__(self, artifactPath):
+        self.isValid = False
+        self.artifactPath = artifactPath
+        self.isOnnx = artifactPath.lower().endswith(ONNX_SUFFIX)
+        try:
+            if ( self.isOnnx ):
+                import onnxruntime
+                self.session = onnxruntime.InferenceSession(artifactPath,
+                                          providers=["CPUExecutionProvider"])
+                metaStr = self.session.get_modelmeta().custom_metadata_map[
+                                                               RUNTIME_META_NAME]
+                self.inputName = self.session.get_inputs()[0].name
+            else:
+                import torch
+                self.torch = torch
+                extraFiles = {RUNTIME_META_NAME: ""}
+                self.module = torch.jit.load(artifactPath, map_location="cpu",
+                                             _extra_files=extraFiles)
+                self.module.eval()
+                metaStr = extraFiles[RUNTIME_META_NAME]
+            meta = json.loads(metaStr)
+        except Exception as e:
+            print(f"-E- Failed loading exported model '{artifactPath}': {e}")
+            return
+        self.meta = meta
+        self.idx2label = {int(code): label
+                          for (code, label) in meta["labelCodes"].items()}
+        self.sbsWidth  = int(meta["sbsWidth"])
+        self.sbsHeight = int(meta["sbsHeight"])
+        self.mean = np.array(meta["normalizeMean"], dtype=np.float32).reshape(3, 1, 1)
+        self.std  = np.array(meta["normalizeStd"],  dtype=np.float32).reshape(3, 1, 1)
+        self.inference_transforms = self._preprocess
+        self.isValid = True
+        print(f"-I- Loaded exported model '{artifactPath}'")
+
+
+    # Same as InferenceStereoTransform: halves resized separately
+    #   (PIL bilinear), scaled to 0..1 and normalized; returns [3, H, W]
+    def _preprocess(self, image):
+        w, h = image.size
+        halves = [np.asarray(image.crop(box).resize(
+                                (self.sbsWidth // 2, self.sbsHeight), Image.BILINEAR))
+                  for box in ((0, 0, w // 2, h), (w // 2, 0, w, h))]
+        arr = np.concatenate(halves, axis=1).transpose(2, 0, 1).astype(np.float32)
+        arr = (arr / 255.0 - self.mean) / self.std
+        return(arr  if  self.isOnnx  else  self.torch.from_numpy(arr))
+
+
+    # Returns transformed image or None on error
+    def _transform_for_inference(self, pathOrImage):
+        try:
+            if ( isinstance(pathOrImage, Image.Image) ):
+                image = pathOrImage.convert("RGB")
+            else:
+                with Image.open(pathOrImage) as f:
+                    image = f.convert("RGB")
+            return(self._preprocess(image))
+        except Exception as e:
+            print(f"-E- Failed reading image '{pathOrImage}': {e}")
+            return(None)
+
+
+    # Returns list of (haldStr, confidence) for stacked batch
+    def _predict_tensor_batch(self, batch):
+        if ( self.isOnnx ):
+            logits = self.session.run(None, {self.inputName: np.asarray(batch)})[0]
+        else:
+            with self.torch.inference_mode():
+                logits = self.module(batch).float().numpy()
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        results = []
+        for (predicted_idx, conf) in zip(probs.argmax(axis=1).tolist(),
+                                         probs.max(axis=1).tolist()):
+            if ( predicted_idx not in self.idx2label ):
+                print(f"-E- Unknown HALD code '{predicted_idx}'")
+                results.append((None, conf))
+            else:
+                results.append((self.idx2label[predicted_idx], conf))
+        return(results)
+
+
+    # Returns list of (haldStr, confidence) in the input order
+    def predict_halds(self, pathsOrImages, batch_size=RUNTIME_BATCH_SIZE):
+        results = []
+        items = list(pathsOrImages)
+        for i in range(0, len(items), batch_size):
+            batch = [self._transform_for_inference(x) for x in items[i : i + batch_size]]
+            good = [t for t in batch if t is not None]
+            if ( len(good) == 0 ):
+                choices = iter([])
+            elif ( self.isOnnx ):
+                choices = iter(self._predict_tensor_batch(np.stack(good)))
+            else:
+                choices = iter(self._predict_tensor_batch(self.torch.stack(good)))
+            results.extend([next(choices)  if  (t is not None)  else  (None, 0.0)
+                            for t in batch])
+        return(results)
+
+
+    def predict_hald(self, imgPath):
+        [(haldStr, conf)] = self.predict_halds([imgPath], batch_size=1)
+        if ( haldStr is None ):
+            return(None)  # error already printed
+        print(f"-I- Predicted HALD for '{imgPath}' is '{haldStr}' (confidence: {conf:.2f})")
+        return(haldStr)
+#################################################################################
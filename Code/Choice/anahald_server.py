@@ -0,0 +1,239 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# anahald_server.py - resident HALD-choice server on localhost.
+# Keeps the network and the HALD LUT cache warm between invocations;
+#   requests arriving together are inferred as one batch.
+## Usage example:
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\anahald_server.py  [--port 8765]  [--model PATH.pth]  [--any-outdir]
+## Protocol - JSON over HTTP (see anahald_client.py):
+##    POST /predict  {"paths": [...]}                   => {"results": [[haldId, confidence], ...]}
+##    POST /apply    {"sbsPath", "haldId", "outDir", optional "gamma", "maxWidth", "maxHeight", "isPreview"}  => {"anaPath": path-or-null}
+##    POST /choose   {"paths": [...], "outDir"}          => {"results": [[haldId, confidence, anaPath], ...]}
+##    GET  /status                                      => {"model", "batches", "images", "lutCache"}
+## Security: listens on 127.0.0.1 only and trusts local clients - it reads
+##    any image or HALD path a request names. Output directories must be
+##    the input image's directory or under it, unless started with --any-outdir.
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_PATH = os.path.realpath(__file__)
+CHOICE_DIR  = os.path.dirname(SCRIPT_PATH)
+sys.path.append(CHOICE_DIR)
+from choose_hald_resnet import *
+from ah_cfg import *             # need AhConfig.MODEL_PATH
+
+HALD_ROOTDIR = os.path.join(CHOICE_DIR, "..", "..", "SAMPLE_HALDS")
+HALD_DIRS = [HALD_ROOTDIR, os.path.join(HALD_ROOTDIR, "ADD")]
+
+MICRO_BATCH_MAX_SIZE = 32
+MICRO_BATCH_MAX_WAIT_SEC = 0.02   # how long the 1st request waits for company
+
+
+#################################################################################
+# Collects transformed images submitted by concurrent requests into batches
+class MicroBatcher:
+    def __init__(self, ah, maxBatch=MICRO_BATCH_MAX_SIZE,
+                 maxWaitSec=MICRO_BATCH_MAX_WAIT_SEC):
+        self.ah = ah
+        self.maxBatch = maxBatch
+        self.maxWaitSec = maxWaitSec
+        self.numBatches = 0
+        self.numImages = 0
+        self._q = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    # Queues transformed image; returns ticket for 'wait'
+    def submit(self, tensor):
+        ticket = {"tensor": tensor, "event": threading.Event(),
+                  "result": (None, 0.0)}
+        self._q.put(ticket)
+        return(ticket)
+
+
+    # Returns (haldId, confidence) for the ticket
+    def wait(self, ticket):
+        ticket["event"].wait()
+        return(ticket["result"])
+
+
+    def _run(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.maxWaitSec
+            while ( len(batch) < self.maxBatch ):
+                remaining = deadline - time.monotonic()
+                if ( remaining <= 0 ):
+                    break
+                try:
+                    batch.append(self._q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.ah._predict_tensor_batch(
+                                torch.stack([t["tensor"] for t in batch]))
+            except Exception as e:
+                print(f"-E- Failed HALD inference for batch of {len(batch)}: {e}")
+                results = [(None, 0.0)] * len(batch)
+            self.numBatches += 1
+            self.numImages += len(batch)
+            for (ticket, res) in zip(batch, results):
+                ticket["result"] = res
+                ticket["event"].set()
+#################################################################################
+
+
+
+#################################################################################
+class AnahaldServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, ah, modelPath, haldDirs, port, anyOutDir=False):
+        self.ah = ah
+        self.modelPath = modelPath
+        self.haldDirs = haldDirs
+        self.anyOutDir = anyOutDir
+        self.batcher = MicroBatcher(ah)
+        super().__init__(("127.0.0.1", port), _AnahaldRequestHandler)
+
+
+    # Returns list of (haldId, confidence) for image paths
+    def predict_paths(self, paths):
+        tickets = []
+        for p in paths:
+            tensor = self.ah._transform_for_inference(p)
+            tickets.append(None  if  (tensor is None)  else
+                           self.batcher.submit(tensor))
+        return([self.batcher.wait(t)  if  (t is not None)  else  (None, 0.0)
+                for t in tickets])
+
+
+    # Tells whether results for 'sbsPath' may be written into 'outDir'
+    def is_outdir_allowed(self, sbsPath, outDir):
+        if ( self.anyOutDir ):
+            return(True)
+        imgDir = os.path.dirname(os.path.realpath(sbsPath))
+        try:
+            return(os.path.commonpath([imgDir, os.path.realpath(outDir)]) == imgDir)
+        except ValueError:  # e.g. different drives
+            return(False)
+
+
+    def status(self):
+        return({"model": self.modelPath, "batches": self.batcher.numBatches,
+                "images": self.batcher.numImages,
+                "lutCache": GetHaldLutCache().get_stats()})
+#################################################################################
+
+
+
+class _AnahaldRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if ( self.path == "/status" ):
+            self._reply(200, self.server.status())
+        else:
+            self._reply(404, {"error": f"Unknown request '{self.path}'"})
+
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length) or b"{}")
+            if ( self.path == "/predict" ):
+                res = self.server.predict_paths(req["paths"])
+                self._reply(200, {"results": [list(r) for r in res]})
+            elif ( self.path == "/apply" ):
+                if ( not self.server.is_outdir_allowed(req["sbsPath"], req["outDir"]) ):
+                    self._reply(403, {"error": f"Output directory '{req['outDir']}' is outside of the image directory"})
+                    return
+                anaPath = AnahaldNetBase.apply_hald_make_ana(req["sbsPath"],
+                    req["haldId"], req.get("haldDirs", self.server.haldDirs),
+                    req["outDir"], gamma=req.get("gamma", -1),
+                    maxWidth=req.get("maxWidth", -1),
+                    maxHeight=req.get("maxHeight", -1),
+                    isPreview=req.get("isPreview", False))
+                self._reply(200, {"anaPath": anaPath})
+            elif ( self.path == "/choose" ):
+                haldDirs = req.get("haldDirs", self.server.haldDirs)
+                results = []
+                for (p, (haldId, conf)) in zip(req["paths"],
+                                       self.server.predict_paths(req["paths"])):
+                    anaPath = None
+                    if ( not self.server.is_outdir_allowed(p, req["outDir"]) ):
+                        print(f"-E- Output directory '{req['outDir']}' is outside of the directory of '{p}'")
+                    elif ( haldId is not None ):
+                        anaPath = AnahaldNetBase.apply_hald_make_ana(p, haldId,
+                                                      haldDirs, req["outDir"])
+                    results.append([haldId, conf, anaPath])
+                self._reply(200, {"results": results})
+            else:
+                self._reply(404, {"error": f"Unknown request '{self.path}'"})
+        except Exception as e:
+            print(f"-E- Failed serving '{self.path}': {e}")
+            self._reply(500, {"error": str(e)})
+
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass  # per-request lines of BaseHTTPRequestHandler are too noisy
+
+
+
+## Example:  server = StartAnahaldServer(AhConfig.MODEL_PATH, HALD_DIRS, 8765);  server.serve_forever()
+def StartAnahaldServer(modelPath, haldDirs, port, anyOutDir=False):
+    ah = LoadSavedAnahaldResnet(modelPath)
+    if ( ah is None ):
+        print(f"-E- Failed loading model file '{modelPath}'")
+        return(None)
+    try:
+        server = AnahaldServer(ah, modelPath, haldDirs, port, anyOutDir)
+    except OSError as e:
+        print(f"-E- Cannot listen on port {port}: {e}")
+        return(None)
+    print(f"-I- Anahald server listens on http://127.0.0.1:{port}")
+    return(server)
+
+
+if ( __name__ == "__main__" ):
+    parser = argparse.ArgumentParser(description="Resident Anahald HALD-choice server")
+    parser.add_argument("--port", type=int, default=AhConfig.MODEL_SERVER_PORT)
+    parser.add_argument("--model", default=AhConfig.MODEL_PATH)
+    parser.add_argument("--any-outdir", action="store_true",
+                        help="allow writing results outside of input image directories")
+    args = parser.parse_args()
+    server = StartAnahaldServer(args.model, HALD_DIRS, args.port,
+                                args.any_outdir)
+    if ( server is None ):
+        sys.exit(1)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("-I- Anahald server stopped")
+    sys.exit(0)
@@ -0,0 +1,170 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# batch_pipeline.py - pipelined decode -> infer -> apply over many SBS images
+
+import os
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+from make_anaglyph import *
+
+
+################## HOW TO LOAD THE CODE #########################################
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from choose_hald_resnet import *;  from batch_pipeline import *
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import batch_pipeline;  importlib.reload(batch_pipeline);  from batch_pipeline import *
+#################################################################################
+
+
+DECODE_WORKERS = 2
+INFER_BATCH_SIZE = 16
+APPLY_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+QUEUE_DEPTH_IN_BATCHES = 2   # bounds decoded images held in memory
+
+_END = None                  # end-of-stream marker passed between stages
+
+
+#################################################################################
+# Chooses HALD-s and makes anaglyphs for many SBS images.
+# Stages run concurrently and are connected by bounded queues:
+#  - decode: 'decodeWorkers' threads open images and make inference tensors
+#  - infer:  one thread runs the network over batches of up to 'batchSize'
+#  - apply:  'applyWorkers' threads apply the chosen HALD and write anaglyphs
+# Decoded images are handed over to the apply stage, so each is read once.
+## Example:  ah = LoadSavedAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth");  pl = AnahaldBatchPipeline(ah, ["SAMPLE_HALDS", "SAMPLE_HALDS/ADD"], "TMP");  results = pl.run(glob.glob("ALL_SBS_1080/*.TIF"))
+class AnahaldBatchPipeline:
+    def __init__(self, ah, haldDirs, outDir, *, decodeWorkers=DECODE_WORKERS,
+                 batchSize=INFER_BATCH_SIZE, applyWorkers=APPLY_WORKERS):
+        self.ah = ah
+        self.haldDirs = haldDirs
+        self.outDir = outDir
+        self.decodeWorkers = max(1, decodeWorkers)
+        self.batchSize = max(1, batchSize)
+        self.applyWorkers = max(1, applyWorkers)
+
+
+    # Processes all images in 'inpPaths'.
+    # Returns dictionary {inpPath :: anaglyph-path or None on error}
+    def run(self, inpPaths):
+        os.makedirs(self.outDir, exist_ok=True)
+        depth = self.batchSize * QUEUE_DEPTH_IN_BATCHES
+        self._pathQ   = queue.Queue()
+        self._decodedQ = queue.Queue(maxsize=depth)
+        self._chosenQ  = queue.Queue(maxsize=depth)
+        self._results = {}
+        self._resultsLock = threading.Lock()
+        for p in inpPaths:
+            self._pathQ.put(p)
+        for i in range(self.decodeWorkers):
+            self._pathQ.put(_END)
+
+        threads =  [threading.Thread(target=self._decode_worker, daemon=True)
+                                            for i in range(self.decodeWorkers)]
+        threads += [threading.Thread(target=self._infer_worker, daemon=True)]
+        threads += [threading.Thread(target=self._apply_worker, daemon=True)
+                                            for i in range(self.applyWorkers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        errCnt = sum(1 for v in self._results.values() if v is None)
+        print(f"-I- Batch pipeline processed {len(self._results)} image(s); {errCnt} error(s)")
+        return(self._results)
+
+
+    def _set_result(self, inpPath, anaPathOrNone):
+        with self._resultsLock:
+            self._results[inpPath] = anaPathOrNone
+
+
+    def _decode_worker(self):
+        while True:
+            inpPath = self._pathQ.get()
+            if ( inpPath is _END ):
+                self._decodedQ.put(_END)
+                return
+            try:
+                with Image.open(inpPath) as f:
+                    image = f.convert("RGB")
+                tensor = self.ah.inference_transforms(image)
+            except Exception as e:
+                print(f"-E- Failed decoding '{inpPath}': {e}")
+                self._set_result(inpPath, None)
+                continue
+            self._decodedQ.put((inpPath, image, tensor))
+
+
+    def _infer_worker(self):
+        endsLeft = self.decodeWorkers
+        while ( endsLeft > 0 ):
+            batch = []
+            # block for the 1st item, then take whatever is ready up to batch size
+            while ( (endsLeft > 0) and (len(batch) < self.batchSize) ):
+                try:
+                    item = self._decodedQ.get(block=(len(batch) == 0))
+                except queue.Empty:
+                    break
+                if ( item is _END ):
+                    endsLeft -= 1
+                else:
+                    batch.append(item)
+            if ( len(batch) > 0 ):
+                self._infer_one_batch(batch)
+        for i in range(self.applyWorkers):
+            self._chosenQ.put(_END)
+
+
+    def _infer_one_batch(self, batch):
+        try:
+            tensors = [tensor for (_p, _i, tensor) in batch]
+            # ONNX runtime (anahald_runtime.py) works with numpy arrays;
+            #   torch is imported only for torch models - keeps cold start light
+            if ( isinstance(tensors[0], np.ndarray) ):
+                batchTensor = np.stack(tensors)
+            else:
+                import torch
+                batchTensor = torch.stack(tensors)
+            choices = self.ah._predict_tensor_batch(batchTensor)
+        except Exception as e:
+            print(f"-E- Failed HALD inference for batch of {len(batch)}: {e}")
+            for (inpPath, _i, _t) in batch:
+                self._set_result(inpPath, None)
+            return
+        for ((inpPath, image, _t), (haldId, conf)) in zip(batch, choices):
+            if ( haldId is None ):
+                self._set_result(inpPath, None)  # error already printed
+                continue
+            print(f"-I- Predicted HALD for '{inpPath}' is '{haldId}' (confidence: {conf:.2f})")
+            self._chosenQ.put((inpPath, image, haldId))
+
+
+    def _apply_worker(self):
+        while True:
+            item = self._chosenQ.get()
+            if ( item is _END ):
+                return
+            (inpPath, image, haldId) = item
+            try:
+                res = ApplyHaldMakeAna(inpPath, haldId,
+                                   self.haldDirs, self.outDir, sbsImage=image)
+            except Exception as e:
+                print(f"-E- Failed making anaglyph of '{inpPath}': {e}")
+                res = None
+            self._set_result(inpPath, res)
+#################################################################################
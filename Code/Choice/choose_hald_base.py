@@ -12,10 +12,13 @@
 
 # choose_hald_base.py
 
+import contextlib
 from datetime import datetime
 import os
 from pathlib import Path
+import random
 import subprocess
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -25,6 +28,8 @@ from PIL import Image
 from AnahaldDataset import *
 from search_ana import *
 from ah_cfg import *
+from hald_lut import *
+from make_anaglyph import *
 
 
 ################## HOW TO LOAD THE CODE #########################################
@@ -47,15 +52,26 @@ NUM_HALDS = 7
 NUM_EPOCHS = 2
 MIN_ACCURACY_FOR_EARLY_STOP = 99.0
 SUFFICIENT_ACCURACY_TO_STOP = 96.5
+PRECISION_FP32 = "fp32"   # float32 NCHW - reference
+PRECISION_BF16 = "bf16"   # bfloat16 autocast with channels_last memory format
+CHECKPOINT_EVERY_EPOCHS = 1
+CHECKPOINT_FILENAME = "anahald_checkpoint.pt"  # latest one; replaced atomically
 
 
 #################################################################################
 class AnahaldNetBase:
-    def __init__(self, csv_or_pth_file, sbs_dir, out_dir=""):
+    # 'precision' is PRECISION_FP32 or PRECISION_BF16
+    # 'loaderOptions' are passed to MakeAnahaldDataloaders (e.g. cache_dir)
+    def __init__(self, csv_or_pth_file, sbs_dir, out_dir="",
+                 precision=PRECISION_FP32, **loaderOptions):
         # if CSV path given, net is trained; otherwise - parameters are loaded
         extension = (os.path.splitext(csv_or_pth_file)[1]).lower()
         isTrainRequest = (extension == ".csv")
+        if ( precision not in (PRECISION_FP32, PRECISION_BF16) ):
+            raise Exception(f"Unsupported precision '{precision}'")
+        self.precision = precision
         self._validationAccuracies = []
+        self._epochsDone = 0      # grows across resumed runs
         self.idx2label = None
         self.outDir = out_dir
         self.inference_transforms = InferenceStereoTransform(
@@ -66,31 +82,59 @@ class AnahaldNetBase:
             self.optimizer = torch.optim.Adam(self.model.parameters(),
                                           lr=1e-4, weight_decay=1e-4)
             self.train_loader, self.val_loader, self.dataset = MakeAnahaldDataloaders(
-                                                        csv_or_pth_file, sbs_dir)
+                                       csv_or_pth_file, sbs_dir, **loaderOptions)
             self.isValid = not ((self.train_loader is None) or
                                 (self.val_loader is None))
+            # set if loaders yield raw uint8 batches to be augmented here
+            self.batch_transform = None  if  ( self.dataset is None )  else \
+                                   self.dataset.batch_transform
         else:                   # provide empty network for loading saved model
+            self.dataset = None
             self.isValid = True
 
             
     def _prepare_model(self, isTrainRequest):
         raise Exception("AnahaldNetBase._prepare_model() should not be called")
+
+
+    # Runs the model on 'images' in the chosen precision; returns float32 outputs
+    def run_model(self, images):
+        if ( self.precision == PRECISION_FP32 ):
+            return(self.model(images))
+        images = images.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=images.device.type, dtype=torch.bfloat16):
+            outputs = self.model(images)
+        return(outputs.float())
+
+
+    # Reshapes the model to fit saved 'stateDict' if needed; overloaded per network
+    def _adapt_model_to_state_dict(self, stateDict):
+        return
     
 
-    def train_model(self, num_epochs=NUM_EPOCHS):
+    # Trains until 'num_epochs' epochs in total are done - including those
+    #   restored by 'load_checkpoint'.
+    # If 'checkpoint_dir' given, stores checkpoint there every
+    #   'checkpoint_every' epochs and upon stop.
+    def train_model(self, num_epochs=NUM_EPOCHS, checkpoint_dir="",
+                    checkpoint_every=CHECKPOINT_EVERY_EPOCHS):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        for epoch in range(num_epochs):
+        avg_loss_per_batch = float("nan")  # in case all epochs are done already
+        for epoch in range(self._epochsDone, num_epochs):
             self.model.train()
             running_loss = 0.0
             total_batches = 0
             correct = 0
             total = 0
             for images, labels, filenames in self.train_loader:
-                images, labels = images.to(device), labels.to(device)
+                images, labels = (images.to(device, non_blocking=True),
+                                  labels.to(device, non_blocking=True))
+                if ( self.batch_transform is not None ):
+                    images = self.batch_transform(images)
 
                 # Forward pass
                 self.optimizer.zero_grad()
-                outputs = self.model(images)
+                outputs = self.run_model(images)
                 #print(f"-D- Epoch {epoch+1}: outputs='{outputs}', labels='{labels}'")
                 loss = self.criterion(outputs, labels)
                 _, predicted = torch.max(outputs, 1)  # decode one-hot encoding
@@ -115,6 +159,15 @@ class AnahaldNetBase:
                   f"Valid-Accuracy: {val_accuracy:.2f}%")
 
             self._validationAccuracies.append(val_accuracy)
+            self._epochsDone = epoch + 1
+            isLastEpoch = ((epoch + 1 == num_epochs) or
+                           (val_accuracy >= SUFFICIENT_ACCURACY_TO_STOP) or
+                           ((val_accuracy >= MIN_ACCURACY_FOR_EARLY_STOP) and
+                            (not self._AccuracyGrows())))
+            if ( (checkpoint_dir != "") and
+                 (isLastEpoch or (self._epochsDone % checkpoint_every == 0)) ):
+                self.save_checkpoint(os.path.join(checkpoint_dir,
+                                                  CHECKPOINT_FILENAME))
             if ( val_accuracy >= SUFFICIENT_ACCURACY_TO_STOP ):
                 print(f"-I- Epoch [{epoch+1}/{num_epochs}]>  Training stopped early, since accuracy of {val_accuracy} is achieved")
                 if ( self.outDir != "" ):
@@ -138,8 +191,11 @@ class AnahaldNetBase:
             print(f"-I- ... Calculating validation accuracy ...")
         with torch.no_grad():
             for images, labels, filenames in self.val_loader:
-                images, labels = images.to(device), labels.to(device)
-                outputs = self.model(images)
+                images, labels = (images.to(device, non_blocking=True),
+                                  labels.to(device, non_blocking=True))
+                if ( self.batch_transform is not None ):
+                    images = self.batch_transform(images)
+                outputs = self.run_model(images)
                 loss = self.criterion(outputs, labels)
                 running_val_loss += loss.item()
 
@@ -181,16 +237,99 @@ class AnahaldNetBase:
         finally:
             self.model.to(currDevice)  # return to the old device
         print(f"-I- Saved model in '{modelPath}'")
-        AnahaldNetBase.store_dictionary_in_csv(self.dataset.GetLabelCodesMap(),
-                                               labelMapPath)
+        # retrained head may come with its own label map - not from dataset
+        labelMap = self.dataset.GetLabelCodesMap()  if  ( self.dataset is not None )  \
+                   else  self.idx2label
+        AnahaldNetBase.store_dictionary_in_csv(labelMap, labelMapPath)
         return(1)
 
     
+    # Stores everything needed to continue training in 'ckptPath':
+    #   model, optimizer, epoch count, accuracy history and RNG states.
+    # Writes under temporary name first, so that a crash leaves the old one intact.
+    # Returns 1 on success, 0 on error.
+    def save_checkpoint(self, ckptPath):
+        rngStates = {"torch": torch.get_rng_state(),
+                     "python": random.getstate(),
+                     "numpy": np.random.get_state()}
+        if ( torch.cuda.is_available() ):
+            rngStates["cuda"] = torch.cuda.get_rng_state_all()
+        for (key, holder) in self._rng_state_holders():
+            rngStates[key] = (holder.get_state()
+                              if  ( isinstance(holder, torch.Generator) )  else
+                              holder.get_rng_state())
+        ckpt = {"model": self.model.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "epochsDone": self._epochsDone,
+                "validationAccuracies": self._validationAccuracies,
+                "labelCodes": self.dataset.GetLabelCodesMap(),
+                "rngStates": rngStates}
+        tmpPath = ckptPath + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(ckptPath)), exist_ok=True)
+            torch.save(ckpt, tmpPath)
+            os.replace(tmpPath, ckptPath)
+        except Exception as e:
+            print(f"-E- Error saving checkpoint in '{ckptPath}': {e}")
+            return(0)
+        print(f"-I- Saved checkpoint after epoch {self._epochsDone} in '{ckptPath}'")
+        return(1)
+
+
+    # Returns [(key, generator-or-transform)] of the RNG-s besides the global
+    #   ones that a resumed run needs to repeat an uninterrupted one:
+    #   shuffling/worker seeds of the loaders and main-process augmentation.
+    # With 'num_workers' > 0 augmentation runs in the workers, seeded from
+    #   the loader generator whenever workers start - so a resumed run repeats
+    #   the uninterrupted one only if the workers are not persistent.
+    def _rng_state_holders(self):
+        holders = [("loader", self.train_loader.generator),
+                   ("valLoader", self.val_loader.generator),
+                   ("transform", self.dataset.transform),
+                   ("batchTransform", self.batch_transform)]
+        return([(key, h) for (key, h) in holders
+                if ( isinstance(h, torch.Generator) or hasattr(h, "get_rng_state") )])
+
+
+    # Restores training state stored by 'save_checkpoint'.
+    # Returns 1 on success, 0 on error.
+    def load_checkpoint(self, ckptPath):
+        try:
+            ckpt = torch.load(ckptPath, weights_only=False)
+            if ( ckpt["labelCodes"] != self.dataset.GetLabelCodesMap() ):
+                print(f"-E- Checkpoint '{ckptPath}' was made for other HALD codes: {ckpt['labelCodes']}")
+                return(0)
+            self.model.load_state_dict(ckpt["model"])
+            self.optimizer.load_state_dict(ckpt["optimizer"])
+        except Exception as e:
+            print(f"-E- Error loading checkpoint from '{ckptPath}': {e}")
+            return(0)
+        self._epochsDone = ckpt["epochsDone"]
+        self._validationAccuracies = ckpt["validationAccuracies"]
+        rngStates = ckpt["rngStates"]
+        torch.set_rng_state(rngStates["torch"])
+        random.setstate(rngStates["python"])
+        np.random.set_state(rngStates["numpy"])
+        if ( ("cuda" in rngStates) and torch.cuda.is_available() ):
+            torch.cuda.set_rng_state_all(rngStates["cuda"])
+        for (key, holder) in self._rng_state_holders():
+            if ( key not in rngStates ):
+                continue
+            if ( isinstance(holder, torch.Generator) ):
+                holder.set_state(rngStates[key])
+            else:
+                holder.set_rng_state(rngStates[key])
+        print(f"-I- Resumed from checkpoint '{ckptPath}' after epoch {self._epochsDone}")
+        return(1)
+
+
     # Loads the model state (only) from 'inpParamsPath'.
     def load_model(self, inpParamsPath):
         # load model - weights
         try:
-            self.model.load_state_dict(torch.load(inpParamsPath))
+            stateDict = torch.load(inpParamsPath)
+            self._adapt_model_to_state_dict(stateDict)
+            self.model.load_state_dict(stateDict)
         except Exception as e:
             print(f"-E- Error loading model weights from '{inpParamsPath}': {e}")
             return(0)
@@ -210,28 +349,80 @@ class AnahaldNetBase:
 
     # Example:  haldStr = ah.predict_hald("ALL_SBS_1080/DSC_0111.TIF")
     def predict_hald(self, imgPath):
+        [(haldStr, conf)] = self.predict_halds([imgPath], batch_size=1)
+        if ( haldStr is None ):
+            return(None)  # error already printed
+        print(f"-I- Predicted HALD for '{imgPath}' is '{haldStr}' (confidence: {conf:.2f})")
+        return(haldStr)
+
+
+    # Predicts HALD-s for images given as paths or PIL images.
+    # 'pathsOrImages' can be any iterable, including a generator -
+    #   only one batch of transformed images is held at a time.
+    # Returns list of (haldStr, confidence) in the input order;
+    #   haldStr is None for unreadable images or unknown codes.
+    ## Example:  choices = ah.predict_halds(glob.glob("ALL_SBS_1080/*.TIF"), batch_size=32)
+    def predict_halds(self, pathsOrImages, batch_size=BATCH_SIZE):
+        return(list(self.iter_predict_halds(pathsOrImages, batch_size)))
+
+
+    # Generator variant of 'predict_halds' - yields (haldStr, confidence) per input
+    ## Example:  for (path, (haldStr, conf)) in zip(paths, ah.iter_predict_halds(iter(paths))):  print(path, haldStr, conf)
+    def iter_predict_halds(self, pathsOrImages, batch_size=BATCH_SIZE):
         assert(self.isValid)
         assert(self.idx2label is not None)
-        image = Image.open(imgPath).convert("RGB")
-        # Apply transforms
-        transformed_image = self.inference_transforms(image)
-        # Add a batch dimension if your model expects a batch
-        transformed_image_t = transformed_image.unsqueeze(0)
+        batch = []   # transformed images or None for failed ones
+        for pathOrImage in pathsOrImages:
+            batch.append(self._transform_for_inference(pathOrImage))
+            if ( len(batch) >= batch_size ):
+                yield from self._predict_partial_batch(batch)
+                batch = []
+        if ( len(batch) > 0 ):
+            yield from self._predict_partial_batch(batch)
+
+
+    # Returns transformed image tensor or None on error
+    def _transform_for_inference(self, pathOrImage):
+        try:
+            if ( isinstance(pathOrImage, Image.Image) ):
+                image = pathOrImage.convert("RGB")
+            else:
+                with Image.open(pathOrImage) as f:
+                    image = f.convert("RGB")
+            return(self.inference_transforms(image))
+        except Exception as e:
+            print(f"-E- Failed reading image '{pathOrImage}': {e}")
+            return(None)
 
-        # infere
-        self.model.eval()
-        with torch.no_grad():
-            output = self.model(transformed_image_t)
-            _, predicted_idx_t = torch.max(output, 1)  # decode one-hot encoding
-            predicted_idx = int(predicted_idx_t[0])
 
-        # convert index to HALD-name-suffix string
-        if ( predicted_idx not in self.idx2label ):
-            print(f"-E- Unknown HALD code '{predicted_idx}'")
-            return(None)
-        haldStr = self.idx2label[predicted_idx]
-        print(f"-I- Predicted HALD for '{imgPath}' is '{haldStr}' (code: {predicted_idx})")
-        return(haldStr)
+    # Predicts for list of tensors where some may be None (failed to read)
+    def _predict_partial_batch(self, batch):
+        goodTensors = [t for t in batch if t is not None]
+        choices = iter(self._predict_tensor_batch(torch.stack(goodTensors))
+                       if  ( len(goodTensors) > 0 )  else  [])
+        return([next(choices)  if  (t is not None)  else  (None, 0.0)
+                for t in batch])
+
+
+    # Runs the model on stacked batch of transformed images 'batchTensor'.
+    # Returns list of (haldStr, confidence) per image; haldStr is None
+    #   for unknown code; confidence is softmax probability of the choice.
+    def _predict_tensor_batch(self, batchTensor):
+        assert(self.isValid)
+        assert(self.idx2label is not None)
+        self.model.eval()
+        with torch.inference_mode():
+            output = self.run_model(batchTensor)
+            probs = torch.softmax(output.float(), dim=1)
+            confs_t, predicted_t = torch.max(probs, 1)  # decode one-hot encoding
+        results = []
+        for predicted_idx, conf in zip(predicted_t.tolist(), confs_t.tolist()):
+            if ( predicted_idx not in self.idx2label ):
+                print(f"-E- Unknown HALD code '{predicted_idx}'")
+                results.append((None, conf))
+            else:
+                results.append((self.idx2label[predicted_idx], conf))
+        return(results)
 
 
     # Makes anaglyph out of SBS image 'sbsPath' using auto-predicted HALD.
@@ -290,82 +481,16 @@ class AnahaldNetBase:
 
     # Makes anaglyph out of SBS image 'sbsPath' using HALD 'haldId'.
     # Returns path of the created anaglyph or None on error.
+    # Kept for callers of the class API; see ApplyHaldMakeAna in make_anaglyph.py
     ## Example 1:  AnahaldNetBase.apply_hald_make_ana("ALL_SBS_1080/DSC00033.TIF", "ahg_oleg_gp", ["d:/Work/RMA_WA/INP/HALD"], "TMP")
-    ## Example 2:  AnahaldNetBase.apply_hald_make_ana("ALL_SBS_1080/DSC00033.TIF", "ahg_oleg_gp", ["C:/ANY/GitWork/AnaHald/INP/HALD"], "TMP")
     @staticmethod
-    def apply_hald_make_ana(sbsPath, haldId, haldDirs, outDir,
-                      *, gamma=-1, maxWidth=-1, maxHeight=-1, isPreview=False):
-        IMC = os.getenv("IMAGEMAGICK_CONVERT_OR_MAGICK")
-        if ( IMC is None ):
-            print(f"-E- Please define environment variable 'IMAGEMAGICK_CONVERT_OR_MAGICK' with path of ImageMagick 'convert' or 'magick' utility")
-            return(None)
-        IMC_DIR = os.path.dirname(IMC).strip('"')
-        IMC_NAME = os.path.basename(IMC).strip('"')
-        os.makedirs(outDir, exist_ok=True)
-        if ( haldId != "ahg_oleg_id" ):
-            # find HALD file in provided directories
-            haldName = f"hald__{haldId}__16.TIF"
-            haldPath = None
-            for haldDir in haldDirs:
-                haldPath = f"{haldDir}/{haldName}"
-                if ( os.path.exists(haldPath) ):
-                    #print(f"-D- Found HALD '{haldPath}'")
-                    break
-                else:
-                    #print(f"-D- Not found HALD '{haldPath}'")
-                    haldPath = None
-            if ( haldPath is None ):
-                print(f"-E- Inexistent HALD file '{haldName}'; checked directories : {haldDirs}")
-                return(None)
-            haldArgs = [Path(haldPath).resolve(), "-hald-clut"]
-        else:
-            haldArgs = []
-        # build output file path
-        pureName, ext = os.path.splitext(os.path.basename(sbsPath))
-        outExt = "jpg"  if  ( isPreview or
-                              (AhConfig.MAKE_TIFF == False) )  else  "tif" 
-        outPath = f"{outDir}/{pureName}_{haldId}.{outExt}"
-        if ( gamma < 0 ):
-            gamma = AnahaldNetBase.choose_gamma_for_sample_hald(haldId)
-        # build resize specification
-        resizeSpec = ""
-        if ( (maxWidth > 0) or (maxHeight > 0) ):
-            resizeSpec = "-resize "
-            if ( maxWidth > 0 ):   resizeSpec += str(maxWidth)
-            resizeSpec += "x"
-            if ( maxHeight > 0 ):  resizeSpec += str(maxHeight)
-        cmdAsList = [IMC_NAME, Path(sbsPath).resolve(), *resizeSpec.split(), "-gamma", str(gamma)] + haldArgs +  ["-crop","50%x100%", "-swap","0,1",  "-define","compose:args=20",  "-compose","stereo", "-composite"] + AnahaldNetBase._make_im_outspec_for_outpath(outPath)
-        print(f"-I- Running command:  {' '.join([str(x) for x in cmdAsList])}")
-        try:
-            oldDir = os.getcwd()
-            if ( IMC_DIR != '' ):
-                os.chdir(IMC_DIR) # workaround for "Access is denied" on Anaconda
-            result = subprocess.run(cmdAsList,
-                                    capture_output=True, text=True, check=True)
-            isOk = True
-        except Exception as e:
-            os.chdir(oldDir)
-            print(f"Error executing command: {e}")
-            #print(f"Stderr: {e.stderr}") #stderr available in specific exception
-            return(None)
-        finally:
-            os.chdir(oldDir)
-        # success
-        return(outPath)
+    def apply_hald_make_ana(sbsPath, haldId, haldDirs, outDir, **kwargs):
+        return(ApplyHaldMakeAna(sbsPath, haldId, haldDirs, outDir, **kwargs))
 
 
+    @staticmethod
     def choose_gamma_for_sample_hald(haldId):
-        haldPrefixToGamma = {"ahg_oleg_id":1.00,
-                             "ahg_oleg_cp":1.00,
-                             "ahg_oleg_mc":1.00,
-                             "ahg_oleg_gp":1.00,
-                             "ahg_oleg_ec":0.95,
-                             "ahg_oleg_xc":0.88,
-                             "ahg_oleg_sf":0.88}
-        if ( haldId in haldPrefixToGamma ):
-            return(haldPrefixToGamma[haldId])
-        else:
-            return(1.00)
+        return(ChooseGammaForSampleHald(haldId))
 
 
     @staticmethod
@@ -374,15 +499,4 @@ class AnahaldNetBase:
         labelMapPath = lP.replace(".pth", ".csv")
         return(labelMapPath)
 
-    @staticmethod
-    # Returns list of Imagemagick file-save parameters for given output file
-    def _make_im_outspec_for_outpath(outPath):
-        ext = os.path.splitext(outPath)[1].lower()
-        outPath = Path(outPath).resolve()
-        if ( ext == ".jpg" ):
-            return(["-depth","8", "-quality","92", outPath])
-        elif ( ext == ".tif" ):
-            return(["-depth","8", "-compress","LZW", outPath])
-        else:
-            return(["-depth","8", outPath])
 #################################################################################
@@ -13,40 +13,26 @@
 # choose_hald_for_image.py
 ## Usage example:
 ##    set IMAGEMAGICK_CONVERT_OR_MAGICK=c:\ANY\Tools\ImageMagick-7.1.1-34\magick.exe  &  python c:\ANY\GitWork\AnaHald\Code\Choice\choose_hald_for_image.py  ALL_SBS_1080\DSC00022-00034.TIF  TMP
+## Batch usage example (stage workers and inference batch size are optional):
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\choose_hald_for_image.py  --decode-workers 4  --batch-size 32  --apply-workers 8  "ALL_SBS_1080\*.TIF"  TMP
+## Thin-client usage example (model stays loaded in anahald_server.py):
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\choose_hald_for_image.py  --server http://127.0.0.1:8765  "ALL_SBS_1080\*.TIF"  TMP
 
+import argparse
 import os
 import sys
 import glob
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torchvision import models, transforms, datasets
-
-
-MODEL_FILENAME = "anahald_model_params__96d5__20250814-231159.pth"
-
-
-if ( os.getenv("IMAGEMAGICK_CONVERT_OR_MAGICK") is None ):
-    print(f"-E- Please define environment variable 'IMAGEMAGICK_CONVERT_OR_MAGICK' with path of ImageMagick 'convert' or 'magick' utility")
-    input("\nPress Enter to close...")
-    sys.exit(1)
 
 
 SCRIPT_PATH = os.path.realpath(__file__)
 CHOICE_DIR  = os.path.dirname(SCRIPT_PATH)
 sys.path.append(CHOICE_DIR)
-from choose_hald_resnet import *
-
-MODEL_DIR  = os.path.join(CHOICE_DIR, "..", "..", "CHOICE_MODELS")
-MODEL_PATH = os.path.join(MODEL_DIR, MODEL_FILENAME)
-if ( not os.path.exists(MODEL_PATH) ):
-    print(f"-E- Missing model file '{MODEL_PATH}'")
-    input("\nPress Enter to close...")
-    sys.exit(1)
+from ah_cfg import *
 
-ah = LoadSavedAnahaldResnet(MODEL_PATH)
-if ( ah is None ):
-    print(f"-E- Failed loading model file '{MODEL_PATH}'")
+# ImageMagick is only needed if HALD-s aren't applied in-process
+if ( (AhConfig.HALD_ENGINE == "magick") and
+     (os.getenv("IMAGEMAGICK_CONVERT_OR_MAGICK") is None) ):
+    print(f"-E- Please define environment variable 'IMAGEMAGICK_CONVERT_OR_MAGICK' with path of ImageMagick 'convert' or 'magick' utility")
     input("\nPress Enter to close...")
     sys.exit(1)
 
@@ -60,34 +46,91 @@ for hd in HALD_DIRS:
         sys.exit(1)
 #################################################################################
 
-if ( len(sys.argv) < 2 ):
+parser = argparse.ArgumentParser(
+    usage="python choose_hald_for_image.py [options] INPUT-SBS-IMAGE-GLOB-1 ... INPUT-SBS-IMAGE-GLOB-n  [OUTPUT-DIRECTORY]")
+parser.add_argument("paths", nargs="*")
+parser.add_argument("--decode-workers", type=int, default=None,
+                    help="threads decoding input images")
+parser.add_argument("--batch-size", type=int, default=None,
+                    help="images per network inference batch")
+parser.add_argument("--apply-workers", type=int, default=None,
+                    help="threads applying HALD-s and writing anaglyphs")
+parser.add_argument("--server", default=AhConfig.MODEL_SERVER_URL,
+                    help="URL of running anahald_server.py; model isn't loaded locally")
+args = parser.parse_args()
+
+if ( len(args.paths) < 1 ):
     print("\n-E- Usage:  python choose_hald_for_image.py INPUT-SBS-IMAGE-GLOB-1 ... INPUT-SBS-IMAGE-GLOB-n  [OUTPUT-DIRECTORY]")
     input("\nPress Enter to close...")
     sys.exit(1)
 
-inpPath1 = sys.argv[1]
+inpPath1 = args.paths[0]
 inpDir = os.path.dirname(inpPath1)
 
 # decide on output directory - either given or ANA/ under input directory
-if ( (len(sys.argv) >= 3) and
-     (os.path.isdir(sys.argv[-1]) or (not os.path.exists(sys.argv[-1]))) ):
-    outDir = sys.argv[-1]
-    inpPatterns = sys.argv[1:-1]
+if ( (len(args.paths) >= 2) and
+     (os.path.isdir(args.paths[-1]) or (not os.path.exists(args.paths[-1]))) ):
+    outDir = args.paths[-1]
+    inpPatterns = args.paths[:-1]
 else:
     outDir = os.path.join(inpDir, "ANA")
-    inpPatterns = sys.argv[1:]
+    inpPatterns = args.paths
 os.makedirs(outDir, exist_ok=True)
 
 print(f"-I- Run configuration:  HALD directories = '{HALD_DIRS}', output directory = '{outDir}'")
 
 # Perform HALD choice(s) and conversion(s)
-errCnt = 0
+inpPaths = []
 for pattern in inpPatterns:
-    inpPaths = glob.glob(pattern)
-    for inpPath in inpPaths:
-        res = ah.choose_hald_make_ana(inpPath, HALD_DIRS, outDir)
+    inpPaths.extend(glob.glob(pattern))
+if ( args.server != "" ):
+    from anahald_client import *
+    client = AnahaldClient(args.server)
+    if ( not client.is_alive() ):
+        print(f"-E- Anahald server at '{args.server}' doesn't respond")
+        input("\nPress Enter to close...")
+        sys.exit(1)
+    # send in chunks, so that progress is visible and server batches them
+    errCnt = 0
+    chunkSize = args.batch_size or CLIENT_CHUNK_SIZE
+    for i in range(0, len(inpPaths), chunkSize):
+        chunk = inpPaths[i : i + chunkSize]
+        res = client.choose_halds_make_ana(chunk, HALD_DIRS, outDir)
         if ( res is None ):
-            errCnt += 1
+            errCnt += len(chunk)
+            continue
+        for (p, (haldId, conf, anaPath)) in zip(chunk, res):
+            if ( anaPath is None ):
+                errCnt += 1
+            else:
+                print(f"-I- '{p}' => HALD '{haldId}' (confidence {conf:.2f}) => '{anaPath}'")
+else:
+    from anahald_runtime import *
+    from batch_pipeline import *
+
+    # exported model (see ExportAnahaldResnet) loads without training code
+    exportedPath = FindExportedModel(AhConfig.MODEL_PATH)
+    if ( exportedPath is not None ):
+        ah = AnahaldRuntime(exportedPath)
+        if ( not ah.isValid ):
+            ah = None
+    else:
+        if ( not os.path.exists(AhConfig.MODEL_PATH) ):
+            print(f"-E- Missing model file '{AhConfig.MODEL_PATH}'")
+            input("\nPress Enter to close...")
+            sys.exit(1)
+        from choose_hald_resnet import *
+        ah = LoadSavedAnahaldResnet(AhConfig.MODEL_PATH)
+    if ( ah is None ):
+        print(f"-E- Failed loading model file '{exportedPath or AhConfig.MODEL_PATH}'")
+        input("\nPress Enter to close...")
+        sys.exit(1)
+    pipeline = AnahaldBatchPipeline(ah, HALD_DIRS, outDir,
+                                    decodeWorkers=args.decode_workers or DECODE_WORKERS,
+                                    batchSize=args.batch_size or INFER_BATCH_SIZE,
+                                    applyWorkers=args.apply_workers or APPLY_WORKERS)
+    results = pipeline.run(inpPaths)
+    errCnt = sum(1 for res in results.values() if res is None)
 
 input("\nPress Enter to close...")
 sys.exit(errCnt)
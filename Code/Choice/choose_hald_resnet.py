@@ -13,14 +13,22 @@
 # choose_hald_resnet.py
 
 from datetime import datetime
+import copy
+import hashlib
+import json
+import time
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torchvision import models, transforms, datasets
+import torchvision.models.quantization as quantized_models
 
+import choose_hald_base         # need SUFFICIENT_ACCURACY_TO_STOP to override
 from choose_hald_base import *
 from AnahaldDataset import *
 from search_ana import *
+from anahald_runtime import *   # need ExportedModelPaths, RUNTIME_META_NAME
 
 
 ################## HOW TO LOAD THE CODE #########################################
@@ -39,57 +47,599 @@ from search_ana import *
 #################################################################################
 
 
+HEAD_NUM_EPOCHS = 300       # full-batch epochs of head-only training
+HEAD_LEARNING_RATE = 1e-3
+FEATURES_FILE_PREFIX = "anahald_features"
+FILE_HASH_INDEX_NAME = "anahald_file_hashes.csv"  # (path, mtime, size) => hash
+QUANTIZED_SUFFIX = "_int8.pt"      # int8 TorchScript model next to .pth
+CALIBRATION_NUM_IMAGES = 200
+
+
 #################################################################################
 class AnahaldResnet(AnahaldNetBase):
-    def __init__(self, csv_or_pth_file, sbs_dir_or_dummy, out_dir=""):
-        super().__init__(csv_or_pth_file, sbs_dir_or_dummy, out_dir)
+    def __init__(self, csv_or_pth_file, sbs_dir_or_dummy, out_dir="",
+                 precision=PRECISION_FP32, **loaderOptions):
+        super().__init__(csv_or_pth_file, sbs_dir_or_dummy, out_dir,
+                         precision, **loaderOptions)
 
 
     def _prepare_model(self, isTrainRequest):
         self.model = models.resnet18(weights=None) #Or resnet34, resnet50,...
         # Change the fc layer to match the number of classes in the dataset
         num_classes = NUM_HALDS
-        self.model.fc = nn.Linear(self.model.fc.in_features, num_classes)
+        self.numFeatures = self.model.fc.in_features
+        self.model.fc = AnahaldResnet.make_head(self.numFeatures, num_classes)
         if ( isTrainRequest ):
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             device = "cpu"
         self.model = self.model.to(device)
+        if ( self.precision == PRECISION_BF16 ):  # weights stay float32
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+
+    # Returns classifier head - single linear layer if 'hidden'=0, otherwise MLP
+    @staticmethod
+    def make_head(numFeatures, numClasses, hidden=0):
+        if ( hidden == 0 ):
+            return(nn.Linear(numFeatures, numClasses))
+        return(nn.Sequential(nn.Linear(numFeatures, hidden), nn.ReLU(),
+                             nn.Linear(hidden, numClasses)))
+
+
+    # Rebuilds 'fc' as stored - retrained head may be MLP or have other #classes
+    def _adapt_model_to_state_dict(self, stateDict):
+        if ( "fc.weight" in stateDict ):
+            self.model.fc = AnahaldResnet.make_head(self.numFeatures,
+                                                    stateDict["fc.weight"].shape[0])
+        else:
+            self.model.fc = AnahaldResnet.make_head(self.numFeatures,
+                                                    stateDict["fc.2.weight"].shape[0],
+                                                    stateDict["fc.0.weight"].shape[0])
+
+
+    # Returns short digest of backbone (all but 'fc') parameters;
+    #   cached features are only valid for the same backbone
+    def backbone_id(self):
+        h = hashlib.sha1()
+        for (name, tensor) in self.model.state_dict().items():
+            if ( not name.startswith("fc.") ):
+                h.update(name.encode("utf-8"))
+                h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        return(h.hexdigest()[:12])
+
+
+    # Returns tag of precision and memory format the features are computed in
+    #   (as by run_model()); features of different variants are not identical
+    def feature_variant(self):
+        memFormat = "cl"  if  ( self.precision == PRECISION_BF16 )  else  "nchw"
+        return(f"{self.precision}_{memFormat}")
+
+
+    # Returns float32 [N, numFeatures] pooled backbone outputs for image paths
+    #   or None on error; images are transformed as for inference - no augmentation
+    def compute_features(self, imgPaths, batch_size=BATCH_SIZE):
+        device = next(self.model.parameters()).device
+        head = self.model.fc
+        self.model.fc = nn.Identity()
+        self.model.eval()
+        feats = []
+        try:
+            with torch.inference_mode():
+                for i in range(0, len(imgPaths), batch_size):
+                    batch = [self._transform_for_inference(p)
+                             for p in imgPaths[i : i + batch_size]]
+                    if ( any(t is None for t in batch) ):
+                        return(None)  # error already printed
+                    feats.append(self.run_model(torch.stack(batch).to(device)).cpu())
+        finally:
+            self.model.fc = head
+        return(torch.cat(feats).numpy().astype(np.float32)  if  ( len(feats) > 0 )
+               else  np.zeros((0, self.numFeatures), dtype=np.float32))
+
+
+    # Returns (features [N, numFeatures], labelStrings) for images in 'csv_file';
+    #   features are taken from the cache under 'cache_dir' when the image
+    #   content, the backbone, precision and memory format match,
+    #   computed and stored otherwise.
+    # Image content is identified by hash, recomputed only for files whose
+    #   size or modification time changed (see CachedFileContentHashes).
+    # Returns (None, None) on error.
+    def features_for_dataset(self, csv_file, sbs_dir, cache_dir, sbs_ext=SBS_EXT):
+        try:
+            annotations = pd.read_csv(csv_file)
+        except Exception as e:
+            print(f"-E- Error reading CSV from '{csv_file}': {e.__str__()}")
+            return(None, None)
+        imgPaths = [os.path.join(sbs_dir, f"{name}.{sbs_ext}")
+                    for name in annotations.iloc[:, 0]]
+        try:
+            hashes = CachedFileContentHashes(imgPaths,
+                                os.path.join(cache_dir, FILE_HASH_INDEX_NAME))
+        except OSError as e:
+            print(f"-E- Error reading image: {e}")
+            return(None, None)
+        cachePath = os.path.join(cache_dir,
+                         f"{FEATURES_FILE_PREFIX}__{self.backbone_id()}__{self.feature_variant()}.npz")
+        cache = LoadFeatureCache(cachePath)
+        missing = [i for (i, h) in enumerate(hashes) if h not in cache]
+        if ( len(missing) > 0 ):
+            print(f"-I- Computing backbone features for {len(missing)} of {len(hashes)} image(s)")
+            newFeats = self.compute_features([imgPaths[i] for i in missing])
+            if ( newFeats is None ):
+                return(None, None)
+            for (i, f) in zip(missing, newFeats):
+                cache[hashes[i]] = f
+            if ( not StoreFeatureCache(cachePath, cache) ):
+                return(None, None)
+        else:
+            print(f"-I- All {len(hashes)} feature vector(s) found in '{cachePath}'")
+        feats = np.stack([cache[h] for h in hashes])  if  ( len(hashes) > 0 )  \
+                else  np.zeros((0, self.numFeatures), dtype=np.float32)
+        return(feats, list(annotations.iloc[:, 1]))
+
+
+    # Trains only the classifier head on cached backbone features;
+    #   the backbone stays frozen. 'hidden' > 0 makes MLP head.
+    # Label codes are assigned as in AnahaldDataset; train/validation split
+    #   is the same as in MakeAnahaldDataloaders.
+    # Returns validation accuracy or -1 on error.
+    def train_head(self, csv_file, sbs_dir, cache_dir,
+                   num_epochs=HEAD_NUM_EPOCHS, hidden=0):
+        (feats, labelStrs) = self.features_for_dataset(csv_file, sbs_dir,
+                                                       cache_dir)
+        if ( feats is None ):
+            return(-1)  # error already printed
+        idx2label = {idx: label  for idx, label in enumerate(sorted(set(labelStrs)))}
+        label2idx = {label: idx  for idx, label in idx2label.items()}
+        x = torch.from_numpy(feats)
+        y = torch.tensor([label2idx[l] for l in labelStrs])
+        train_size = int(0.8 * len(y))
+        generator = torch.Generator().manual_seed(SPLIT_SEED)
+        (trnSubset, valSubset) = torch.utils.data.random_split(
+                        range(len(y)), [train_size, len(y) - train_size],
+                        generator=generator)
+        (trnIdx, valIdx) = (list(trnSubset), list(valSubset))
+
+        head = AnahaldResnet.make_head(self.numFeatures, len(idx2label), hidden)
+        optimizer = torch.optim.Adam(head.parameters(), lr=HEAD_LEARNING_RATE,
+                                     weight_decay=1e-4)
+        criterion = nn.CrossEntropyLoss()
+        val_accuracy = 0.0
+        for epoch in range(num_epochs):
+            head.train()
+            optimizer.zero_grad()
+            loss = criterion(head(x[trnIdx]), y[trnIdx])
+            loss.backward()
+            optimizer.step()
+            if ( ((epoch + 1) % 50 == 0) or (epoch + 1 == num_epochs) ):
+                head.eval()
+                with torch.no_grad():
+                    if ( len(valIdx) > 0 ):
+                        predicted = torch.argmax(head(x[valIdx]), 1)
+                        val_accuracy = 100 * (predicted == y[valIdx]).float().mean().item()
+                print(f"-I- Head epoch [{epoch+1}/{num_epochs}]>  Loss: {loss.item():.4f}  "
+                      f"Valid-Accuracy: {val_accuracy:.2f}%")
+
+        device = next(self.model.parameters()).device
+        self.model.fc = head.to(device)
+        self.idx2label = idx2label
+        self._validationAccuracies.append(val_accuracy)
+        return(val_accuracy)
 #################################################################################
 
 
 
 ## Example 1: ah = TrainAnahaldResnet('sbs_to_hald.csv', 'ALL_SBS_1080', num_epochs=3)
 ## Example 2: ah = TrainAnahaldResnet('sbs_to_hald__aug.csv', 'AUG_SBS_1080', num_epochs=3)
-def TrainAnahaldResnet(csv_file, sbs_dir, num_epochs=NUM_EPOCHS):
+## Example 3: ah = TrainAnahaldResnet('sbs_to_hald.csv', 'ALL_SBS_1080', num_epochs=30, cache_dir='SBS_CACHE')
+## Example 4: ah = TrainAnahaldResnet('sbs_to_hald.csv', 'ALL_SBS_1080', num_epochs=30, cache_dir='SBS_CACHE', num_workers=8)
+## Example 5: ah = TrainAnahaldResnet('sbs_to_hald.csv', 'ALL_SBS_1080', num_epochs=100, checkpoint_dir='CKPT')
+## Example 6: ah = TrainAnahaldResnet('sbs_to_hald.csv', 'ALL_SBS_1080', num_epochs=100, resume_from='CKPT/anahald_checkpoint.pt')
+# 'num_epochs' is the total, including epochs done before 'resume_from' checkpoint;
+#   checkpoints go to 'checkpoint_dir' - by default where resumed from.
+# 'loaderOptions' are passed to MakeAnahaldDataloaders
+def TrainAnahaldResnet(csv_file, sbs_dir, num_epochs=NUM_EPOCHS,
+                       checkpoint_dir="", resume_from="",
+                       precision=PRECISION_FP32, **loaderOptions):
     # CSV path required - net is to be trained
     extension = (os.path.splitext(csv_file)[1]).lower()
     if ( extension != ".csv" ):
         print(f"-E- Provided input file is {extension} instead of .csv; aborting")
         return(None)
-    ahResNet = AnahaldResnet(csv_file, sbs_dir, "MODELS")
+    ahResNet = AnahaldResnet(csv_file, sbs_dir, "MODELS", precision,
+                             **loaderOptions)
     if ( not ahResNet.isValid ):
         print("-E- Obtained ResNet is invalid; aborting")
         return(None)
-    avg_loss_per_batch = ahResNet.train_model(num_epochs)
+    if ( resume_from != "" ):
+        if ( not ahResNet.load_checkpoint(resume_from) ):
+            return(None)  # error already printed
+        if ( checkpoint_dir == "" ):
+            checkpoint_dir = os.path.dirname(resume_from) or "."
+    avg_loss_per_batch = ahResNet.train_model(num_epochs, checkpoint_dir)
     print(f"-I- Training for {num_epochs} epoch(s) is finished; ultimate loss per batch: {avg_loss_per_batch}")
     
     ahResNet.validate_model()
     return(ahResNet)
         
 
+# Checks that training resumed from checkpoint ends with the same weights
+#   as uninterrupted training: 'num_epochs' straight vs. half of them,
+#   checkpoint, load into a new net, the rest. Early stop is disabled meanwhile.
+# Use few images - trains three times. Checkpoint goes to 'tmp_dir'.
+## Example: DEBUG__TestCheckpointResume('sbs_to_hald__small.csv', 'ALL_SBS_1080', 'TMP')
+def DEBUG__TestCheckpointResume(csv_file, sbs_dir, tmp_dir, num_epochs=4,
+                                **loaderOptions):
+    def _seed_all(seed):
+        torch.manual_seed(seed);  random.seed(seed);  np.random.seed(seed)
+    oldStopAccuracy = choose_hald_base.SUFFICIENT_ACCURACY_TO_STOP
+    choose_hald_base.SUFFICIENT_ACCURACY_TO_STOP = 101.0  # never reached
+    try:
+        _seed_all(SPLIT_SEED)
+        ahStraight = TrainAnahaldResnet(csv_file, sbs_dir, num_epochs,
+                                        **loaderOptions)
+        _seed_all(SPLIT_SEED)
+        ahFirst = TrainAnahaldResnet(csv_file, sbs_dir, num_epochs // 2,
+                                     checkpoint_dir=tmp_dir, **loaderOptions)
+        _seed_all(SPLIT_SEED + 100)  # resumed run must not depend on it
+        ahResumed = TrainAnahaldResnet(csv_file, sbs_dir, num_epochs,
+                     resume_from=os.path.join(tmp_dir, CHECKPOINT_FILENAME),
+                     **loaderOptions)
+    finally:
+        choose_hald_base.SUFFICIENT_ACCURACY_TO_STOP = oldStopAccuracy
+    if ( None in (ahStraight, ahFirst, ahResumed) ):
+        return(0)  # error already printed
+    straightState = ahStraight.model.state_dict()
+    diffNames = [name for (name, t) in ahResumed.model.state_dict().items()
+                 if not torch.equal(t, straightState[name])]
+    if ( len(diffNames) > 0 ):
+        print(f"-E- Resumed training differs from uninterrupted one in {len(diffNames)} tensor(s), e.g. '{diffNames[0]}'")
+        return(0)
+    print(f"-I- Success testing checkpoint resume after {num_epochs // 2} of {num_epochs} epoch(s)")
+    return(1)
+
+
+## Example 1: ah = TrainAnahaldHead("MODELS/anahald_model_params__96d5__20250814-231159.pth", 'sbs_to_hald.csv', 'ALL_SBS_1080', 'FEATURE_CACHE')
+## Example 2: ah = TrainAnahaldHead("MODELS/anahald_model_params__96d5__20250814-231159.pth", 'sbs_to_hald.csv', 'ALL_SBS_1080', 'FEATURE_CACHE', hidden=128)
+# Retrains only the classifier head of saved model on (new) labels;
+#   saves the resulting model in 'out_dir' unless it's empty
+def TrainAnahaldHead(pth_file, csv_file, sbs_dir, cache_dir,
+                     num_epochs=HEAD_NUM_EPOCHS, hidden=0, out_dir="MODELS"):
+    ahResNet = LoadSavedAnahaldResnet(pth_file)
+    if ( ahResNet is None ):
+        return(None)  # error already printed
+    val_accuracy = ahResNet.train_head(csv_file, sbs_dir, cache_dir,
+                                       num_epochs, hidden)
+    if ( val_accuracy < 0 ):
+        print("-E- Head training failed; aborting")
+        return(None)
+    print(f"-I- Head training for {num_epochs} epoch(s) is finished; validation accuracy: {val_accuracy:.2f}%")
+    if ( out_dir != "" ):
+        ahResNet.save_model(out_dir)
+    return(ahResNet)
+
+
+# Returns hex SHA-1 of file content - identifies image regardless of its name
+def FileContentHash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return(h.hexdigest())
+
+
+# Returns content hashes of files in 'paths'. Hashes of files with the same
+#   size and modification time as recorded in 'indexPath' CSV are reused;
+#   only new/changed files are read, and the index is updated for them.
+# Raises OSError if a file cannot be read.
+def CachedFileContentHashes(paths, indexPath):
+    index = {}   # absPath => (mtimeNs, size, hash)
+    if ( os.path.exists(indexPath) ):
+        try:
+            indexDF = pd.read_csv(indexPath, dtype={"hash": str})
+            index = {p: (int(t), int(z), h) for (p, t, z, h) in zip(
+                        indexDF["path"], indexDF["mtime_ns"], indexDF["size"],
+                        indexDF["hash"])}
+        except Exception as e:
+            print(f"-W- Ignoring unreadable file-hash index '{indexPath}': {e}")
+    hashes = []
+    numRehashed = 0
+    for path in paths:
+        absPath = os.path.abspath(path)
+        st = os.stat(absPath)
+        rec = index.get(absPath)
+        if ( (rec is None) or (rec[:2] != (st.st_mtime_ns, st.st_size)) ):
+            rec = index[absPath] = (st.st_mtime_ns, st.st_size,
+                                    FileContentHash(absPath))
+            numRehashed += 1
+        hashes.append(rec[2])
+    if ( numRehashed > 0 ):
+        print(f"-I- Hashed {numRehashed} new or changed file(s) of {len(paths)}")
+        tmpPath = indexPath + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(indexPath)), exist_ok=True)
+            pd.DataFrame([(p,) + rec for (p, rec) in index.items()],
+                         columns=["path", "mtime_ns", "size", "hash"]
+                         ).to_csv(tmpPath, index=False)
+            os.replace(tmpPath, indexPath)
+        except Exception as e:  # only costs rehashing next time
+            print(f"-W- Failed storing file-hash index '{indexPath}': {e}")
+    return(hashes)
+
+
+# Returns {contentHash :: featureVector} from 'cachePath' or {} if missing
+def LoadFeatureCache(cachePath):
+    if ( not os.path.exists(cachePath) ):
+        return({})
+    try:
+        with np.load(cachePath) as data:
+            return({h: f for (h, f) in zip(data["hashes"], data["features"])})
+    except Exception as e:
+        print(f"-W- Ignoring unreadable feature cache '{cachePath}': {e}")
+        return({})
+
+
+# Stores {contentHash :: featureVector} in 'cachePath'; returns 1 on success, 0 on error
+def StoreFeatureCache(cachePath, cache):
+    tmpPath = cachePath + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cachePath)), exist_ok=True)
+        with open(tmpPath, "wb") as f:
+            np.savez(f, hashes=np.array(list(cache.keys())),
+                     features=np.stack(list(cache.values())))
+        os.replace(tmpPath, cachePath)
+    except Exception as e:
+        print(f"-E- Failed storing feature cache '{cachePath}': {e}")
+        return(0)
+    print(f"-I- Stored {len(cache)} feature vector(s) in '{cachePath}'")
+    return(1)
+
+
 ## Example: ah = LoadSavedAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth")
-def LoadSavedAnahaldResnet(pth_file):
+# If 'quantized', loads int8 model made by QuantizeAnahaldResnet when present
+def LoadSavedAnahaldResnet(pth_file, precision=PRECISION_FP32, quantized=False):
     # PTH path required - parameters are to be loaded
     extension = (os.path.splitext(pth_file)[1]).lower()
     if ( extension != ".pth" ):
         print(f"-E- Provided input file is {extension} instead of .pth; aborting")
         return(None)
-    ahResNet = AnahaldResnet(pth_file, "DUMMY_DIR", "MODELS")
+    ahResNet = AnahaldResnet(pth_file, "DUMMY_DIR", "MODELS", precision)
     if ( not ahResNet.isValid ):
         print("-E- Obtained ResNet is invalid; aborting")
         return(None)
-    if ( ahResNet.load_model(pth_file) ):
-        return(ahResNet)
-    else:
+    if ( not ahResNet.load_model(pth_file) ):
         return(None)  # error already printed
+    qPath = QuantizedModelPath(pth_file)
+    if ( quantized and (not os.path.exists(qPath)) ):
+        print(f"-W- No int8 model '{qPath}'; using float model")
+    elif ( quantized ):
+        try:
+            _choose_quantized_engine()
+            ahResNet.model = torch.jit.load(qPath, map_location="cpu")
+            ahResNet.precision = PRECISION_FP32  # int8 model takes float input
+        except Exception as e:
+            print(f"-E- Failed loading int8 model '{qPath}': {e}")
+            return(None)
+        print(f"-I- Loaded int8 model '{qPath}'")
+    return(ahResNet)
+
+
+
+# Exports saved model for inference by AnahaldRuntime (anahald_runtime.py)
+#   together with label codes and preprocessing constants.
+# 'fmt' is "torchscript" or "onnx" (needs 'onnx' package); the artifact is
+#   written next to 'pth_file' - see ExportedModelPaths().
+# Returns path of the artifact or None on error.
+## Example: ExportAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth")
+def ExportAnahaldResnet(pth_file, fmt="torchscript"):
+    ah = LoadSavedAnahaldResnet(pth_file)
+    if ( ah is None ):
+        return(None)  # error already printed
+    ah.model.eval()
+    meta = json.dumps({"labelCodes": {str(k): v for (k, v) in ah.idx2label.items()},
+                       "sbsHeight": SBS_HEIGHT, "sbsWidth": SBS_WIDTH,
+                       "normalizeMean": NORMALIZE_MEAN, "normalizeStd": NORMALIZE_STD,
+                       "sourceModel": os.path.basename(pth_file)})
+    example = torch.zeros(1, 3, SBS_HEIGHT, SBS_WIDTH)
+    (scriptPath, onnxPath) = ExportedModelPaths(pth_file)
+    try:
+        if ( fmt == "torchscript" ):
+            outPath = scriptPath
+            with torch.inference_mode():
+                traced = torch.jit.trace(ah.model, example)
+            torch.jit.save(traced, outPath, _extra_files={RUNTIME_META_NAME: meta})
+        elif ( fmt == "onnx" ):
+            import onnx
+            outPath = onnxPath
+            torch.onnx.export(ah.model, example, outPath,
+                              input_names=["sbs"], output_names=["logits"],
+                              dynamic_axes={"sbs": {0: "batch"},
+                                            "logits": {0: "batch"}})
+            onnxModel = onnx.load(outPath)
+            entry = onnxModel.metadata_props.add()
+            entry.key = RUNTIME_META_NAME
+            entry.value = meta
+            onnx.save(onnxModel, outPath)
+        else:
+            print(f"-E- Unknown export format '{fmt}'; should be 'torchscript' or 'onnx'")
+            return(None)
+    except Exception as e:
+        print(f"-E- Failed exporting '{pth_file}' as {fmt}: {e}")
+        return(None)
+    print(f"-I- Exported model '{pth_file}' into '{outPath}'")
+    return(outPath)
+
+
+# Compares predictions of saved model in float32 and in bfloat16/channels_last
+#   on the validation split of 'csv_file' (same split as in training);
+#   images are transformed as for inference.
+# Returns {"fp32Accuracy", "bf16Accuracy", "agreement", "maxProbDiff"} or None on error.
+## Example: CheckPrecisionParity("MODELS/anahald_model_params__96d5__20250814-231159.pth", 'sbs_to_hald.csv', 'ALL_SBS_1080')
+def CheckPrecisionParity(pth_file, csv_file, sbs_dir):
+    nets = [LoadSavedAnahaldResnet(pth_file, precision)
+              for precision in (PRECISION_FP32, PRECISION_BF16)]
+    if ( None in nets ):
+        return(None)  # error already printed
+    return(CompareNetsOnValidation(nets, (PRECISION_FP32, PRECISION_BF16),
+                                   csv_file, sbs_dir))
+
+
+# Runs two loaded nets with the same label codes on the validation split
+#   of 'csv_file' (same split as in training); images are transformed as for inference.
+# Returns {"<name1>Accuracy", "<name2>Accuracy", "agreement", "maxProbDiff"}
+#   or None on error.
+def CompareNetsOnValidation(nets, names, csv_file, sbs_dir):
+    dataset = AnahaldDataset(csv_file, sbs_dir, SBS_EXT,
+                             transform=nets[0].inference_transforms)
+    if ( not dataset.is_valid ):
+        return(None)  # error already printed
+    label2idx = {label: idx  for idx, label in nets[0].idx2label.items()}
+    (_trnSet, valSet) = _split_like_training(dataset)
+    correct = [0, 0];  agree = 0;  total = 0;  maxProbDiff = 0.0
+    for m in nets:
+        m.model.eval()
+    with torch.inference_mode():
+        for (images, labels, filenames) in DataLoader(valSet, batch_size=BATCH_SIZE):
+            truth = torch.tensor([label2idx.get(dataset.idx2label[int(l)], -1)
+                                  for l in labels])
+            probs = [torch.softmax(m.run_model(images), dim=1) for m in nets]
+            preds = [torch.argmax(p, 1) for p in probs]
+            for i in range(2):
+                correct[i] += (preds[i] == truth).sum().item()
+            agree += (preds[0] == preds[1]).sum().item()
+            maxProbDiff = max(maxProbDiff, (probs[0] - probs[1]).abs().max().item())
+            total += len(labels)
+    if ( total == 0 ):
+        print(f"-E- Empty validation split in '{csv_file}'")
+        return(None)
+    res = {f"{names[0]}Accuracy": 100 * correct[0] / total,
+           f"{names[1]}Accuracy": 100 * correct[1] / total,
+           "agreement":    100 * agree / total,  "maxProbDiff": maxProbDiff}
+    print(f"-I- Comparison on {total} validation image(s):  "
+          f"{names[0].upper()}-Accuracy: {res[names[0] + 'Accuracy']:.2f}%  "
+          f"{names[1].upper()}-Accuracy: {res[names[1] + 'Accuracy']:.2f}%  "
+          f"Agreement: {res['agreement']:.2f}%  Max-Prob-Diff: {maxProbDiff:.4f}")
+    return(res)
+
+
+# Returns (trainSubset, validationSubset) split as by MakeAnahaldDataloaders
+def _split_like_training(dataset):
+    train_size = int(0.8 * len(dataset))
+    return(torch.utils.data.random_split(dataset,
+                            [train_size, len(dataset) - train_size],
+                            generator=torch.Generator().manual_seed(SPLIT_SEED)))
+
+
+# Returns path of int8 model made by QuantizeAnahaldResnet for 'pth_file'
+def QuantizedModelPath(pth_file):
+    return(os.path.splitext(pth_file)[0] + QUANTIZED_SUFFIX)
+
+
+# Picks quantized-kernel backend available on this CPU
+def _choose_quantized_engine():
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if ( engine in torch.backends.quantized.supported_engines ):
+            torch.backends.quantized.engine = engine
+            return(engine)
+    return(None)
+
+
+# Post-training static int8 quantization of saved model:
+#   conv-bn-relu fused, activation ranges calibrated on up to 'num_calib_images'
+#   of the training split of 'csv_file'. Saves TorchScript int8 model
+#   next to 'pth_file' (see QuantizedModelPath) and reports top-1 agreement
+#   with the float model on the validation split.
+# Returns path of int8 model or None on error.
+## Example: QuantizeAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth", 'sbs_to_hald.csv', 'ALL_SBS_1080')
+def QuantizeAnahaldResnet(pth_file, csv_file, sbs_dir,
+                          num_calib_images=CALIBRATION_NUM_IMAGES):
+    ah = LoadSavedAnahaldResnet(pth_file)
+    if ( ah is None ):
+        return(None)  # error already printed
+    engine = _choose_quantized_engine()
+    if ( engine is None ):
+        print(f"-E- No quantized-kernel engine available in this torch build")
+        return(None)
+    # the float model must stay usable - probe it before and after
+    probe = torch.zeros(1, 3, SBS_HEIGHT, SBS_WIDTH)
+    ah.model.eval()
+    with torch.inference_mode():
+        floatOut = ah.model(probe)
+    qModel = quantized_models.resnet18(weights=None, quantize=False)
+    # own copy - prepare/convert modify the head in place
+    qModel.fc = copy.deepcopy(ah.model.fc)  # Linear or MLP, as trained
+    qModel.load_state_dict(ah.model.state_dict())
+    qModel.eval()
+    qModel.fuse_model(is_qat=False)
+    qModel.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(qModel, inplace=True)
+
+    dataset = AnahaldDataset(csv_file, sbs_dir, SBS_EXT,
+                             transform=ah.inference_transforms)
+    if ( not dataset.is_valid ):
+        return(None)  # error already printed
+    (trnSet, _valSet) = _split_like_training(dataset)
+    calibSet = torch.utils.data.Subset(trnSet,
+                                 range(min(num_calib_images, len(trnSet))))
+    print(f"-I- Calibrating int8 model ({engine}) on {len(calibSet)} image(s)")
+    with torch.inference_mode():
+        for (images, labels, filenames) in DataLoader(calibSet, batch_size=BATCH_SIZE):
+            qModel(images)
+    torch.ao.quantization.convert(qModel, inplace=True)
+    try:
+        with torch.inference_mode():
+            isIntact = torch.equal(ah.model(probe), floatOut)
+    except Exception as e:
+        isIntact = False
+        print(f"-E- Float model fails after quantization: {e}")
+    if ( not isIntact ):
+        print(f"-E- Quantization altered the float model of '{pth_file}'")
+        return(None)
+
+    outPath = QuantizedModelPath(pth_file)
+    try:
+        with torch.inference_mode():
+            scripted = torch.jit.trace(qModel, probe)
+        torch.jit.save(scripted, outPath)
+    except Exception as e:
+        print(f"-E- Failed saving int8 model '{outPath}': {e}")
+        return(None)
+    print(f"-I- Saved int8 model in '{outPath}'")
+
+    qAh = LoadSavedAnahaldResnet(pth_file, quantized=True)
+    if ( qAh is not None ):
+        CompareNetsOnValidation([ah, qAh], ("fp32", "int8"), csv_file, sbs_dir)
+    return(outPath)
+
+
+# Measures images/second of inference and of training steps
+#   in each precision on random SBS-sized batches.
+# Returns {precision: (inferImgsPerSec, trainImgsPerSec)}
+## Example: BenchmarkAnahaldResnet(batch_size=32, num_batches=5)
+def BenchmarkAnahaldResnet(batch_size=BATCH_SIZE, num_batches=5):
+    results = {}
+    images = torch.randn(batch_size, 3, SBS_HEIGHT, SBS_WIDTH)
+    labels = torch.randint(0, NUM_HALDS, (batch_size,))
+    for precision in (PRECISION_FP32, PRECISION_BF16):
+        ah = AnahaldResnet("DUMMY.pth", "DUMMY_DIR", "", precision)
+        ah.model.to("cpu")
+        optimizer = torch.optim.Adam(ah.model.parameters(), lr=1e-4)
+        criterion = nn.CrossEntropyLoss()
+        ah.model.eval()
+        with torch.inference_mode():
+            ah.run_model(images)      # warm-up
+            start = time.perf_counter()
+            for _ in range(num_batches):
+                ah.run_model(images)
+            inferRate = batch_size * num_batches / (time.perf_counter() - start)
+        ah.model.train()
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            optimizer.zero_grad()
+            criterion(ah.run_model(images), labels).backward()
+            optimizer.step()
+        trainRate = batch_size * num_batches / (time.perf_counter() - start)
+        results[precision] = (inferRate, trainRate)
+        print(f"-I- Benchmark {precision}>  Inference: {inferRate:.1f} img/s  Training: {trainRate:.1f} img/s")
+    return(results)
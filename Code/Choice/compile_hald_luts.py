@@ -0,0 +1,49 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# compile_hald_luts.py - converts HALD TIFF-s into memory-mappable compiled LUT-s
+## Usage example:
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\compile_hald_luts.py
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\compile_hald_luts.py  --dtype float16  --force  INP\HALD  INP\HALD\ADD
+
+import argparse
+import os
+import sys
+
+
+SCRIPT_PATH = os.path.realpath(__file__)
+CHOICE_DIR  = os.path.dirname(SCRIPT_PATH)
+sys.path.append(CHOICE_DIR)
+from hald_lut import *
+
+HALD_ROOTDIR = os.path.join(CHOICE_DIR, "..", "..", "SAMPLE_HALDS")
+HALD_DIRS = [HALD_ROOTDIR, os.path.join(HALD_ROOTDIR, "ADD")]
+#################################################################################
+
+parser = argparse.ArgumentParser(
+    description="Builds 'hald__*__16.npy' compiled LUT-s beside HALD TIFF-s")
+parser.add_argument("haldDirs", nargs="*", default=HALD_DIRS,
+                    help="HALD directories; default - the sample-HALD ones")
+parser.add_argument("--dtype", choices=COMPILED_LUT_DTYPES, default="uint16")
+parser.add_argument("--force", action="store_true",
+                    help="rebuild even if compiled LUT-s are up to date")
+args = parser.parse_args()
+
+for hd in args.haldDirs:
+    if ( not os.path.isdir(hd) ):
+        print(f"-E- Missing HALD directory '{hd}'")
+        sys.exit(1)
+
+errCnt = CompileHaldLutsInDirs(args.haldDirs, dtype=args.dtype, force=args.force)
+print(f"-I- Done compiling LUT-s in {args.haldDirs}; {errCnt} error(s)")
+sys.exit(errCnt)
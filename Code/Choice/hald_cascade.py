@@ -0,0 +1,223 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# hald_cascade.py - two-stage HALD choice: the R2C-histogram decision tree
+#   answers when its leaf is confident; only uncertain images go to the network.
+# The network is anything with predict_halds(paths) -> [(haldId, confidence)]:
+#   AnahaldResnet, AnahaldRuntime or AnahaldClient; this module needs no torch.
+# The tree must give graded confidences: a fully grown tree has pure leaves,
+#   always reports 1.0 and never escalates. Use TrainCascadeDecisionTree()
+#   (leaves of at least 'minSamplesLeaf' images) or a calibrated classifier.
+
+import os
+import numpy as np
+from sklearn.tree import DecisionTreeClassifier
+
+from search_ana import *
+from search_ana import _HIST_KEYS_ORDER, _HALD_ORDER_ABC, _RANDOM_SEED
+from r2c_histogram import *
+
+
+################## HOW TO LOAD THE CODE #########################################
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from choose_hald_resnet import *;  from hald_cascade import *
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import hald_cascade;  importlib.reload(hald_cascade);  from hald_cascade import *
+#################################################################################
+
+
+CASCADE_CONFIDENCE_THRESHOLD = 0.9   # tree leaf purity below it => ask network
+CASCADE_EVAL_THRESHOLDS = [0.0, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0, 1.01]
+CASCADE_SOURCE_TREE = "tree"
+CASCADE_SOURCE_NET  = "net"
+CASCADE_MIN_SAMPLES_LEAF = 5   # keeps tree leaves mixed => confidences below 1.0
+
+
+#################################################################################
+## Example:  casc = HaldCascade(TrainCascadeDecisionTree("INP/CHOICE_DATA/real__hist.csv", "INP/CHOICE_DATA/real__ana_to_hald.csv"), LoadSavedAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth"));  casc.predict_halds_for_histogram_csv("ALL_SBS_1080", "INP/CHOICE_DATA/real__hist.csv")
+class HaldCascade:
+    def __init__(self, decTree, net, threshold=CASCADE_CONFIDENCE_THRESHOLD):
+        self.decTree = decTree
+        self.net = net
+        self.threshold = threshold
+        self.cntTree = 0   # answered by the tree
+        self.cntNet  = 0   # escalated to the network
+        self.canEscalate = CascadeTreeCanEscalate(decTree, threshold)
+        if ( not self.canEscalate ):
+            print(f"-W- All leaves of the tree are pure - no confidence falls below {threshold}, the network will never be asked; use TrainCascadeDecisionTree() or a calibrated model")
+
+
+    # Returns list of (haldId, confidence, source) in the order of 'sbsPaths';
+    #   'binsMatrix' holds R2C histograms of the same images (N x 7);
+    #   if not given, the histograms are computed from the images.
+    # If the network fails on an image, the tree answer is kept.
+    def predict_halds(self, sbsPaths, binsMatrix=None):
+        unreadable = np.zeros(len(sbsPaths), dtype=bool)
+        if ( binsMatrix is None ):
+            hists = [R2CHistogramOfImage(p) for p in sbsPaths]
+            unreadable = np.array([h is None for h in hists], dtype=bool)
+            binsMatrix = [np.zeros(R2C_NUM_BINS)  if  (h is None)  else  h
+                          for h in hists]
+        (treeHalds, treeConfs) = PredictHaldIdsWithConfidence(self.decTree,
+                                                              binsMatrix)
+        treeConfs[unreadable] = 0.0   # leave these to the network
+        results = [(h, float(c), CASCADE_SOURCE_TREE)
+                   for (h, c) in zip(treeHalds, treeConfs)]
+        escIdx = np.flatnonzero(treeConfs < self.threshold)
+        if ( len(escIdx) > 0 ):
+            netRes = self.net.predict_halds([sbsPaths[i] for i in escIdx])
+            if ( netRes is None ):
+                print(f"-W- Network failed; keeping tree choices for {len(escIdx)} uncertain image(s)")
+                netRes = [(None, 0.0)] * len(escIdx)
+            for (i, (haldId, conf)) in zip(escIdx, netRes):
+                if ( haldId is not None ):
+                    results[i] = (haldId, conf, CASCADE_SOURCE_NET)
+        self.cntNet  += len(escIdx)
+        self.cntTree += len(results) - len(escIdx)
+        return(results)
+
+
+    # Predicts for all images listed in R2C-histogram CSV 'histogramDictCSVPath';
+    #   images are expected under 'sbsDir'.
+    # Returns dictionary of {fileName :: (haldId, confidence, source)} or 0 on error.
+    def predict_halds_for_histogram_csv(self, sbsDir, histogramDictCSVPath):
+        try:
+            histDF = pd.read_csv(histogramDictCSVPath, index_col='filename')
+        except Exception as e:
+            print(f"-E- Error reading histogram dictionary from '{histogramDictCSVPath}': {e}")
+            return(0)
+        names = histDF.index.tolist()
+        results = self.predict_halds([os.path.join(sbsDir, n) for n in names],
+                                     histDF[_HIST_KEYS_ORDER].to_numpy(float))
+        print(f"-I- Cascade chose HALD-s for {len(names)} image(s); {self.escalation_rate():.1f}% escalated so far")
+        return(dict(zip(names, results)))
+
+
+    # Returns percent of images passed to the network since construction
+    def escalation_rate(self):
+        cntAll = self.cntTree + self.cntNet
+        return(100.0 * self.cntNet / cntAll  if  (cntAll > 0)  else  0.0)
+#################################################################################
+
+
+# Tells whether 'decTree' can report confidence below 'threshold' at all.
+# A bare sklearn tree is judged by its leaves: single-output - by their
+#   top-class share; multi-output (one-hot) - by purity.
+# Other models (e.g. CalibratedClassifierCV) are assumed to be graded.
+def CascadeTreeCanEscalate(decTree, threshold):
+    tree = getattr(decTree, "tree_", None)
+    if ( tree is None ):
+        return(True)
+    leaves = (tree.children_left == -1)
+    if ( tree.n_outputs == 1 ):
+        value = tree.value[leaves, 0, :]
+        return(bool(np.any(value.max(axis=1) < threshold * value.sum(axis=1))))
+    return(bool(np.any(tree.impurity[leaves] > 0)))
+
+
+# Trains single-output decision tree for the cascade on R2C histograms of
+#   labeled images; every leaf holds at least 'minSamplesLeaf' images,
+#   so leaf shares are graded confidences rather than always 1.0.
+# Returns the tree or 0 on error.
+## Example:  decTree = TrainCascadeDecisionTree("INP/CHOICE_DATA/real__hist.csv", "INP/CHOICE_DATA/real__ana_to_hald.csv")
+def TrainCascadeDecisionTree(histogramDictCSVPath, haldDictCSVPath,
+                             minSamplesLeaf=CASCADE_MIN_SAMPLES_LEAF):
+    corr = CorrelateHistogramAndHaldTables(histogramDictCSVPath, haldDictCSVPath)
+    if ( corr == 0 ):
+        return(0)  # error already printed
+    (fileNames, featuresDF, haldIds) = corr
+    decTree = DecisionTreeClassifier(min_samples_leaf=minSamplesLeaf,
+                                     random_state=_RANDOM_SEED)
+    decTree.fit(featuresDF.to_numpy(float), haldIds.to_numpy())
+    print(f"-I- Trained cascade tree on {len(fileNames)} image(s): {decTree.get_n_leaves()} leaves of at least {minSamplesLeaf} image(s)")
+    return(decTree)
+
+
+# Measures the accuracy vs. escalation trade-off of the cascade on labeled images.
+# The tree and the network each run once over all images; every threshold
+#   then only selects which answer counts.
+# Returns list of (threshold, escalationPercent, accuracyPercent) or 0 on error.
+## Example:  EvaluateHaldCascade(TrainCascadeDecisionTree("INP/CHOICE_DATA/real__hist.csv", "INP/CHOICE_DATA/real__ana_to_hald.csv"), LoadSavedAnahaldResnet("MODELS/anahald_model_params__96d5__20250814-231159.pth"), "INP/CHOICE_DATA/real__hist.csv", "INP/CHOICE_DATA/real__ana_to_hald.csv", "ALL_SBS_1080")
+def EvaluateHaldCascade(decTree, net, histogramDictCSVPath, haldDictCSVPath,
+                        sbsDir, thresholds=CASCADE_EVAL_THRESHOLDS):
+    corr = CorrelateHistogramAndHaldTables(histogramDictCSVPath, haldDictCSVPath)
+    if ( corr == 0 ):
+        return(0)  # error already printed
+    (fileNames, featuresDF, haldIds) = corr
+    binsMatrix = featuresDF.to_numpy(float)
+    expected = haldIds.to_numpy()
+    (treeHalds, treeConfs) = PredictHaldIdsWithConfidence(decTree, binsMatrix)
+    netRes = net.predict_halds([os.path.join(sbsDir, n) for n in fileNames])
+    if ( netRes is None ):
+        print("-E- Network failed to predict")
+        return(0)
+    treeHalds = np.array(treeHalds)
+    netHalds  = np.array([str(h) for (h, _) in netRes])
+    treeAcc = 100.0 * np.mean(treeHalds == expected)
+    netAcc  = 100.0 * np.mean(netHalds  == expected)
+    print(f"-I- Cascade evaluation over {len(fileNames)} image(s): tree-only accuracy {treeAcc:.2f}%, network-only accuracy {netAcc:.2f}%")
+    print("    threshold  escalated%  accuracy%")
+    tradeOff = []
+    for thr in thresholds:
+        escalate = (treeConfs < thr)
+        chosen = np.where(escalate, netHalds, treeHalds)
+        escRate = 100.0 * np.mean(escalate)
+        acc = 100.0 * np.mean(chosen == expected)
+        print(f"    {thr:9.2f}  {escRate:10.2f}  {acc:9.2f}")
+        tradeOff.append((thr, float(escRate), float(acc)))
+    return(tradeOff)
+
+
+# Checks that fully grown tree is reported as never escalating, while
+#   TrainCascadeDecisionTree() one does pass uncertain images to the network.
+# Writes CSV-s of random histograms with random HALD labels into 'tmp_dir';
+#   the "network" is a stub that always answers the first HALD.
+## Example:  DEBUG__TestHaldCascadeEscalation("TMP")
+def DEBUG__TestHaldCascadeEscalation(tmp_dir, numImgs=200):
+    class _StubNet:
+        def predict_halds(self, sbsPaths):
+            return([(_HALD_ORDER_ABC[0], 1.0)] * len(sbsPaths))
+    os.makedirs(tmp_dir, exist_ok=True)
+    histPath = os.path.join(tmp_dir, "debug_cascade__hist.csv")
+    haldPath = os.path.join(tmp_dir, "debug_cascade__ana_to_hald.csv")
+    rng = np.random.RandomState(_RANDOM_SEED)
+    names = [f"IMG{i:04d}" for i in range(numImgs)]
+    halds = [_HALD_ORDER_ABC[i] for i in rng.randint(0, 3, numImgs)]
+    histDF = pd.DataFrame(rng.rand(numImgs, len(_HIST_KEYS_ORDER)) * 100,
+                          columns=_HIST_KEYS_ORDER)
+    histDF.insert(0, "filename", [f"{n}.TIF" for n in names])
+    histDF.to_csv(histPath, index=False)
+    pd.DataFrame({"AnaFileName": [f"{n}_{h}.JPG" for (n, h) in zip(names, halds)],
+                  "HaldId": halds}).to_csv(haldPath, index=False)
+
+    fullTree = DecisionTreeClassifier(random_state=_RANDOM_SEED).fit(
+                    histDF[_HIST_KEYS_ORDER].to_numpy(float), halds)
+    if ( CascadeTreeCanEscalate(fullTree, CASCADE_CONFIDENCE_THRESHOLD) ):
+        print(f"-E- Fully grown tree not detected as never escalating")
+        return(0)
+    decTree = TrainCascadeDecisionTree(histPath, haldPath)
+    if ( decTree == 0 ):
+        return(0)  # error already printed
+    casc = HaldCascade(decTree, _StubNet())
+    results = casc.predict_halds_for_histogram_csv(tmp_dir, histPath)
+    if ( results == 0 ):
+        return(0)  # error already printed
+    numNet = sum(1 for (_, _, src) in results.values() if src == CASCADE_SOURCE_NET)
+    if ( (not casc.canEscalate) or (numNet == 0) or (numNet != casc.cntNet) ):
+        print(f"-E- Cascade escalated {numNet} of {numImgs} image(s) (counted {casc.cntNet})")
+        return(0)
+    print(f"-I- Success testing cascade escalation: {casc.escalation_rate():.1f}% escalated")
+    return(1)
+##
@@ -0,0 +1,762 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# hald_lut.py - in-process application of HALD CLUT-s;
+#               replaces ImageMagick '-gamma ... -hald-clut ... -compose stereo'
+
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+from ah_cfg import *
+
+
+################## HOW TO LOAD THE CODE #########################################
+# DT2022 - Anaconda:
+# import sys;  sys.path.append('C:\\Oleg\\Gitwork\\Anahald\\Code\\Choice')
+# from hald_lut import *
+#
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from hald_lut import *
+# # import os;  os.chdir('C:\\ANY\\Gitwork\\Anahald')
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import hald_lut;  importlib.reload(hald_lut);  from hald_lut import *
+#################################################################################
+
+
+HALD_LEVEL    = 16                       # sample HALD-s are 'hald__*__16.TIF'
+ID_HALD_ID    = "ahg_oleg_id"            # identity - no HALD file needed
+
+# Compiled LUT-s are stored beside HALD-s as 'hald__{id}__16.npy' -
+# .npy header (dtype, shape) followed by the raw N x N x N x 3 cube
+COMPILED_LUT_EXT    = ".npy"
+COMPILED_LUT_DTYPES = ("uint16", "float16")
+
+INTERP_TRILINEAR   = "trilinear"
+INTERP_TETRAHEDRAL = "tetrahedral"
+
+# Pixels processed per vectorized step; bounds temporary memory to ~100 MB
+APPLY_CHUNK_PIXELS = 1 << 18
+
+# Expected deviation from ImageMagick (Q16) result, in 8-bit levels per channel.
+# Differences come from resize filter and 8-bit (vs 16-bit) resize output;
+# LUT interpolation itself matches '-hald-clut' up to rounding.
+# Checked by make_anaglyph.DEBUG__TestMagickParity().
+MAGICK_PARITY_TOLERANCE = 2
+
+
+#################################################################################
+# A 3D lookup cube loaded from HALD image.
+# 'cube' is N x N x N x 3 array indexed as [blue, green, red];
+# its dtype is uint16 (full scale 65535), uint8 (255) or float (1.0).
+## Example:  lut = HaldLut.from_hald_image("SAMPLE_HALDS/hald__ahg_oleg_gp__16.TIF");  anaArr = RenderAnaglyphArray("ALL_SBS_1080/DSC00033.TIF", lut, 1.0)
+class HaldLut:
+    def __init__(self, cube, haldId="", srcPath=""):
+        if ( (cube.ndim != 4) or (cube.shape[3] != 3) or
+             not (cube.shape[0] == cube.shape[1] == cube.shape[2]) ):
+            raise Exception(f"Invalid LUT cube shape {cube.shape}")
+        self.cube = cube
+        self.size = cube.shape[0]
+        self.haldId = haldId
+        self.srcPath = srcPath
+        if   ( cube.dtype == np.uint16 ):  self._scale = 1.0 / 65535
+        elif ( cube.dtype == np.uint8 ):   self._scale = 1.0 / 255
+        else:                              self._scale = 1.0
+        # flat view for gathers: entry of (r,g,b) is at  (b*N + g)*N + r
+        self._flat = cube.reshape(-1, 3)
+
+
+    # Builds the LUT out of HALD image file; returns None on error
+    @staticmethod
+    def from_hald_image(haldPath, haldId=""):
+        haldArr = ReadHaldImage(haldPath)
+        if ( haldArr is None ):
+            return(None)  # error already printed
+        cube = HaldLut.hald_image_to_cube(haldArr)
+        if ( cube is None ):
+            print(f"-E- Invalid HALD image '{haldPath}' of shape {haldArr.shape}")
+            return(None)
+        return(HaldLut(cube, haldId, haldPath))
+
+
+    # Memory-maps compiled LUT file; returns None on error
+    @staticmethod
+    def from_compiled(npyPath, haldId=""):
+        try:
+            cube = np.load(npyPath, mmap_mode="r")
+            return(HaldLut(cube, haldId, npyPath))
+        except Exception as e:
+            print(f"-E- Error loading compiled LUT '{npyPath}': {e}")
+            return(None)
+
+
+    # Loads the LUT from HALD image or compiled file 'haldPath'.
+    # For HALD image, takes its compiled counterpart instead unless it is stale.
+    @staticmethod
+    def from_file(haldPath, haldId=""):
+        if ( os.path.splitext(haldPath)[1].lower() == COMPILED_LUT_EXT ):
+            return(HaldLut.from_compiled(haldPath, haldId))
+        npyPath = CompiledLutPathForHald(haldPath)
+        if ( os.path.exists(npyPath) ):
+            if ( IsCompiledLutFresh(npyPath, haldPath) ):
+                lut = HaldLut.from_compiled(npyPath, haldId)
+                if ( lut is not None ):
+                    return(lut)
+            else:
+                print(f"-W- Compiled LUT '{npyPath}' is older than '{haldPath}'; reading the HALD image")
+        return(HaldLut.from_hald_image(haldPath, haldId))
+
+
+    # Identity LUT - mostly for testing
+    @staticmethod
+    def identity(size=HALD_LEVEL*HALD_LEVEL):
+        grid = np.linspace(0.0, 1.0, size, dtype=np.float32)
+        b, g, r = np.meshgrid(grid, grid, grid, indexing="ij")
+        return(HaldLut(np.stack([r, g, b], axis=-1), ID_HALD_ID, ""))
+
+
+    # Converts HALD image of level L (L^3 x L^3 pixels) into L^2-sized cube.
+    # Returns None if the image is not a HALD.
+    @staticmethod
+    def hald_image_to_cube(haldArr):
+        if ( (haldArr.ndim != 3) or (haldArr.shape[0] != haldArr.shape[1]) ):
+            return(None)
+        level = round(haldArr.shape[0] ** (1.0/3))
+        if ( level**3 != haldArr.shape[0] ):
+            return(None)
+        n = level * level
+        # HALD pixels in scan order are the cube entries with red changing fastest
+        return(np.ascontiguousarray(haldArr[:, :, :3]).reshape(n, n, n, 3))
+
+
+    def nbytes(self):
+        return(self.cube.nbytes)
+
+
+    # Applies the LUT to HxWx3 image 'img' - uint8 or float in [0...1].
+    # Returns float32 HxWx3 array in [0...1].
+    def apply(self, img, method=INTERP_TRILINEAR):
+        h, w = img.shape[:2]
+        flat = img.reshape(-1, 3)
+        out = np.empty(flat.shape, dtype=np.float32)
+        for start in range(0, flat.shape[0], APPLY_CHUNK_PIXELS):
+            end = min(start + APPLY_CHUNK_PIXELS, flat.shape[0])
+            out[start:end] = self._apply_chunk(flat[start:end], method)
+        return(out.reshape(h, w, 3))
+
+
+    def _apply_chunk(self, pix, method):
+        n = self.size
+        if ( (pix.dtype == np.uint8) and (n == 256) ):
+            # 8-bit input falls exactly on the grid - no interpolation needed
+            idx = ((pix[:, 2].astype(np.intp) * n + pix[:, 1]) * n + pix[:, 0])
+            return(self._flat[idx] * np.float32(self._scale))
+        if ( pix.dtype == np.uint8 ):
+            coords = pix.astype(np.float32) * np.float32((n - 1) / 255.0)
+        else:
+            coords = np.clip(pix, 0.0, 1.0).astype(np.float32) * np.float32(n-1)
+        i0 = np.minimum(coords.astype(np.intp), n - 2)
+        f = coords - i0                                      # in [0...1]
+        base = (i0[:, 2] * n + i0[:, 1]) * n + i0[:, 0]
+        c = self._flat
+        if ( method == INTERP_TETRAHEDRAL ):
+            # walk from the base corner along axes in order of decreasing fraction
+            order = np.argsort(-f, axis=1)
+            fs = np.take_along_axis(f, order, axis=1)
+            steps = np.array([1, n, n*n], dtype=np.intp)[order]
+            v1 = base + steps[:, 0]
+            v2 = v1   + steps[:, 1]
+            v3 = v2   + steps[:, 2]
+            res = ( (1.0 - fs[:, 0:1])      * c[base] +
+                    (fs[:, 0:1] - fs[:, 1:2]) * c[v1] +
+                    (fs[:, 1:2] - fs[:, 2:3]) * c[v2] +
+                    fs[:, 2:3]              * c[v3] )
+        else:  # trilinear
+            fr, fg, fb = f[:, 0:1], f[:, 1:2], f[:, 2:3]
+            dg = n;  db = n * n
+            c00 = _lerp(c[base],         c[base+1],         fr)
+            c10 = _lerp(c[base+dg],      c[base+dg+1],      fr)
+            c01 = _lerp(c[base+db],      c[base+db+1],      fr)
+            c11 = _lerp(c[base+db+dg],   c[base+db+dg+1],   fr)
+            res = _lerp(_lerp(c00, c10, fg), _lerp(c01, c11, fg), fb)
+        return(res * np.float32(self._scale))
+#################################################################################
+
+
+def _lerp(a, b, t):
+    a = a.astype(np.float32)
+    return(a + (b.astype(np.float32) - a) * t)
+
+
+# Returns path of 'hald__{haldId}__16.TIF' in the first of 'haldDirs' having it,
+# or that of its compiled counterpart if only the latter exists,
+# or None if not found
+def FindHaldFile(haldId, haldDirs):
+    haldName = f"hald__{haldId}__{HALD_LEVEL}.TIF"
+    for haldDir in haldDirs:
+        haldPath = f"{haldDir}/{haldName}"
+        if ( os.path.exists(haldPath) ):
+            return(haldPath)
+        npyPath = CompiledLutPathForHald(haldPath)
+        if ( os.path.exists(npyPath) ):
+            return(npyPath)
+    return(None)
+
+
+def CompiledLutPathForHald(haldPath):
+    return(os.path.splitext(haldPath)[0] + COMPILED_LUT_EXT)
+
+
+# Compiled LUT is fresh if it isn't older than its HALD image
+def IsCompiledLutFresh(npyPath, haldPath):
+    try:
+        return(os.stat(npyPath).st_mtime_ns >= os.stat(haldPath).st_mtime_ns)
+    except OSError:
+        return(False)
+
+
+# Returns ((path, mtime, size), ...) for 'paths' or None if any is inaccessible
+def FileStamps(paths):
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return(None)
+        stamps.append((path, st.st_mtime_ns, st.st_size))
+    return(tuple(stamps))
+
+
+# Stamps of the files 'lut' depends on: the HALD path looked up
+# and the file actually loaded - e.g. its compiled .npy
+def LoadedLutStamps(haldPath, lut):
+    paths = [haldPath]
+    if ( (lut.srcPath != "") and
+         (os.path.normcase(os.path.abspath(lut.srcPath)) !=
+          os.path.normcase(os.path.abspath(haldPath))) ):
+        paths.append(lut.srcPath)
+    return(FileStamps(paths))
+
+
+# Writes compiled LUT beside HALD image 'haldPath'; skips it if fresh unless 'force'.
+# 'dtype' is "uint16" (exact) or "float16" (same size, ~3 decimal digits).
+# Returns path of the compiled LUT or None on error.
+## Example:  CompileHaldLut("SAMPLE_HALDS/hald__ahg_oleg_gp__16.TIF")
+def CompileHaldLut(haldPath, dtype="uint16", force=False):
+    if ( dtype not in COMPILED_LUT_DTYPES ):
+        print(f"-E- Unsupported compiled-LUT type '{dtype}'; should be one of {COMPILED_LUT_DTYPES}")
+        return(None)
+    npyPath = CompiledLutPathForHald(haldPath)
+    if ( (not force) and os.path.exists(npyPath) and
+         IsCompiledLutFresh(npyPath, haldPath) ):
+        print(f"-I- Compiled LUT '{npyPath}' is up to date")
+        return(npyPath)
+    lut = HaldLut.from_hald_image(haldPath)
+    if ( lut is None ):
+        return(None)  # error already printed
+    cube = lut.cube
+    if ( dtype == "float16" ):
+        cube = (cube * np.float32(lut._scale)).astype(np.float16)
+    elif ( cube.dtype != np.uint16 ):
+        cube = np.round(cube * np.float32(lut._scale * 65535)).astype(np.uint16)
+    tmpPath = npyPath + ".tmp"
+    try:
+        with open(tmpPath, "wb") as f:
+            np.save(f, np.ascontiguousarray(cube))
+        os.replace(tmpPath, npyPath)  # atomic - readers never see partial file
+    except Exception as e:
+        print(f"-E- Error writing compiled LUT '{npyPath}': {e}")
+        return(None)
+    print(f"-I- Compiled '{haldPath}' into '{npyPath}' ({dtype})")
+    return(npyPath)
+
+
+# Compiles all 'hald__*__16.TIF' HALD-s in 'haldDirs'; returns number of failures
+## Example:  CompileHaldLutsInDirs(["SAMPLE_HALDS", "SAMPLE_HALDS/ADD"])
+def CompileHaldLutsInDirs(haldDirs, dtype="uint16", force=False):
+    errCnt = 0
+    for haldDir in haldDirs:
+        for leaf in sorted(os.listdir(haldDir)):
+            if ( not re.fullmatch(rf"hald__.+__{HALD_LEVEL}\.tiff?", leaf,
+                                  flags=re.IGNORECASE) ):
+                continue
+            if ( CompileHaldLut(os.path.join(haldDir, leaf), dtype, force) is None ):
+                errCnt += 1
+    return(errCnt)
+
+
+# Returns HxWx3 array of HALD pixels (uint16 if the file is 16-bit) or None.
+# PIL reduces 16-bit RGB TIFF-s to 8 bits, so 'tifffile' or 'cv2' are preferred.
+def ReadHaldImage(haldPath):
+    try:
+        import tifffile
+        if ( os.path.splitext(haldPath)[1].lower() in (".tif", ".tiff") ):
+            return(tifffile.imread(haldPath))
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"-E- Error reading HALD image '{haldPath}': {e}")
+        return(None)
+    try:
+        import cv2
+        arr = cv2.imread(haldPath, cv2.IMREAD_UNCHANGED)
+        if ( arr is not None ):
+            return(arr[:, :, 2::-1])  # BGR -> RGB
+    except ImportError:
+        pass
+    try:
+        with Image.open(haldPath) as img:
+            arr = np.asarray(img.convert("RGB"))
+    except Exception as e:
+        print(f"-E- Error reading HALD image '{haldPath}': {e}")
+        return(None)
+    print(f"-W- HALD '{haldPath}' read with 8-bit precision; install 'tifffile' for 16 bits")
+    return(arr)
+
+
+#################################################################################
+# Process-wide LRU cache of decoded HALD LUT-s bounded by 'maxBytes'.
+# Entries are keyed by (haldId, HALD file path) and invalidated
+# when modification time or size of the file changes.
+# Obtain the shared instance with GetHaldLutCache().
+## Example:  lut = GetHaldLutCache().get("ahg_oleg_gp", ["SAMPLE_HALDS", "SAMPLE_HALDS/ADD"]);  GetHaldLutCache().get_stats()
+class HaldLutCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self._entries = OrderedDict()  # (haldId, path) : (stamps, lut)
+        self._paths = {}               # (haldId, haldDirs) : path
+        self._lock = threading.RLock()
+        self._loadLock = threading.Lock()  # one decode at a time
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    # Returns path of the HALD file for 'haldId'; remembers the choice
+    def find_hald_path(self, haldId, haldDirs):
+        pathKey = (haldId, tuple(haldDirs))
+        with self._lock:
+            haldPath = self._paths.get(pathKey)
+        if ( (haldPath is not None) and os.path.exists(haldPath) ):
+            return(haldPath)
+        haldPath = FindHaldFile(haldId, haldDirs)
+        with self._lock:
+            if ( haldPath is not None ):
+                self._paths[pathKey] = haldPath
+            else:
+                self._paths.pop(pathKey, None)
+        return(haldPath)
+
+
+    # Returns the LUT for 'haldId' or None if not found or failed to load
+    def get(self, haldId, haldDirs):
+        haldPath = self.find_hald_path(haldId, haldDirs)
+        if ( haldPath is None ):
+            print(f"-E- Inexistent HALD file 'hald__{haldId}__{HALD_LEVEL}.TIF'; checked directories : {haldDirs}")
+            return(None)
+        key = (haldId, os.path.normcase(os.path.abspath(haldPath)))
+        lut = self._lookup(key)
+        if ( lut is not None ):
+            return(lut)
+        with self._loadLock:
+            lut = self._lookup(key, countMiss=False)  # maybe loaded meanwhile
+            if ( lut is not None ):
+                return(lut)
+            lut = HaldLut.from_file(haldPath, haldId)
+            if ( lut is None ):
+                return(None)  # error already printed
+            self._insert(key, LoadedLutStamps(haldPath, lut), lut)
+        return(lut)
+
+
+    # Returns LUT of 'haldId' with gamma 'gamma' baked in, or None on error.
+    # Composed LUT-s are cached by (haldId, gamma) alongside plain ones.
+    def get_composed(self, haldId, haldDirs, gamma):
+        if ( gamma == 1.0 ):
+            return(self.get(haldId, haldDirs))
+        baseLut = self.get(haldId, haldDirs)
+        if ( baseLut is None ):
+            return(None)  # error already printed
+        haldPath = self.find_hald_path(haldId, haldDirs)
+        if ( haldPath is None ):
+            print(f"-E- Inexistent HALD file 'hald__{haldId}__{HALD_LEVEL}.TIF'; checked directories : {haldDirs}")
+            return(None)
+        key = (haldId, os.path.normcase(os.path.abspath(haldPath)),
+               "gamma", round(float(gamma), 4))
+        lut = self._lookup(key)
+        if ( lut is not None ):
+            return(lut)
+        with self._loadLock:
+            lut = self._lookup(key, countMiss=False)
+            if ( lut is not None ):
+                return(lut)
+            stamps = LoadedLutStamps(haldPath, baseLut)  # before composing
+            lut = ComposeLuts([Curve1D.gamma(gamma), baseLut],
+                              size=baseLut.size, haldId=haldId)
+            self._insert(key, stamps, lut)
+        return(lut)
+
+
+    # An entry is valid while all files it was stamped with are unchanged
+    def _lookup(self, key, countMiss=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if ( entry is not None ):
+                (stamps, lut) = entry
+                if ( FileStamps([s[0] for s in stamps]) == stamps ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return(lut)
+                del self._entries[key]          # a file changed on disk
+                self.invalidations += 1
+            if ( countMiss ):
+                self.misses += 1
+            return(None)
+
+
+    def _insert(self, key, stamps, lut):
+        if ( stamps is None ):
+            print(f"-W- HALD file(s) of '{key[0]}' vanished while loading; not cached")
+            return
+        with self._lock:
+            if ( lut.nbytes() > self.maxBytes ):
+                print(f"-W- HALD LUT '{key[0]}' of {lut.nbytes()} byte(s) exceeds cache budget of {self.maxBytes}; not cached")
+                return
+            self._entries[key] = (stamps, lut)
+            self._evict_to_budget()
+
+
+    def _evict_to_budget(self):
+        while ( (self.current_bytes() > self.maxBytes) and
+                (len(self._entries) > 1) ):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def set_max_bytes(self, maxBytes):
+        with self._lock:
+            self.maxBytes = maxBytes
+            self._evict_to_budget()
+
+
+    def current_bytes(self):
+        with self._lock:
+            return(sum(e[1].nbytes() for e in self._entries.values()))
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+
+
+    def get_stats(self):
+        with self._lock:
+            return({"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "entries": len(self._entries),
+                    "bytes": self.current_bytes(),
+                    "maxBytes": self.maxBytes})
+#################################################################################
+
+
+_LUT_CACHE = None
+_LUT_CACHE_LOCK = threading.Lock()
+
+# Returns the process-wide HALD LUT cache; budget from AhConfig.LUT_CACHE_MAX_BYTES
+def GetHaldLutCache():
+    global _LUT_CACHE
+    with _LUT_CACHE_LOCK:
+        if ( _LUT_CACHE is None ):
+            _LUT_CACHE = HaldLutCache(AhConfig.LUT_CACHE_MAX_BYTES)
+        return(_LUT_CACHE)
+
+
+# Returns the LUT for 'haldId' (None for identity HALD) and error indicator.
+# LUT-s come from the process-wide cache unless 'useCache' is False.
+def LoadHaldLut(haldId, haldDirs, useCache=True):
+    if ( haldId == ID_HALD_ID ):
+        return(None, False)
+    if ( useCache ):
+        lut = GetHaldLutCache().get(haldId, haldDirs)
+        return(lut, (lut is None))
+    haldPath = FindHaldFile(haldId, haldDirs)
+    if ( haldPath is None ):
+        print(f"-E- Inexistent HALD file 'hald__{haldId}__{HALD_LEVEL}.TIF'; checked directories : {haldDirs}")
+        return(None, True)
+    lut = HaldLut.from_file(haldPath, haldId)
+    return(lut, (lut is None))
+
+
+#################################################################################
+# Per-channel 1D curve on [0...1] - either a vectorized function
+#   or samples (K or K x 3 values) at K evenly spaced points.
+## Example:  c = Curve1D.gamma(0.88);  c(np.array([[0.5, 0.5, 0.5]]))
+class Curve1D:
+    def __init__(self, func=None, samples=None):
+        if ( (func is None) == (samples is None) ):
+            raise Exception("Curve1D needs either 'func' or 'samples'")
+        self.func = func
+        self.samples = (None  if  (samples is None)  else
+                        np.asarray(samples, dtype=np.float32))
+
+
+    # The ImageMagick '-gamma' curve:  out = in ^ (1/gamma)
+    @staticmethod
+    def gamma(gamma):
+        invGamma = np.float32(1.0 / gamma)
+        return(Curve1D(func=lambda x: np.power(x, invGamma)))
+
+
+    # Evaluates the curve for values 'x' of shape (..., 3)
+    def __call__(self, x):
+        if ( self.func is not None ):
+            return(self.func(x).astype(np.float32))
+        grid = np.linspace(0.0, 1.0, self.samples.shape[0], dtype=np.float32)
+        out = np.empty(x.shape, dtype=np.float32)
+        for ch in range(3):
+            ys = self.samples  if  (self.samples.ndim == 1)  else  self.samples[:, ch]
+            out[..., ch] = np.interp(x[..., ch], grid, ys)
+        return(out)
+#################################################################################
+
+
+# Bakes chain of 'stages' - Curve1D-s and HaldLut-s, applied left to right -
+#   into a single uint16 HaldLut with 'size' grid points per axis.
+# Leading 1D curves are folded into separable resampling of the first 3D LUT,
+#   which makes the common "gamma then HALD" chain cheap (about a second).
+## Example:  lut = ComposeLuts([Curve1D.gamma(0.88), GetHaldLutCache().get("ahg_oleg_sf", ["SAMPLE_HALDS/ADD"])])
+def ComposeLuts(stages, size=HALD_LEVEL*HALD_LEVEL, haldId=""):
+    grid = np.linspace(0.0, 1.0, size, dtype=np.float32)
+    axes = np.stack([grid, grid, grid], axis=-1)   # leading curves, per axis
+    cube = None                                    # float32 result so far
+    for stage in stages:
+        if ( isinstance(stage, HaldLut) ):
+            if ( cube is None ):
+                cube = _resample_lut_separable(stage, axes)
+            else:
+                cube = stage.apply(cube.reshape(-1, size*size, 3),
+                                   INTERP_TRILINEAR).reshape(cube.shape)
+        elif ( isinstance(stage, Curve1D) ):
+            if ( cube is None ):
+                axes = stage(axes)
+            else:
+                cube = stage(cube)
+        else:
+            raise Exception(f"Unsupported LUT stage {type(stage)}")
+    if ( cube is None ):  # only 1D curves
+        b, g, r = np.meshgrid(axes[:, 2], axes[:, 1], axes[:, 0], indexing="ij")
+        cube = np.stack([r, g, b], axis=-1)
+    cube = np.round(np.clip(cube, 0.0, 1.0) * np.float32(65535)).astype(np.uint16)
+    return(HaldLut(cube, haldId, ""))
+
+
+# Trilinear resampling of 'lut' at separable points:  red from axes[:,0],
+#   green from axes[:,1], blue from axes[:,2]. Returns float32 cube.
+# Interpolates along one axis at a time; works slice by slice to bound memory.
+def _resample_lut_separable(lut, axes):
+    n = lut.size
+    size = axes.shape[0]
+    idx = []; frac = []
+    for ch in range(3):
+        coords = np.clip(axes[:, ch], 0.0, 1.0) * np.float32(n - 1)
+        i0 = np.minimum(coords.astype(np.intp), n - 2)
+        idx.append(i0);  frac.append((coords - i0).astype(np.float32))
+    (ir, ig, ib) = idx
+    fr = frac[0][None, :, None];  fg = frac[1][:, None, None]
+    scale = np.float32(lut._scale)
+
+    def _plane(bIdx):  # blue plane resampled along red and green; size x size x 3
+        p = lut.cube[bIdx]                                   # [g, r, 3]
+        p = _lerp(p[:, ir], p[:, ir + 1], fr)                # along red
+        return(_lerp(p[ig], p[ig + 1], fg) * scale)          # along green
+
+    out = np.empty((size, size, size, 3), dtype=np.float32)
+    planes = {}
+    for j in range(size):
+        for bIdx in (ib[j], ib[j] + 1):
+            if ( bIdx not in planes ):
+                planes[bIdx] = _plane(bIdx)
+        out[j] = _lerp(planes[ib[j]], planes[ib[j] + 1], frac[2][j])
+        for bIdx in [k for k in planes if k < ib[j]]:
+            del planes[bIdx]                                 # no longer needed
+    return(out)
+
+
+# Returns (LUT, gamma still to apply, error indicator) for 'haldId' and 'gamma'.
+# For real HALD-s gamma is baked into the (cached) LUT, so one lookup does both;
+# identity HALD gets no LUT, and its gamma is a cheap 256-entry table.
+def LoadHaldLutWithGamma(haldId, haldDirs, gamma):
+    if ( haldId == ID_HALD_ID ):
+        return(None, gamma, False)
+    lut = GetHaldLutCache().get_composed(haldId, haldDirs, gamma)
+    return(lut, 1.0, (lut is None))
+
+
+# Returns size that fits (w, h) into 'maxWidth' x 'maxHeight' box
+# like ImageMagick '-resize WxH' does; non-positive limit means "unlimited"
+def FitSizeLikeImageMagick(w, h, maxWidth=-1, maxHeight=-1):
+    scales = []
+    if ( maxWidth  > 0 ):  scales.append(maxWidth / w)
+    if ( maxHeight > 0 ):  scales.append(maxHeight / h)
+    if ( len(scales) == 0 ):
+        return(w, h)
+    scale = min(scales)
+    return(max(1, int(w * scale + 0.5)), max(1, int(h * scale + 0.5)))
+
+
+# Applies gamma the ImageMagick way: out = in ^ (1/gamma)
+# For 8-bit input uses 256-entry table instead of per-pixel power.
+def ApplyGamma(img, gamma):
+    if ( img.dtype == np.uint8 ):
+        table = np.arange(256, dtype=np.float32) * np.float32(1.0 / 255)
+        if ( gamma != 1.0 ):
+            table = np.power(table, np.float32(1.0 / gamma))
+        return(table[img])
+    if ( gamma == 1.0 ):
+        return(img)
+    return(np.power(img, np.float32(1.0 / gamma)))
+
+
+# Makes red-cyan anaglyph out of SBS array, replicating ImageMagick
+#   "-crop 50%x100% -swap 0,1 -compose stereo -composite":
+# red comes from the left half, green and blue - from the right half.
+def ComposeStereoAnaglyph(sbsArr):
+    w = sbsArr.shape[1]
+    leftW = (w + 1) // 2
+    left  = sbsArr[:, :leftW]
+    right = sbsArr[:, leftW:]
+    ana = right.copy()               # the destination (after swap) - right
+    ana[:, :, 0] = left[:, :right.shape[1], 0]
+    return(ana)
+
+
+def FloatToUint8(img):
+    return(np.clip(img * np.float32(255) + np.float32(0.5), 0, 255).astype(np.uint8))
+
+
+# Opens SBS image or takes already-open PIL image; resizes if requested
+def LoadSbsImage(sbsPathOrImage, maxWidth=-1, maxHeight=-1):
+    if ( isinstance(sbsPathOrImage, Image.Image) ):
+        img = sbsPathOrImage.convert("RGB")
+    else:
+        with Image.open(sbsPathOrImage) as f:
+            img = f.convert("RGB")
+    newW, newH = FitSizeLikeImageMagick(img.width, img.height, maxWidth, maxHeight)
+    if ( (newW, newH) != (img.width, img.height) ):
+        img = img.resize((newW, newH), Image.LANCZOS)
+    return(img)
+
+
+# Renders anaglyph in memory; returns HxWx3 uint8 array.
+# 'haldLut' is HaldLut or None (identity).
+## Example:  anaArr = RenderAnaglyphArray("ALL_SBS_1080/DSC00033.TIF", lut, 0.95, maxWidth=1080, maxHeight=1080)
+def RenderAnaglyphArray(sbsPathOrImage, haldLut, gamma, *, maxWidth=-1,
+                        maxHeight=-1, method=INTERP_TRILINEAR):
+    img = LoadSbsImage(sbsPathOrImage, maxWidth, maxHeight)
+    arr = np.asarray(img)
+    if ( gamma != 1.0 ):
+        arr = ApplyGamma(arr, gamma)
+    if ( haldLut is not None ):
+        arr = haldLut.apply(arr, method)
+    if ( arr.dtype != np.uint8 ):
+        arr = FloatToUint8(arr)
+    return(ComposeStereoAnaglyph(arr))
+
+
+# Returns 256-entry table of LUT grid indices for 8-bit channel values
+#   with gamma applied the ImageMagick way: in ^ (1/gamma).
+# Values are rounded to the nearest grid node - fine for on-screen preview.
+## Example:  tbl = GammaIndexTable(0.9, 256)
+def GammaIndexTable(gamma, size):
+    table = np.arange(256, dtype=np.float64) / 255
+    if ( gamma != 1.0 ):
+        table = np.power(table, 1.0 / gamma)
+    return(np.rint(table * (size - 1)).astype(np.intp))
+
+
+# Fast preview variant of RenderAnaglyphArray() for already loaded 8-bit SBS.
+# Gamma goes as 1D pre-table into the plain (cached) LUT, then each pixel
+#   is one direct gather in the cube - neither composed LUT nor interpolation.
+# Coarser LUT-s (not one node per 8-bit value) are interpolated as usual.
+# 'haldLut' is HaldLut or None (identity). Returns HxWx3 uint8 array.
+## Example:  anaArr = RenderPreviewAnaglyphArray(LoadSbsImage("ALL_SBS_1080/DSC00033.TIF", 1024, 512), lut, 0.95)
+def RenderPreviewAnaglyphArray(sbsImage, haldLut, gamma, method=INTERP_TRILINEAR):
+    arr = np.asarray(sbsImage)
+    if ( haldLut is None ):
+        table = FloatToUint8(ApplyGamma(np.arange(256, dtype=np.uint8), gamma))
+        return(ComposeStereoAnaglyph(table[arr]))
+    n = haldLut.size
+    if ( n < 256 ):
+        return(RenderAnaglyphArray(sbsImage, haldLut, gamma, method=method))
+    table = GammaIndexTable(gamma, n)
+    flatIdx = (table[arr[:, :, 2]] * n + table[arr[:, :, 1]]) * n + table[arr[:, :, 0]]
+    out = haldLut._flat[flatIdx]
+    if ( out.dtype == np.uint16 ):   # round to 8 bits like FloatToUint8()
+        out = ((out.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    elif ( out.dtype != np.uint8 ):
+        out = FloatToUint8(out.astype(np.float32) * np.float32(haldLut._scale))
+    return(ComposeStereoAnaglyph(out))
+
+
+# Saves uint8 array with the same settings as
+#   MakeImOutspecForOutpath() in make_anaglyph.py gives ImageMagick.
+# Returns 'outPath' or None on error.
+def SaveImageArray(arr, outPath):
+    ext = os.path.splitext(outPath)[1].lower()
+    try:
+        img = Image.fromarray(arr, mode="RGB")
+        if ( ext == ".jpg" ):
+            img.save(outPath, quality=92, subsampling=0)
+        elif ( ext == ".tif" ):
+            img.save(outPath, compression="tiff_lzw")
+        else:
+            img.save(outPath)
+    except Exception as e:
+        print(f"-E- Error saving image '{outPath}': {e}")
+        return(None)
+    return(outPath)
+
+
+# Makes anaglyph 'outPath' out of SBS image (path or PIL image) with the given LUT.
+# Returns 'outPath' or None on error.
+def MakeAnaglyphFile(sbsPathOrImage, haldLut, gamma, outPath, *, maxWidth=-1,
+                     maxHeight=-1, method=INTERP_TRILINEAR):
+    try:
+        anaArr = RenderAnaglyphArray(sbsPathOrImage, haldLut, gamma,
+                        maxWidth=maxWidth, maxHeight=maxHeight, method=method)
+    except Exception as e:
+        print(f"-E- Error rendering anaglyph for '{outPath}': {e}")
+        return(None)
+    return(SaveImageArray(anaArr, outPath))
+
+
+# Compares two images of equal size; returns (maxAbsDiff, meanAbsDiff) in 8-bit levels.
+# Intended for checking in-process output against ImageMagick output.
+## Example:  (mx, mean) = CompareImageFiles("TMP/IM/DSC00033_ahg_oleg_gp.tif", "TMP/NP/DSC00033_ahg_oleg_gp.tif");  mx <= MAGICK_PARITY_TOLERANCE
+def CompareImageFiles(path1, path2):
+    with Image.open(path1) as i1, Image.open(path2) as i2:
+        a1 = np.asarray(i1.convert("RGB"), dtype=np.int16)
+        a2 = np.asarray(i2.convert("RGB"), dtype=np.int16)
+    if ( a1.shape != a2.shape ):
+        raise Exception(f"Image sizes differ: {a1.shape} vs {a2.shape}")
+    diff = np.abs(a1 - a2)
+    return(int(diff.max()), float(diff.mean()))
+#################################################################################
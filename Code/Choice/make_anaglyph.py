@@ -0,0 +1,181 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# make_anaglyph.py - applies a chosen HALD to SBS image and writes anaglyph;
+#                    needs no torch, so that inference runtimes stay light
+
+import os
+from pathlib import Path
+import subprocess
+
+from ah_cfg import *
+from hald_lut import *
+
+
+################## HOW TO LOAD THE CODE #########################################
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from make_anaglyph import *
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import make_anaglyph;  importlib.reload(make_anaglyph);  from make_anaglyph import *
+#################################################################################
+
+
+# Returns default gamma for sample HALD 'haldId'
+def ChooseGammaForSampleHald(haldId):
+    haldPrefixToGamma = {"ahg_oleg_id":1.00,
+                         "ahg_oleg_cp":1.00,
+                         "ahg_oleg_mc":1.00,
+                         "ahg_oleg_gp":1.00,
+                         "ahg_oleg_ec":0.95,
+                         "ahg_oleg_xc":0.88,
+                         "ahg_oleg_sf":0.88}
+    if ( haldId in haldPrefixToGamma ):
+        return(haldPrefixToGamma[haldId])
+    else:
+        return(1.00)
+
+
+# Makes anaglyph out of SBS image 'sbsPath' using HALD 'haldId'.
+# Returns path of the created anaglyph or None on error.
+# 'engine' is "numpy" (in-process) or "magick"; default - AhConfig.HALD_ENGINE
+# 'sbsImage' optionally gives already decoded PIL image of 'sbsPath'
+## Example 1:  ApplyHaldMakeAna("ALL_SBS_1080/DSC00033.TIF", "ahg_oleg_gp", ["d:/Work/RMA_WA/INP/HALD"], "TMP")
+## Example 2:  ApplyHaldMakeAna("ALL_SBS_1080/DSC00033.TIF", "ahg_oleg_gp", ["C:/ANY/GitWork/AnaHald/INP/HALD"], "TMP", engine="magick")
+def ApplyHaldMakeAna(sbsPath, haldId, haldDirs, outDir,
+                     *, gamma=-1, maxWidth=-1, maxHeight=-1, isPreview=False,
+                     engine=None, sbsImage=None):
+    if ( engine is None ):
+        engine = AhConfig.HALD_ENGINE
+    if ( gamma < 0 ):
+        gamma = ChooseGammaForSampleHald(haldId)
+    os.makedirs(outDir, exist_ok=True)
+    outPath = MakeAnaOutPath(sbsPath, haldId, outDir, isPreview)
+    if ( engine == "magick" ):
+        return(_ApplyHaldMakeAnaMagick(sbsPath, haldId,
+                  haldDirs, outPath, gamma=gamma,
+                  maxWidth=maxWidth, maxHeight=maxHeight))
+    elif ( engine == "numpy" ):
+        return(_ApplyHaldMakeAnaNumpy(
+                  sbsPath  if  (sbsImage is None)  else  sbsImage,
+                  haldId, haldDirs, outPath, gamma=gamma,
+                  maxWidth=maxWidth, maxHeight=maxHeight))
+    else:
+        print(f"-E- Unknown HALD engine '{engine}'; should be 'numpy' or 'magick'")
+        return(None)
+
+
+# Builds output file path for anaglyph of 'sbsPath' made with 'haldId'
+def MakeAnaOutPath(sbsPath, haldId, outDir, isPreview):
+    pureName, ext = os.path.splitext(os.path.basename(sbsPath))
+    outExt = "jpg"  if  ( isPreview or
+                          (AhConfig.MAKE_TIFF == False) )  else  "tif"
+    return(f"{outDir}/{pureName}_{haldId}.{outExt}")
+
+
+# In-process variant of 'ApplyHaldMakeAna' - see hald_lut.py
+def _ApplyHaldMakeAnaNumpy(sbsPathOrImage, haldId, haldDirs, outPath,
+                           *, gamma, maxWidth=-1, maxHeight=-1):
+    haldLut, restGamma, isErr = LoadHaldLutWithGamma(haldId, haldDirs, gamma)
+    if ( isErr ):
+        return(None)  # error already printed
+    print(f"-I- Rendering '{outPath}' with HALD '{haldId}', gamma {gamma}")
+    return(MakeAnaglyphFile(sbsPathOrImage, haldLut, restGamma, outPath,
+                            maxWidth=maxWidth, maxHeight=maxHeight,
+                            method=AhConfig.HALD_INTERPOLATION))
+
+
+# ImageMagick variant of 'ApplyHaldMakeAna'
+def _ApplyHaldMakeAnaMagick(sbsPath, haldId, haldDirs, outPath,
+                            *, gamma, maxWidth=-1, maxHeight=-1):
+    IMC = os.getenv("IMAGEMAGICK_CONVERT_OR_MAGICK")
+    if ( IMC is None ):
+        print(f"-E- Please define environment variable 'IMAGEMAGICK_CONVERT_OR_MAGICK' with path of ImageMagick 'convert' or 'magick' utility")
+        return(None)
+    IMC_DIR = os.path.dirname(IMC).strip('"')
+    IMC_NAME = os.path.basename(IMC).strip('"')
+    if ( haldId != "ahg_oleg_id" ):
+        # find HALD file in provided directories
+        haldPath = GetHaldLutCache().find_hald_path(haldId, haldDirs)
+        if ( (haldPath is None) or
+             haldPath.lower().endswith(COMPILED_LUT_EXT) ):
+            print(f"-E- Inexistent HALD file 'hald__{haldId}__16.TIF'; checked directories : {haldDirs}")
+            return(None)
+        haldArgs = [Path(haldPath).resolve(), "-hald-clut"]
+    else:
+        haldArgs = []
+    # build resize specification
+    resizeSpec = ""
+    if ( (maxWidth > 0) or (maxHeight > 0) ):
+        resizeSpec = "-resize "
+        if ( maxWidth > 0 ):   resizeSpec += str(maxWidth)
+        resizeSpec += "x"
+        if ( maxHeight > 0 ):  resizeSpec += str(maxHeight)
+    cmdAsList = [IMC_NAME, Path(sbsPath).resolve(), *resizeSpec.split(), "-gamma", str(gamma)] + haldArgs +  ["-crop","50%x100%", "-swap","0,1",  "-define","compose:args=20",  "-compose","stereo", "-composite"] + MakeImOutspecForOutpath(outPath)
+    print(f"-I- Running command:  {' '.join([str(x) for x in cmdAsList])}")
+    try:
+        # run in IMC_DIR - workaround for "Access is denied" on Anaconda;
+        # 'cwd' instead of os.chdir() keeps it safe for parallel callers
+        result = subprocess.run(cmdAsList,
+                                cwd=(IMC_DIR  if  (IMC_DIR != '')  else  None),
+                                capture_output=True, text=True, check=True)
+        isOk = True
+    except Exception as e:
+        print(f"Error executing command: {e}")
+        #print(f"Stderr: {e.stderr}") #stderr available in specific exception
+        return(None)
+    # success
+    return(outPath)
+
+
+# Returns list of Imagemagick file-save parameters for given output file
+def MakeImOutspecForOutpath(outPath):
+    ext = os.path.splitext(outPath)[1].lower()
+    outPath = Path(outPath).resolve()
+    if ( ext == ".jpg" ):
+        return(["-depth","8", "-quality","92", outPath])
+    elif ( ext == ".tif" ):
+        return(["-depth","8", "-compress","LZW", outPath])
+    else:
+        return(["-depth","8", outPath])
+
+
+# Renders 'sbsPath' with both engines - full size and preview-sized -
+# and checks they differ by at most MAGICK_PARITY_TOLERANCE.
+# Needs IMAGEMAGICK_CONVERT_OR_MAGICK; run before relying on the "numpy" engine.
+## Example:  DEBUG__TestMagickParity("ALL_SBS_1080/DSC00033.TIF", ["C:/ANY/GitWork/AnaHald/INP/HALD"], "TMP/PARITY")
+def DEBUG__TestMagickParity(sbsPath, haldDirs, tmp_dir, haldId="ahg_oleg_gp",
+                            gamma=0.88, previewSize=(1024, 384)):
+    oldMakeTiff = AhConfig.MAKE_TIFF
+    AhConfig.MAKE_TIFF = True   # lossless output - JPEG noise would mask the check
+    try:
+        for (maxWidth, maxHeight) in [(-1, -1), previewSize]:
+            outPaths = []
+            for engine in ["magick", "numpy"]:
+                outPath = ApplyHaldMakeAna(sbsPath, haldId, haldDirs,
+                            os.path.join(tmp_dir, engine), gamma=gamma,
+                            maxWidth=maxWidth, maxHeight=maxHeight,
+                            engine=engine)
+                if ( outPath is None ):
+                    return(0)  # error already printed
+                outPaths.append(outPath)
+            (maxDiff, meanDiff) = CompareImageFiles(*outPaths)
+            print(f"-I- Engines differ by max {maxDiff}, mean {meanDiff:.3f} level(s) at {maxWidth}x{maxHeight}")
+            if ( maxDiff > MAGICK_PARITY_TOLERANCE ):
+                print(f"-E- Difference {maxDiff} exceeds tolerance {MAGICK_PARITY_TOLERANCE} for '{sbsPath}'")
+                return(0)
+    finally:
+        AhConfig.MAKE_TIFF = oldMakeTiff
+    print(f"-I- Success testing engine parity on '{sbsPath}'")
+    return(1)
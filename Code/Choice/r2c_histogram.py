@@ -0,0 +1,153 @@
+#################################################################################
+## Copyright 2025 Oleg Kosyakovsky
+##
+## Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+
+# r2c_histogram.py - red-to-cyan ratio histograms of images, as produced by
+#   Tcl 'anahald_r2c_histogram' (rca::read_r2c_histogram_from_file_list),
+#   computed in-process with NumPy.
+## Usage example:
+##    python c:\ANY\GitWork\AnaHald\Code\Choice\r2c_histogram.py  ALL_SBS_1080  TMP/real__hist.csv  [--subsample 2]  [--workers 8]
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+################## HOW TO LOAD THE CODE #########################################
+# SZBOX12 - WinPython - need to change directory
+# import sys;  sys.path.append('C:\\ANY\\Gitwork\\Anahald\\Code\\Choice')
+# from r2c_histogram import *
+#
+# RELOAD - ANYWHERE:
+# import importlib;  import r2c_histogram;  importlib.reload(r2c_histogram);  from r2c_histogram import *
+#################################################################################
+
+
+# Same constants as in the Tcl code (img_proc:: and rca::_list_r2c_thresholds)
+R2C_MIN_COLOR_VAL = 0.5          # channel values floored to it before division
+R2C_THRESHOLDS = [R2C_MIN_COLOR_VAL/255, 0.33, 0.45, 0.67, 1.50, 2.20, 3.00,
+                  255/R2C_MIN_COLOR_VAL]
+R2C_NUM_BINS = len(R2C_THRESHOLDS) - 1
+R2C_IMAGE_EXTENSIONS = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'gif']
+R2C_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+R2C_CHUNK_SIZE = 8               # images per task sent to a worker process
+
+
+# Returns 256x256 table of bin index by [red, max(green, blue)].
+# A ratio on a threshold belongs to the lower bin - the 1st inclusive range
+#   that matches, as in rca::_classify_color_for_r2c_histogram.
+def _MakeR2CBinTable():
+    vals = np.maximum(np.arange(256, dtype=np.float64), R2C_MIN_COLOR_VAL)
+    r2c = vals[:, np.newaxis] / vals[np.newaxis, :]
+    binIdx = np.searchsorted(np.array(R2C_THRESHOLDS[1:-1]), r2c, side='left')
+    return(binIdx.astype(np.uint8))
+
+_R2C_BIN_TABLE = _MakeR2CBinTable()
+
+
+# Returns CSV header columns for the bins; example: '0.00-0.33'
+def R2CHistogramBinNames():
+    return([f"{R2C_THRESHOLDS[i-1]:.2f}-{R2C_THRESHOLDS[i]:.2f}"
+            for i in range(1, len(R2C_THRESHOLDS))])
+
+
+# Returns array of 'R2C_NUM_BINS' pixel percentages for 8-bit RGB array [H,W,3].
+# 'subsample' > 1 takes every n-th pixel of every n-th row.
+def R2CHistogramOfArray(rgbArray, subsample=1):
+    if ( subsample > 1 ):
+        rgbArray = rgbArray[::subsample, ::subsample]
+    red  = rgbArray[..., 0]
+    cyan = np.maximum(rgbArray[..., 1], rgbArray[..., 2])
+    counts = np.bincount(_R2C_BIN_TABLE[red, cyan].ravel(),
+                         minlength=R2C_NUM_BINS)
+    return(100.0 * counts / max(1, red.size))
+
+
+# Returns array of bin percentages for image file 'imgPath' or None on error
+## Example:  R2CHistogramOfImage("ALL_SBS_1080/DSC00033.TIF", subsample=2)
+def R2CHistogramOfImage(imgPath, subsample=1):
+    try:
+        with Image.open(imgPath) as f:
+            rgbArray = np.asarray(f.convert("RGB"))
+    except Exception as e:
+        print(f"-E- Failed reading image '{imgPath}': {e}")
+        return(None)
+    return(R2CHistogramOfArray(rgbArray, subsample))
+
+
+# Worker-side processing of a chunk of paths; returns list of (path, hist-or-None)
+def _R2CHistogramsOfChunk(pathsAndSubsample):
+    (paths, subsample) = pathsAndSubsample
+    return([(p, R2CHistogramOfImage(p, subsample)) for p in paths])
+
+
+# Returns list of image paths in directory 'imgDir' in name order
+def ListImagesForR2CHistogram(imgDir):
+    paths = [p for p in glob.glob(os.path.join(imgDir, '*.*'))
+             if  (os.path.splitext(p)[1][1:].lower() in R2C_IMAGE_EXTENSIONS)]
+    return(sorted(paths))
+
+
+# Computes R2C histograms for images in 'imgDirOrPathsList' and writes them
+#   into CSV 'outCsvPath' in the format of the Tcl tool:
+#   filename,0.00-0.33,...,3.00-510.00  with percents per bin.
+# Unreadable images are skipped.
+# Returns number of images written or 0 on error.
+## Example:  MakeR2CHistogramsCSV("ALL_SBS_1080", "TMP/real__hist.csv", subsample=2)
+def MakeR2CHistogramsCSV(imgDirOrPathsList, outCsvPath, subsample=1,
+                         numWorkers=R2C_WORKERS):
+    if ( isinstance(imgDirOrPathsList, str) ):
+        paths = ListImagesForR2CHistogram(imgDirOrPathsList)
+    else:
+        paths = list(imgDirOrPathsList)
+    if ( len(paths) == 0 ):
+        print(f"-E- No images to compute R2C histograms for")
+        return(0)
+    chunks = [(paths[i:i+R2C_CHUNK_SIZE], subsample)
+              for i in range(0, len(paths), R2C_CHUNK_SIZE)]
+    if ( (numWorkers <= 1) or (len(chunks) == 1) ):
+        results = [r for c in chunks for r in _R2CHistogramsOfChunk(c)]
+    else:
+        with ProcessPoolExecutor(max_workers=numWorkers) as pool:
+            results = [r for rc in pool.map(_R2CHistogramsOfChunk, chunks)
+                       for r in rc]
+    lines = [",".join(["filename"] + R2CHistogramBinNames())]
+    for (path, hist) in results:
+        if ( hist is None ):
+            continue  # error already printed
+        lines.append(",".join([os.path.basename(path)] +
+                              [f"{v:.2f}" for v in hist]))
+    try:
+        with open(outCsvPath, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+    except Exception as e:
+        print(f"-E- Error saving R2C histograms in '{outCsvPath}': {e}")
+        return(0)
+    print(f"-I- Stored R2C histogram(s) for {len(lines)-1} of {len(paths)} image(s) in '{outCsvPath}'")
+    return(len(lines) - 1)
+
+
+if ( __name__ == "__main__" ):
+    parser = argparse.ArgumentParser(description="Compute R2C histograms of images into CSV")
+    parser.add_argument("imgDir")
+    parser.add_argument("outCsvPath")
+    parser.add_argument("--subsample", type=int, default=1,
+                        help="take every n-th pixel in both directions")
+    parser.add_argument("--workers", type=int, default=R2C_WORKERS)
+    args = parser.parse_args()
+    cnt = MakeR2CHistogramsCSV(args.imgDir, args.outCsvPath,
+                               args.subsample, args.workers)
+    sys.exit(0  if  (cnt > 0)  else  1)
@@ -156,47 +156,89 @@ def MapSbsToHalds(anaDir, haldPrefix=_HALD_NAME_PREFIX,
     return(sbsNameToHald)
 
 
-# Turns two {fileName :: <SOMETHING>} dictionries into order-correlated lists
+# Joins R2C-histogram and HALD tables by image name - one pandas merge.
 # histogramDict = {          fileName :: R2C-histogram-bins}
 # halddDict = {fileNameWithHaldSuffix :: haldID}
 # (dictionaries stored in CSV files)
-## Example 1:  (fileNamesNoSuffList, r2cBinsListOfLists, haldIDList) = CorrelateFileNameDictionaries("INP/CHOICE_DATA/dummy_hist.csv", "INP/CHOICE_DATA/dummy_hald.csv")
-## Example 2:  (fileNames, r2cBinsLists, haldIDs) = CorrelateFileNameDictionaries("INP/CHOICE_DATA/hist_rr.csv", "INP/CHOICE_DATA/ana_to_hald.csv")
-def CorrelateFileNameDictionaries(histogramDictCSVPath, haldDictCSVPath):
+# Join key is the lowercase name without extension; HALD suffix is dropped
+#   from anaglyph names ("IMG12_ahg_oleg_cp.JPG" => "img12"), while names
+#   without suffix (dummy "ID" HALD) are taken as is.
+# Returns (fileNamesList, featuresDFrame, haldIdSeries) sorted by filename,
+#   with features in columns b_0...b_6 as in AssembleFeaturesDataframe(),
+#   or 0 on error.
+## Example:  (fileNames, featuresDF, haldIds) = CorrelateHistogramAndHaldTables("INP/CHOICE_DATA/hist_rr.csv", "INP/CHOICE_DATA/ana_to_hald.csv")
+def CorrelateHistogramAndHaldTables(histogramDictCSVPath, haldDictCSVPath,
+                                    haldPrefix=_HALD_NAME_PREFIX):
     try:
-        histogramDictDFrame = pd.read_csv(histogramDictCSVPath, index_col=None)
-    # Process the DataFrame
+        histDF = pd.read_csv(histogramDictCSVPath, index_col=None)
     except Exception as e:
         print(f"-E- Error reading histogram dictionary from '{histogramDictCSVPath}': {e}")
         return  0
     try:
-        haldDictDFrame = pd.read_csv(haldDictCSVPath, index_col=None)
+        haldDF = pd.read_csv(haldDictCSVPath, index_col=None)
     except Exception as e:
         print(f"-E- Error reading HALD dictionary from '{haldDictCSVPath}': {e}")
         return  0
-    fileNamesHist = histogramDictDFrame['filename'].tolist() # TODO: error-check
-    fileNamesHald = haldDictDFrame['AnaFileName'].tolist()   # TODO: error-check
-    (fileNamesHistSorted, fileNamesHaldSorted) = \
-                              FindCommonFileNames(fileNamesHist, fileNamesHald)
-    if ( len(fileNamesHistSorted) == 0 ):
+    missingCols = ([c for c in ['filename'] + _HIST_KEYS_ORDER if c not in histDF] +
+                   [c for c in ['AnaFileName', 'HaldId'] if c not in haldDF])
+    if ( len(missingCols) > 0 ):
+        print(f"-E- Missing column(s) {missingCols} in '{histogramDictCSVPath}' / '{haldDictCSVPath}'")
+        return  0
+    histDF['_key'] = _FileNameStemKeys(histDF['filename'], None)
+    haldDF['_key'] = _FileNameStemKeys(haldDF['AnaFileName'], haldPrefix)
+    histDF = _DropDuplicatedKeys(histDF.sort_values('filename'), histogramDictCSVPath)
+    haldDF = _DropDuplicatedKeys(haldDF.sort_values('AnaFileName'), haldDictCSVPath)
+    joined = histDF.merge(haldDF[['_key', 'AnaFileName', 'HaldId']],
+                          on='_key', how='inner').sort_values('filename')
+    if ( len(joined) == 0 ):
         print("-E- No correlated filenames found")
         return  0
-    print(f"-I- Found {len(fileNamesHistSorted)} correlated filename(s)")
-    #return  (fileNamesHistSorted, fileNamesHaldSorted);  # OK_TMP
-    # build order-correlated lists of histograms and HALDs
-    r2cBinsListOfLists = [];  haldIDList = [];  # for sorted resulting lists
-    histogramDictDFrame.set_index('filename', inplace=True)
-    haldDictDFrame.set_index('AnaFileName', inplace=True)
-    #print(f"@@@@@@\n{histogramDictDFrame}\n@@@@@@\n{haldDictDFrame}\n@@@@@@")
-    for i in range(0, len(fileNamesHistSorted)):
-        fileNameForHist = fileNamesHistSorted[i]
-        fileNameForHald = fileNamesHaldSorted[i]
-        histRow = histogramDictDFrame.loc[fileNameForHist]
-        haldRow = haldDictDFrame.loc[fileNameForHald]
-        #print(f"\n@@@@ '{fileNameForHist}' =>\n{histRow};  \n----\n'{fileNameForHald}' =>\n{haldRow}")
-        r2cBinsListOfLists.append(histRow)
-        haldIDList.append(haldRow)
-    return( (fileNamesHistSorted, r2cBinsListOfLists, haldIDList) )
+    print(f"-I- Found {len(joined)} correlated filename(s)")
+    featuresDF = pd.DataFrame(joined[_HIST_KEYS_ORDER].to_numpy(float),
+                        columns=[f"b_{i}" for i in range(len(_HIST_KEYS_ORDER))])
+    return( (joined['filename'].tolist(), featuresDF,
+             joined['HaldId'].reset_index(drop=True)) )
+
+
+# Returns Series of lowercase file-name stems; 'haldPrefix' (if given) strips
+#   HALD suffix the same way as DetectSourceFromFilename()
+def _FileNameStemKeys(fileNamesSeries, haldPrefix):
+    stems = fileNamesSeries.astype(str).str.replace(r"^.*[\\/]", "", regex=True)
+    stems = stems.str.replace(r"\.[^.]*$", "", regex=True)
+    if ( haldPrefix is not None ):
+        srcNames = stems.str.extract("^(.+)_{}[^.]+$".format(re.escape(haldPrefix)),
+                                     expand=False)
+        stems = srcNames.fillna(stems)
+    return(stems.str.lower())
+
+
+# Keeps the 1st row per '_key'; warns about the rest
+def _DropDuplicatedKeys(df, csvPath):
+    dupl = df['_key'].duplicated(keep='first')
+    if ( dupl.any() ):
+        print(f"-W- Ignored {dupl.sum()} row(s) with duplicated image name in '{csvPath}'")
+    return(df[~dupl])
+
+
+# Turns two {fileName :: <SOMETHING>} dictionries into order-correlated lists
+# histogramDict = {          fileName :: R2C-histogram-bins}
+# halddDict = {fileNameWithHaldSuffix :: haldID}
+# (dictionaries stored in CSV files)
+# Kept for the list-based API; built upon CorrelateHistogramAndHaldTables().
+## Example 1:  (fileNamesNoSuffList, r2cBinsListOfLists, haldIDList) = CorrelateFileNameDictionaries("INP/CHOICE_DATA/dummy_hist.csv", "INP/CHOICE_DATA/dummy_hald.csv")
+## Example 2:  (fileNames, r2cBinsLists, haldIDs) = CorrelateFileNameDictionaries("INP/CHOICE_DATA/hist_rr.csv", "INP/CHOICE_DATA/ana_to_hald.csv")
+def CorrelateFileNameDictionaries(histogramDictCSVPath, haldDictCSVPath):
+    corr = CorrelateHistogramAndHaldTables(histogramDictCSVPath, haldDictCSVPath)
+    if ( corr == 0 ):
+        return  0  # error already printed
+    (fileNames, featuresDF, haldIds) = corr
+    binsDF = pd.DataFrame(featuresDF.to_numpy(), index=fileNames,
+                          columns=_HIST_KEYS_ORDER)
+    haldDF = pd.DataFrame({'HaldId': haldIds.to_numpy()}, index=fileNames)
+    # rows as Series, as expected by AssembleFeaturesDataframe() and alike
+    r2cBinsListOfLists = [row for (_, row) in binsDF.iterrows()]
+    haldIDList         = [row for (_, row) in haldDF.iterrows()]
+    return( (fileNames, r2cBinsListOfLists, haldIDList) )
 #
 
 # Returns 2 order-correlated lists of filenames - without- and with suffix
@@ -243,27 +285,67 @@ def SplitFileNameToHistAndHaldDictionaries(fractForFirst,
         raise Exception(f"Fraction for 1st set must be <=1; got {fractForFirst}")
     random.seed(a=_RANDOM_SEED); # ensure stable choice of training vs validation
     nItems = len(fileNamesList)
-    period = 10
     cntFor1 = round(fractForFirst * nItems)
-    cntFor2 = nItems - cntFor1
-    indicesFor1 = random.sample(range(0, nItems), cntFor1)
-    fileNamesList1=[];  r2cBinsListOfLists1=[];  haldIDList1=[]
-    fileNamesList2=[];  r2cBinsListOfLists2=[];  haldIDList2=[]
-    for i in range(0, nItems):
-        if ( i in indicesFor1 ):
-            fileNamesList1.append(fileNamesList[i])
-            r2cBinsListOfLists1.append(r2cBinsListOfLists[i])
-            haldIDList1.append(haldIDList[i])
-        else:
-            fileNamesList2.append(fileNamesList[i])
-            r2cBinsListOfLists2.append(r2cBinsListOfLists[i])
-            haldIDList2.append(haldIDList[i])
-    ###print(f"@@@@ len(haldIDList1)={len(haldIDList1)}, len(haldIDList2)={len(haldIDList2)}")
-    return  ((fileNamesList1, r2cBinsListOfLists1, haldIDList1),
-             (fileNamesList2, r2cBinsListOfLists2, haldIDList2))
+    indicesFor1 = set(random.sample(range(0, nItems), cntFor1))
+    idx1 = sorted(indicesFor1)
+    idx2 = [i for i in range(0, nItems) if i not in indicesFor1]
+    ###print(f"@@@@ len(idx1)={len(idx1)}, len(idx2)={len(idx2)}")
+    return  (([fileNamesList[i] for i in idx1],
+              [r2cBinsListOfLists[i] for i in idx1],
+              [haldIDList[i] for i in idx1]),
+             ([fileNamesList[i] for i in idx2],
+              [r2cBinsListOfLists[i] for i in idx2],
+              [haldIDList[i] for i in idx2]))
 #
 
 
+# Returns two sorted index arrays (first, second) splitting 'nItems' items;
+#   'fractForFirst' tells a part allocated to 1st set (0.8 means 80 out of 100).
+# If 'stratifyLabels' (e.g. HaldId per item) given, each label is split
+#   in the same proportion.
+# Deterministic - uses its own generator seeded with _RANDOM_SEED.
+## Example:  (fileNames, featuresDF, haldIds) = CorrelateHistogramAndHaldTables("INP/CHOICE_DATA/hist_rr.csv", "INP/CHOICE_DATA/ana_to_hald.csv");    (idxTrn, idxVal) = SplitIndices(len(fileNames), 0.7, stratifyLabels=haldIds);    featuresDF.iloc[idxTrn]
+def SplitIndices(nItems, fractForFirst, stratifyLabels=None):
+    if ( (fractForFirst < 0.0) or (fractForFirst > 1.0) ):
+        raise Exception(f"Fraction for 1st set must be within [0,1]; got {fractForFirst}")
+    rng = np.random.RandomState(_RANDOM_SEED)
+    isFor1 = np.zeros(nItems, dtype=bool)
+    for group in _StratificationGroups(nItems, stratifyLabels):
+        perm = rng.permutation(group)
+        isFor1[perm[:round(fractForFirst * len(group))]] = True
+    return( (np.flatnonzero(isFor1), np.flatnonzero(~isFor1)) )
+
+
+# Returns list of 'numFolds' (trainIdx, validIdx) index-array pairs;
+#   each item is validated in exactly one fold.
+# If 'stratifyLabels' given, each label is spread evenly over the folds.
+## Example:  for (idxTrn, idxVal) in KFoldIndices(len(fileNames), 5, stratifyLabels=haldIds):  print(len(idxTrn), len(idxVal))
+def KFoldIndices(nItems, numFolds, stratifyLabels=None):
+    if ( (numFolds < 2) or (numFolds > nItems) ):
+        raise Exception(f"Number of folds must be within [2,{nItems}]; got {numFolds}")
+    rng = np.random.RandomState(_RANDOM_SEED)
+    foldOfItem = np.zeros(nItems, dtype=int)
+    nextFold = 0   # continue round-robin across groups to balance fold sizes
+    for group in _StratificationGroups(nItems, stratifyLabels):
+        perm = rng.permutation(group)
+        foldOfItem[perm] = (nextFold + np.arange(len(perm))) % numFolds
+        nextFold = (nextFold + len(perm)) % numFolds
+    return([(np.flatnonzero(foldOfItem != k), np.flatnonzero(foldOfItem == k))
+            for k in range(numFolds)])
+
+
+# Returns list of index arrays - one per distinct label in sorted label order,
+#   or a single array of all indices if 'stratifyLabels' is None
+def _StratificationGroups(nItems, stratifyLabels):
+    if ( stratifyLabels is None ):
+        return([np.arange(nItems)])
+    labels = np.asarray(stratifyLabels)
+    if ( len(labels) != nItems ):
+        raise Exception(f"Got {len(labels)} stratification label(s) for {nItems} item(s)")
+    (uniqLabels, labelIdx) = np.unique(labels, return_inverse=True)
+    return([np.flatnonzero(labelIdx == i) for i in range(len(uniqLabels))])
+
+
 def AssembleFeaturesDataframe(r2cBinsListOfLists):
     df = pd.DataFrame({
         'b_0' : [y.iloc[0] for y in r2cBinsListOfLists],
@@ -309,10 +391,65 @@ def DecodeOneHotLabel(oneHotArray):
 #
 
 
+# Vectorized DecodeOneHotLabel() for 2D array of one-hot rows.
+# Returns list of HALD-IDs; "" for rows without 'True' bit.
+def DecodeOneHotLabels(oneHotMatrix):
+    oneHotMatrix = np.asarray(oneHotMatrix).astype(bool)
+    if ( oneHotMatrix.shape[1] > len(_HALD_ORDER_ABC) ):
+        raise Exception(f"Invalid one-hot encoding width for HALD-ID: {oneHotMatrix.shape[1]}")
+    hasTrue = oneHotMatrix.any(axis=1)
+    for row in oneHotMatrix[~hasTrue]:
+        print(f"-F- Missing True bit in one-hot encoding: {row}")
+    idxOfTrue = np.argmax(oneHotMatrix, axis=1)
+    return([_HALD_ORDER_ABC[i]  if  ok  else  ""
+            for (i, ok) in zip(idxOfTrue, hasTrue)])
+#
+
+
 def PredictHaldId(decTree, histogramBinsList):
     oneHotNestedArray = decTree.predict([histogramBinsList]);  # like [[FFFTFFF]]
     return(DecodeOneHotLabel(oneHotNestedArray[0]))
-    
+
+
+# Returns list of HALD-IDs for rows of 'binsMatrix' (N x 7) in one predict() call
+def PredictHaldIds(decTree, binsMatrix):
+    binsMatrix = np.asarray(binsMatrix, dtype=float).reshape(-1, len(_HIST_KEYS_ORDER))
+    if ( len(binsMatrix) == 0 ):
+        return([])
+    return(DecodeOneHotLabels(decTree.predict(binsMatrix)))
+
+
+# Returns (haldIdsList, confidencesArray) for rows of 'binsMatrix' (N x 7).
+# Confidence of the tree is the share of training samples in the reached leaf
+#   that carry the predicted HALD (predict_proba normalized over HALD columns).
+# A single-output classifier with HALD-ID labels (e.g. calibrated small model)
+#   is accepted as well; then confidence is its top class probability.
+## Example:  (haldIds, confs) = PredictHaldIdsWithConfidence(decTree, [[0.0, 0.01, 0.63, 98.88, 0.47, 0.01, 0.0]])
+def PredictHaldIdsWithConfidence(decTree, binsMatrix):
+    binsMatrix = np.asarray(binsMatrix, dtype=float).reshape(-1, len(_HIST_KEYS_ORDER))
+    if ( hasattr(decTree, "feature_names_in_") ):  # trained on a DataFrame
+        binsMatrix = pd.DataFrame(binsMatrix, columns=decTree.feature_names_in_)
+    probs = decTree.predict_proba(binsMatrix)
+    if ( not isinstance(probs, list) ):  # single output - labels are HALD-IDs
+        bestIdx = np.argmax(probs, axis=1)
+        haldIds = [str(decTree.classes_[i]) for i in bestIdx]
+        return( (haldIds, probs[np.arange(len(bestIdx)), bestIdx]) )
+    # multi-output one-hot - probability of 'True' in each HALD column
+    posProbs = np.zeros((len(binsMatrix), len(probs)))
+    for k, (outProbs, classes) in enumerate(zip(probs, decTree.classes_)):
+        trueCols = np.flatnonzero(np.asarray(classes) == True)
+        if ( len(trueCols) > 0 ):
+            posProbs[:, k] = outProbs[:, trueCols[0]]
+    sums = posProbs.sum(axis=1, keepdims=True)
+    posProbs = np.divide(posProbs, sums, out=np.zeros_like(posProbs),
+                         where=(sums > 0))
+    oneHot = np.asarray(decTree.predict(binsMatrix)).astype(bool)
+    # the first 'True' as in DecodeOneHotLabel(); most probable if none
+    chosenIdx = np.where(oneHot.any(axis=1), np.argmax(oneHot, axis=1),
+                         np.argmax(posProbs, axis=1))
+    haldIds = [_HALD_ORDER_ABC[i] for i in chosenIdx]
+    return( (haldIds, posProbs[np.arange(len(chosenIdx)), chosenIdx]) )
+
 
 # Ensures list of histogram values in ascending order.
 ## Example: OneHistogramDictToValues({'0.00-0.33': 0, '0.33-0.45': 1, '0.45-0.67': 2, '0.67-1.50': 3, '1.50-2.20': 4, '2.20-3.00': 5, '3.00-510.00': 6})
@@ -468,11 +605,16 @@ def PredictHaldsForListedImages(decTree, imgNamesList, histogramDictCSVPath,
         except Exception as e:
             print(f"-E- Error reading histogram dictionary from '{histogramDictCSVPath}': {e}")
             return(0)
-    imgNameToPredHaldId = {}
-    for imgName in imgNamesList:
-        haldId = PredictHaldForImageInHistogramCSV(decTree, imgName,
-                  histogramDictCSVPath, histogramDictDFrame=histogramDictDFrame)
-        imgNameToPredHaldId[imgName] = haldId;  # (or 0 on error)
+    # select rows of all listed images at once and predict in one pass
+    imgNamesList = list(imgNamesList)
+    isKnown = pd.Index(imgNamesList).isin(histogramDictDFrame.index)
+    for imgName in np.array(imgNamesList, dtype=object)[~isKnown]:
+        print(f"-E- Image '{imgName}' missing from '{histogramDictCSVPath}'")
+    knownNames = [n for (n, k) in zip(imgNamesList, isKnown) if k]
+    binsMatrix = histogramDictDFrame.loc[knownNames, _HIST_KEYS_ORDER].to_numpy(float)
+    knownToHaldId = dict(zip(knownNames, PredictHaldIds(decTree, binsMatrix)))
+    imgNameToPredHaldId = {n: knownToHaldId.get(n, 0)  # (or 0 on error)
+                           for n in imgNamesList}
     # if requested, output predictions
     if ( outCsvPathOrEmpty != "" ):
         # (keys should represent rows instead of columns, thus orient='index')
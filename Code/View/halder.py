@@ -15,11 +15,13 @@
 
 from datetime import datetime
 import os
-import shutil
 import sys
 from pathlib import Path
+import queue
 import re
 import subprocess
+import threading
+from collections import OrderedDict
 from PIL import Image
 from tempfile import TemporaryDirectory
 
@@ -47,15 +49,14 @@ VIEWER_DIR  = os.path.dirname(SCRIPT_PATH)
 sys.path.append(VIEWER_DIR)
 CHOICE_DIR  = os.path.join(VIEWER_DIR, "..", "Choice")
 sys.path.append(CHOICE_DIR)
-MODEL_DIR  = os.path.join(CHOICE_DIR, "..", "..", "CHOICE_MODELS")
-MODEL_FILENAME = "anahald_model_params__96d5__20250814-231159.pth"  # duplicated, but ...
-MODEL_PATH = os.path.join(MODEL_DIR, MODEL_FILENAME)
 
 
 from choose_hald_base import *   # need AnahaldNetBase.apply_hald_make_ana
 from choose_hald_resnet import * # need AnahaldResnet.LoadSavedAnahaldResnet
-from search_ana import *         # need GenerateTimestampedFilePath
+from search_ana import *
+from hald_lut import *           # need COMPILED_LUT_EXT
 from ah_cfg import *             # configuration settings
+from anahald_client import *     # need AnahaldClient
 
 
 
@@ -65,6 +66,15 @@ from ah_cfg import *             # configuration settings
 class Halder:
     previewWidth = 1080
     previewHeight = 1080
+    SOURCE_CACHE_SIZE = 4   # display-size sources: current image and neighbours
+    SOURCE_PYRAMID_LEVELS = 2  # display size, then each next level halved
+
+    # states of the auto-choice model
+    MODEL_ABSENT  = "absent"    # no model file
+    MODEL_LOADING = "loading"
+    MODEL_READY   = "ready"
+    MODEL_FAILED  = "failed"
+    MODEL_SERVER  = "server"    # model is held by anahald_server.py
     
     def __init__(self, sbsImgOrDirPath, haldDirs, outDir):
         for haldDir in haldDirs:
@@ -72,18 +82,34 @@ class Halder:
                 raise Exception(f"Inexistent HALD directory {haldDir}")
         self.haldDirs = haldDirs
 
-        if ( outDir != "" ):
-            self.outDir = outDir
-            self.tmpDir = GenerateTimestampedFilePath(outDir, "ANAHALD_TMP",
-                                                      ext="", nameSuffOrEmpty="")
-        else:
-            self.outDir = ""
-            self.tmpDir = ""
+        self.outDir = outDir
 
             
         self.currHaldId  = "ahg_oleg_id"  # for ID of the currently chosen HALD
         self.currGamma   = 1.0            # for the currently chosen gamma value
-        self.currAnaPath = ""
+        self.currAnaPath = ""             # the last saved full-size anaglyph
+        self.currPreview = None           # PIL image of the shown preview
+        self.currPreviewName = ""         # like "IMG12_ahg_oleg_cp"
+        # anaglyph previews are rendered to fit this box (set by the view)
+        self.displayWidth  = Halder.previewWidth
+        self.displayHeight = Halder.previewHeight
+
+        # auto-choice model is loaded once, in background, and reused
+        self._model = None
+        self._modelMtime = None        # mtime of AhConfig.MODEL_PATH when loaded
+        self._modelState = Halder.MODEL_LOADING
+        self._modelLock = threading.Lock()
+        self.start_loading_model()
+
+        # downscaled sources - {key :: list of PIL images, largest first}
+        self._sourceCache = PreviewCache(Halder.SOURCE_CACHE_SIZE)
+        # previews rendered ahead of request; filled by background worker
+        self._previewCache = PreviewCache(AhConfig.PREVIEW_CACHE_SIZE)
+        self._prefetchQueue = queue.Queue()
+        self._prefetchGen = 0          # requests of older generations are dropped
+        self._inflight = {}            # {key :: threading.Event} being rendered
+        self._inflightLock = threading.Lock()
+        threading.Thread(target=self._prefetch_worker, daemon=True).start()
 
         self.sbsDir = ""
         self.currSbsPath = ""
@@ -108,44 +134,43 @@ class Halder:
             self.sbsDir = sbsImgOrDirPath
             self.currSbsPath = FileOrder(self.sbsDir).first()  # currently processed image
 
-        # provide 'self.outDir' and 'self.tmpDir' - either given or under input
+        # provide 'self.outDir' - either given or under input
         newOutDir = os.path.join(self.sbsDir, AhConfig.OUTDIR_NAME)
         if ( (self.outDir == "") or
              (os.path.normpath(newOutDir) != os.path.normpath(self.outDir)) ):
-            if ( self.tmpDir != "" ):
-                 self.clean_tmp_dir()  # delete old tmpDir
-            self.outDir = os.path.join(self.sbsDir, AhConfig.OUTDIR_NAME)
-            self.tmpDir = GenerateTimestampedFilePath(self.outDir, "ANAHALD_TMP",
-                                                      ext="", nameSuffOrEmpty="")
+            self.outDir = newOutDir
         os.makedirs(self.outDir, exist_ok=True)
-        os.makedirs(self.tmpDir, exist_ok=True)
-        print(f"-D- Temporary directory: '{self.tmpDir}'")
 
         # generate the default anaglyph
         self.switch_image(self.currSbsPath)
     ####
 
 
-    # If 'isPreview'=True, makes small image in temporary directory;
+    # If 'isPreview'=True, renders display-size image in memory - 'currPreview';
     #          otherwise makes full-size image in output directory
+    # 'isDraft'=True renders preview at half resolution - for live changes
     ## Example_01:  hr.switch_hald_and_gamma(haldId="ahg_oleg_cp", gamma=0.9)
-    def switch_hald_and_gamma(self, *, haldId="ahg_oleg_id", gamma=1.0, isPreview=True):
+    def switch_hald_and_gamma(self, *, haldId="ahg_oleg_id", gamma=1.0, isPreview=True,
+                              isDraft=False):
         if ( not self.is_ready() ):
             print(f"-E- Not ready for 'switch_hald_and_gamma'")
             return(0)
-        oldHaldId = self.currHaldId
-        outDir = self.tmpDir          if  ( isPreview )  else  self.outDir
-        maxWd = Halder.previewWidth   if  ( isPreview )  else  -1
-        maxHt = Halder.previewHeight  if  ( isPreview )  else  -1
-        ret = AnahaldNetBase.apply_hald_make_ana(self.currSbsPath,
-                                  haldId, self.haldDirs, outDir, gamma=gamma,
-                                  maxWidth=maxWd, maxHeight=maxHt,
-                                  isPreview=isPreview)
+        if ( isPreview ):
+            ret = self._take_prefetched(self.currSbsPath, haldId, gamma)
+            if ( ret is None ):
+                ret = self._render_preview(self.currSbsPath, haldId, gamma,
+                                           level=(1 if isDraft else 0))
+        else:
+            ret = AnahaldNetBase.apply_hald_make_ana(self.currSbsPath,
+                                  haldId, self.haldDirs, self.outDir, gamma=gamma,
+                                  maxWidth=-1, maxHeight=-1, isPreview=False)
         if ( ret is not None ):
-            self.currAnaPath = ret
+            if ( isPreview ):
+                self._set_preview(ret, self.currSbsPath, haldId)
+            else:
+                self.currAnaPath = ret
             self.currHaldId  = haldId
             self.currGamma   = gamma
-            self.clean_tmp_all_but_one(preserve=self.currAnaPath)
             return(1)
         else:
             print(f"-E- Failed switching to hald '{haldId}', gamma {gamma}")
@@ -155,8 +180,8 @@ class Halder:
 
     # If image path given, switches to it.
     # If "-"/"+" given, switches to the previous/next image in the same dir
-    # Chooses the new image path and renders the image with current HALD and gamma
-    # Returns path of the created anaglyph or None on error.
+    # Chooses the new image path and renders its preview with identity HALD
+    # Returns the preview - PIL image - or "" at end; raises exception on error.
     def switch_image(self, newSbsPathOrMinusOrPlus):
         if ( not self.is_ready() ):
             print(f"-E- Not ready for 'switch_image'")
@@ -164,17 +189,16 @@ class Halder:
         newSbsPath = self.choose_new_source_image(newSbsPathOrMinusOrPlus)
         if ( newSbsPath == ""  ):
             return("")  # at end
-        ret = AnahaldNetBase.apply_hald_make_ana(newSbsPath,
-              "ahg_oleg_id", self.haldDirs, self.tmpDir, gamma=1.0,
-              maxWidth = Halder.previewWidth, maxHeight = Halder.previewHeight,
-              isPreview=True)
+        ret = self._take_prefetched(newSbsPath, "ahg_oleg_id", 1.0)
+        if ( ret is None ):
+            ret = self._render_preview(newSbsPath, "ahg_oleg_id", 1.0)
         if ( ret is not None ):
             self.currSbsPath = newSbsPath
-            self.currAnaPath = ret
+            self._set_preview(ret, newSbsPath, "ahg_oleg_id")
             self.currHaldId  = "ahg_oleg_id" # reset currently chosen HALD
             self.currGamma   = 1.0           # reset currently chosen gamma value
-            self.clean_tmp_all_but_one(preserve=self.currAnaPath)
-            return(self.currAnaPath)
+            self.prefetch_neighbours()
+            return(self.currPreview)
         else:
             raise Exception(f"Failed switching to '{newSbsPath}'")
     ####
@@ -205,11 +229,164 @@ class Halder:
     ####
 
 
-    # Returns list of filenames of all HALD files
-    # For now picks all TIFF images in HALD directories
+    # Sets the box previews should fit into; drops previews of other size.
+    # Cache keys include the box, so a render at the old size that finishes
+    #   after this never matches a request at the new size.
+    def set_display_size(self, maxWidth, maxHeight):
+        if ( (maxWidth, maxHeight) == (self.displayWidth, self.displayHeight) ):
+            return
+        with self._inflightLock:
+            self._prefetchGen += 1   # drop queued prefetch requests
+            self.displayWidth  = maxWidth
+            self.displayHeight = maxHeight
+        self._sourceCache.clear()
+        self._previewCache.clear()
+    ####
+
+
+    # Renders anaglyph preview of 'sbsPath' fitting the display box.
+    # With in-process engine the HALD is applied to the cached display-size
+    #   source, all in memory; ImageMagick engine goes through a file.
+    # Gamma is not composed into the LUT here (that takes a second) -
+    #   it goes as 8-bit pre-table into the plain cached LUT.
+    # 'displaySize' is (width, height) box; None means the current one.
+    # Returns PIL image or None on error.
+    def _render_preview(self, sbsPath, haldId, gamma, level=0, displaySize=None):
+        (dispW, dispH) = displaySize  or  self._display_size()
+        if ( AhConfig.HALD_ENGINE != "numpy" ):
+            # own directory per render - same names for different gammas
+            with TemporaryDirectory(prefix="ANAHALD_TMP_",
+                                    dir=self.outDir) as renderDir:
+                anaPath = AnahaldNetBase.apply_hald_make_ana(sbsPath, haldId,
+                        self.haldDirs, renderDir, gamma=gamma,
+                        maxWidth=2*dispW, maxHeight=dispH,
+                        isPreview=True)
+                if ( anaPath is None ):
+                    return(None)  # error already printed
+                with Image.open(anaPath) as f:
+                    return(f.convert("RGB"))
+        source = self._get_display_source(sbsPath, level, (dispW, dispH))
+        if ( source is None ):
+            return(None)  # error already printed
+        haldLut, isErr = LoadHaldLut(haldId, self.haldDirs)
+        if ( isErr ):
+            return(None)  # error already printed
+        anaArr = RenderPreviewAnaglyphArray(source, haldLut, gamma,
+                                            method=AhConfig.HALD_INTERPOLATION)
+        return(Image.fromarray(anaArr, mode="RGB"))
+    ####
+
+
+    # Returns SBS image 'sbsPath' downscaled to fit 'displaySize' box
+    #   ('level' > 0 - halved 'level' times) or None on error.
+    # Decodes the image file only once while it is in the source cache.
+    def _get_display_source(self, sbsPath, level, displaySize):
+        (dispW, dispH) = displaySize
+        key = PreviewCache.key(sbsPath, "", 0.0, displaySize)
+        pyramid = self._sourceCache.get(key)
+        if ( pyramid is None ):
+            try:
+                # SBS is twice as wide as the anaglyph
+                img = LoadSbsImage(sbsPath, 2*dispW, dispH)
+            except Exception as e:
+                print(f"-E- Failed reading image '{sbsPath}': {e}")
+                return(None)
+            pyramid = [img]
+            for i in range(1, Halder.SOURCE_PYRAMID_LEVELS):
+                pyramid.append(pyramid[-1].reduce(2))
+            self._sourceCache.put(key, pyramid)
+        return(pyramid[min(level, len(pyramid)-1)])
+    ####
+
+
+    def _display_size(self):
+        with self._inflightLock:
+            return((self.displayWidth, self.displayHeight))
+
+
+    def _set_preview(self, previewImg, sbsPath, haldId):
+        self.currPreview = previewImg
+        pureName = os.path.splitext(os.path.basename(sbsPath))[0]
+        self.currPreviewName = f"{pureName}_{haldId}"
+    ####
+
+
+    # Queues background rendering of identity-HALD previews of the images
+    #   next to the current one; earlier queued requests are dropped
+    def prefetch_neighbours(self):
+        if ( (not AhConfig.PREFETCH_NEIGHBOURS) or (not self.is_ready()) ):
+            return
+        imgOrder = FileOrder(self.sbsDir)
+        paths = [imgOrder.next(self.currSbsPath), imgOrder.prev(self.currSbsPath)]
+        self._queue_prefetch([(p, "ahg_oleg_id", 1.0) for p in paths if p != ""],
+                             replacePending=True)
+    ####
+
+
+    # Queues background rendering of the current image preview with
+    #   'haldId' and 'gamma' - e.g. when HALD is selected but not yet previewed
+    def prefetch_preview(self, haldId, gamma):
+        if ( self.is_ready() ):
+            self._queue_prefetch([(self.currSbsPath, haldId, gamma)],
+                                 replacePending=False)
+    ####
+
+
+    def _queue_prefetch(self, keys, replacePending):
+        with self._inflightLock:
+            if ( replacePending ):
+                self._prefetchGen += 1
+            displaySize = (self.displayWidth, self.displayHeight)
+            for key in keys:
+                self._prefetchQueue.put((self._prefetchGen,
+                                         PreviewCache.key(*key, displaySize)))
+    ####
+
+
+    # Returns already rendered preview image or None.
+    # Waits if the very preview is being rendered right now.
+    def _take_prefetched(self, sbsPath, haldId, gamma):
+        key = PreviewCache.key(sbsPath, haldId, gamma, self._display_size())
+        with self._inflightLock:
+            event = self._inflight.get(key)
+        if ( event is not None ):
+            event.wait()
+        previewImg = self._previewCache.get(key)
+        if ( previewImg is not None ):
+            print(f"-D- Preview of '{sbsPath}' with '{haldId}', gamma {gamma} taken from cache")
+        return(previewImg)
+    ####
+
+
+    # Renders queued previews one by one into the preview cache
+    def _prefetch_worker(self):
+        while True:
+            (gen, key) = self._prefetchQueue.get()
+            cache = self._previewCache
+            with self._inflightLock:
+                if ( (gen != self._prefetchGen) or
+                     cache.contains(key) or (key in self._inflight) ):
+                    continue
+                event = self._inflight[key] = threading.Event()
+            (sbsPath, haldId, gamma, displaySize) = key
+            try:
+                ret = self._render_preview(sbsPath, haldId, gamma,
+                                           displaySize=displaySize)
+                if ( ret is not None ):
+                    cache.put(key, ret)
+            except Exception as e:
+                print(f"-W- Failed prefetching preview of '{sbsPath}': {e}")
+            finally:
+                with self._inflightLock:
+                    del self._inflight[key]
+                event.set()
+    ####
+
+
+    # For now picks all TIFF images and compiled LUT-s in HALD directories
     # TODO: ?use HALD name pattern?
     def list_hald_filenames(self):
-        HALD_EXTENSIONS = ['tif']
+        HALD_EXTENSIONS = ['tif', COMPILED_LUT_EXT.lstrip('.')]
         allHaldFilenames = []
         for hDir in self.haldDirs:
             haldFilenamesInDir = FileOrder(hDir, HALD_EXTENSIONS).get_all_leaves()
@@ -219,22 +396,74 @@ class Halder:
 
 
     # Returns dictionary of {id : original-case-sensitive-name}
+    # If both HALD image and compiled LUT exist, the HALD image is listed
     def get_haldid_to_filename_map(self):
         haldNames = self.list_hald_filenames()
-        idToName = {Halder.hald_filename_to_id(name): name  for name in haldNames}
+        idToName = {}
+        for name in haldNames:
+            haldId = Halder.hald_filename_to_id(name)
+            if ( (haldId not in idToName) or
+                 idToName[haldId].lower().endswith(COMPILED_LUT_EXT) ):
+                idToName[haldId] = name
         return(idToName)
     ####
 
 
+    # Loads the auto-choice model in a background thread; returns immediately
+    def start_loading_model(self):
+        if ( AhConfig.MODEL_SERVER_URL != "" ):
+            self._modelState = Halder.MODEL_SERVER
+            return
+        self._modelState = Halder.MODEL_LOADING
+        threading.Thread(target=self._get_model, daemon=True).start()
+    ####
+
+
+    # Returns one of MODEL_ABSENT/LOADING/READY/FAILED/SERVER
+    def get_model_state(self):
+        return(self._modelState)
+    ####
+
+
+    # Returns the auto-choice model or None;
+    # (re)loads it if not loaded yet or if the model file changed since
+    def _get_model(self):
+        with self._modelLock:
+            if ( not os.path.exists(AhConfig.MODEL_PATH) ):
+                print(f"-E- Missing auto-choice model file '{AhConfig.MODEL_PATH}'")
+                self._model = None
+                self._modelMtime = None
+                self._modelState = Halder.MODEL_ABSENT
+                return(None)
+            mtime = os.path.getmtime(AhConfig.MODEL_PATH)
+            if ( (self._modelMtime is not None) and (mtime == self._modelMtime) ):
+                return(self._model)   # None if previous load of same file failed
+            if ( self._modelMtime is not None ):
+                print(f"-I- Auto-choice model file '{AhConfig.MODEL_PATH}' changed; reloading")
+            self._modelState = Halder.MODEL_LOADING
+            self._model = LoadSavedAnahaldResnet(AhConfig.MODEL_PATH)
+            self._modelMtime = mtime
+            if ( self._model is None ):
+                print(f"-E- Failed loading auto-choice model file '{AhConfig.MODEL_PATH}'")
+                self._modelState = Halder.MODEL_FAILED
+            else:
+                self._modelState = Halder.MODEL_READY
+            return(self._model)
+    ####
+
+
     # Returns (haldId, gamma) or ("", 1.0) on error or unknown HALD
     def auto_choose_hald_and_gamma(self):
-        if ( not os.path.exists(MODEL_PATH) ):
-            print(f"-E- Missing auto-choice model file '{MODEL_PATH}'")
-            return("", 1.0)
-        ah = LoadSavedAnahaldResnet(MODEL_PATH)
+        if ( AhConfig.MODEL_SERVER_URL != "" ):  # resident server holds the model
+            res = AnahaldClient().predict_halds([self.currSbsPath])
+            if ( res is not None ):
+                haldId = res[0][0]  if  (res[0][0] is not None)  else  ""
+                gamma = AnahaldNetBase.choose_gamma_for_sample_hald(haldId)
+                return(haldId, gamma)
+            print(f"-W- Falling back to in-process auto-choice model")
+        ah = self._get_model()   # waits if still loading
         if ( ah is None ):
-            print(f"-E- Failed loading auto-choice model file '{MODEL_PATH}'")
-            return("", 1.0)
+            return("", 1.0)     # error already printed
 
         haldId = ah.predict_hald(self.currSbsPath)
         gamma = AnahaldNetBase.choose_gamma_for_sample_hald(haldId)
@@ -242,39 +471,16 @@ class Halder:
     ####
 
 
-    def clean_tmp_all_but_one(self, *, preserve=None):
-        assert(self.tmpDir != "")
-        print(f"-D- Cleanup in '{self.tmpDir}'")
-        pattern = os.path.join(self.tmpDir, "*.*")
-        if ( preserve is not None ):
-            preserve = os.path.basename(preserve).lower()
-        match = glob.glob(pattern, recursive=False)
-        for fPath in match:
-            fName = os.path.basename(fPath).lower()
-            if ( (preserve is None) or (fName != preserve ) ):
-                os.remove(fPath)
-        return
-    ####
-
-
-    def clean_tmp_dir(self):
-        if ( self.tmpDir == "" ):
-            return
-        print(f"-D- Deleting tmp directory '{self.tmpDir}'")
-        if os.path.exists(self.tmpDir):
-            try:
-                shutil.rmtree(self.tmpDir)
-            except OSError as e:
-                print(f"-E-: {self.tmpDir}: {e.strerror}")
-        else:
-            print(f"-W- Temporary directory '{self.tmpDir}' does not exist.")
-        return
+    # Drops queued background renders - e.g. when the viewer closes
+    def stop_prefetch(self):
+        with self._inflightLock:
+            self._prefetchGen += 1
     ####
 
 
     @staticmethod
     def hald_filename_to_id(filenameOrPath):
-        haldPattern = r"hald__([-a-z_A-Z0-9]+)__16.tif"
+        haldPattern = r"hald__([-a-z_A-Z0-9]+)__16\.(tif|npy)"
         haldName = os.path.basename(filenameOrPath).lower()
         match = re.search(haldPattern, haldName)
         if ( match is None ):
@@ -290,6 +496,52 @@ class Halder:
 
 
 
+#################################################################################
+# Bounded thread-safe LRU cache of rendered previews (or any objects)
+# Key is (normalized-SBS-path, haldId, gamma, (displayWidth, displayHeight))
+#   - see PreviewCache.key()
+class PreviewCache:
+    def __init__(self, maxEntries):
+        self.maxEntries = max(1, maxEntries)
+        self._entries = OrderedDict()   # {key :: value}; LRU first
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def key(sbsPath, haldId, gamma, displaySize):
+        return((os.path.normcase(os.path.abspath(sbsPath)), haldId,
+                round(float(gamma), 2), tuple(displaySize)))
+
+
+    def contains(self, key):
+        with self._lock:
+            return(key in self._entries)
+
+
+    # Returns value for 'key' or None; the entry becomes most recent
+    def get(self, key):
+        with self._lock:
+            if ( key not in self._entries ):
+                return(None)
+            self._entries.move_to_end(key)
+            return(self._entries[key])
+
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while ( len(self._entries) > self.maxEntries ):
+                self._entries.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+#################################################################################
+
+
+
 #################################################################################
 class FileOrder:
     def __init__(self, dirPath, extensions=None):
@@ -19,6 +19,9 @@ import sys
 from pathlib import Path
 import re
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from tempfile import TemporaryDirectory
 
@@ -56,18 +59,125 @@ class AhViewController:
         self.view = view
         self.model = model
         self.view.rootWnd.protocol("WM_DELETE_WINDOW", self.on_closing)
+        # one worker - model operations run in order, off the Tk thread
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="ah_contr")
+        self._lock = threading.Lock()
+        self._requestGen = 0      # generation of the latest request
+        self._navGen = 0          # generation of the latest image move
+        self._cancellable = []    # pending futures that newer requests cancel
+        self._numQueued = 0       # submitted, not finished
+        self._progressText = ""   # what the worker does now; "" if idle
+        self._progressStart = 0.0
     ####
 
 
+    ##################### Asynchronous API ######################################
+    # Each *_async method returns a future of the same result as its
+    #   synchronous counterpart; the view polls it from the Tk loop.
+    # A newer request makes older ones stale (see is_stale()) and cancels
+    #   not yet started ones unless they must run anyway (relative moves);
+    #   a save request affects no other.
+    # Image moves are only made stale by newer moves - the model switches
+    #   image anyway, so the view must always learn about it.
+
+    def point_at_image_async(self, sbsPath):
+        return(self._submit(f"Opening '{os.path.basename(sbsPath)}'",
+                            self.point_at_image, sbsPath, isMove=True))
+
+    def goto_prev_async(self):   # steps are relative - never cancelled
+        return(self._submit("Rendering previous image", self.goto_prev,
+                            cancellable=False, isMove=True))
+
+    def goto_next_async(self):   # steps are relative - never cancelled
+        return(self._submit("Rendering next image", self.goto_next,
+                            cancellable=False, isMove=True))
+
+    def apply_hald_and_gamma_async(self, haldId, gamma, isPreview, isDraft=False):
+        text = (f"Rendering preview with '{haldId}', gamma {gamma:.2f}"
+                if  ( isPreview )  else
+                f"Saving full-size image with '{haldId}', gamma {gamma:.2f}")
+        # a save neither is cancelled nor makes the shown preview stale
+        return(self._submit(text, self.apply_hald_and_gamma,
+                            haldId, gamma, isPreview, isDraft,
+                            cancellable=isPreview,
+                            supersedes=isPreview))
+
+    def auto_choose_hald_and_gamma_async(self):
+        return(self._submit("Choosing HALD automatically",
+                            self.auto_choose_hald_and_gamma))
+
+
+    # Tells whether a newer request was submitted after 'future';
+    #   for an image move - whether a newer move was
+    def is_stale(self, future):
+        if ( future.isMove ):
+            return(future.navGen != self._navGen)
+        return(future.requestGen != self._requestGen)
+
+
+    # Returns (text-of-current-operation, elapsed-seconds, number-queued);
+    #   text is "" when idle
+    def get_progress(self):
+        with self._lock:
+            elapsed = (time.monotonic() - self._progressStart
+                       if  ( self._progressText != "" )  else  0.0)
+            return(self._progressText, elapsed, self._numQueued)
+
+
+    def _submit(self, progressText, func, *args, cancellable=True,
+                supersedes=True, isMove=False):
+        toCancel = []
+        with self._lock:
+            if ( supersedes ):
+                (toCancel, self._cancellable) = (self._cancellable, [])
+                self._requestGen += 1
+            if ( isMove ):
+                self._navGen += 1
+            self._numQueued += 1
+            future = self._executor.submit(self._run_with_progress,
+                                           progressText, func, *args)
+            future.requestGen = self._requestGen
+            future.navGen = self._navGen
+            future.isMove = isMove
+            if ( cancellable ):
+                self._cancellable.append(future)
+        # (done-callbacks may run right here - thus outside of the lock)
+        future.add_done_callback(self._on_future_done)
+        for oldFuture in toCancel:
+            oldFuture.cancel()   # no effect if already running
+        return(future)
+
+
+    def _run_with_progress(self, progressText, func, *args):
+        with self._lock:
+            self._progressText = progressText
+            self._progressStart = time.monotonic()
+        try:
+            return(func(*args))
+        finally:
+            with self._lock:
+                self._progressText = ""
+
+
+    def _on_future_done(self, future):
+        with self._lock:
+            self._numQueued -= 1
+    ####
+
+
+    ##################### Synchronous API #######################################
+
+
     # Obtains SBS path, instructs conroller to make default anaglyph.
-    # Returns (anaglyph-path, hald-id, gamma)
+    # Returns (preview-image, hald-id, gamma)
     def point_at_image(self, sbsPath):
         try:
             self.model.point_at_image_or_dir(sbsPath)
         except Exception as e:
             print(f"-E- Failed to show image: {e}")
             return("", "ahg_oleg_id", 1.0)  # "" indicates failure to switch image
-        return(self.model.currAnaPath,
+        return(self.model.currPreview,
                self.model.currHaldId, self.model.currGamma)
 
 
@@ -93,10 +203,14 @@ class AhViewController:
         return(["ahg_oleg_id"] + [x for x in haldIdToFile.keys()])
 
 
-    def apply_hald_and_gamma(self, haldId, gamma, isPreview):
+    # Returns preview image if 'isPreview', otherwise path of the saved image;
+    #   "" on error. 'isDraft' asks for quick low-resolution preview.
+    def apply_hald_and_gamma(self, haldId, gamma, isPreview, isDraft=False):
         if ( self.model.switch_hald_and_gamma(haldId=haldId, gamma=gamma,
-                                              isPreview=isPreview) ):
-            return(self.model.currAnaPath)
+                                              isPreview=isPreview,
+                                              isDraft=isDraft) ):
+            return(self.model.currPreview  if  ( isPreview )  else
+                   self.model.currAnaPath)
         else:
             return("")
 
@@ -104,9 +218,28 @@ class AhViewController:
     def auto_choose_hald_and_gamma(self):
         return(self.model.auto_choose_hald_and_gamma())
 
+
+    # Starts rendering preview for the selection in background; returns at once
+    def prefetch_preview(self, haldId, gamma):
+        self.model.prefetch_preview(haldId, gamma)
+
+
+    def get_model_state(self):
+        return(self.model.get_model_state())
+
+
+    # Returns name for the shown preview, like "IMG12_ahg_oleg_cp"
+    def get_preview_name(self):
+        return(self.model.currPreviewName)
+
+
+    def set_display_size(self, maxWidth, maxHeight):
+        self.model.set_display_size(maxWidth, maxHeight)
+
     
     def on_closing(self):
-        self.model.clean_tmp_dir()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.model.stop_prefetch()
         self.view.rootWnd.destroy()  # Destroy the window and exit the mainloop
 
 
@@ -28,6 +28,17 @@ from ah_cfg import *             # configuration settings
 
 
 APP_NAME = "Anahald Image Viewer"
+MODEL_POLL_MSEC = 300   # how often to check auto-choice model state while loading
+FUTURE_POLL_MSEC = 50   # how often to check for results of controller requests
+LIVE_PREVIEW_DEBOUNCE_MSEC = 33   # live preview: draft re-render pace (~30 fps)
+LIVE_PREVIEW_SETTLE_MSEC = 300    # live preview: full-resolution render after changes stop
+
+# texts for auto-choice model states reported by the controller
+_MODEL_STATE_TEXTS = {"absent":  "Auto-choice model: missing",
+                      "loading": "Auto-choice model: loading...",
+                      "ready":   "Auto-choice model: ready",
+                      "failed":  "Auto-choice model: failed to load",
+                      "server":  "Auto-choice model: on server"}
 
 
 class AhViewerGUI:
@@ -105,8 +116,7 @@ class AhViewerGUI:
         self.haldListbox.grid(column=4, row=2, rowspan=1, sticky="nsew",
                               padx=5, pady=5)
         # enabled "Preview" button indicates changes not reflected by shown image
-        self.haldListbox.bind("<<ListboxSelect>>",
-                              lambda e: self.btnPreview.config(state=tk.NORMAL))
+        self.haldListbox.bind("<<ListboxSelect>>", self.on_hald_selected)
         hlSc = Scrollbar(self.rootWnd, orient=tk.VERTICAL,
                          command=self.haldListbox.yview)
         hlSc.grid(column=5, row=2, rowspan=1, sticky="ns")
@@ -135,13 +145,22 @@ class AhViewerGUI:
         self.btnAuto.grid(column = 0, row=4, columnspan=1, pady=5)
         self.rootWnd.bind("<a>", lambda event: self.btnAuto.invoke())
         self.btnAuto.config(state=tk.DISABLED)  # no image, nothing to save
+        self.imgOpened = False   # 'Auto' needs both image and loaded model
+        self._liveJob = None        # scheduled live-preview render (after-id)
+        self._liveFuture = None     # live-preview render in progress
+        self._moveFuture = None     # image open/switch in progress
+        self._shownPreviewKey = None  # (hald-id, gamma, is-draft) of shown preview
+        self.modelState = "loading"
+        self.modelStateLbl = ttk.Label(self.rootWnd,
+                                       text=_MODEL_STATE_TEXTS["loading"])
+        self.modelStateLbl.grid(column=0, row=0, columnspan=4, sticky="w", padx=5)
 
         # Create a label to host the image
         self.panel = Label(self.rootWnd, text=AhViewerGUI._help_str(),
                            fg="lightgrey", bg="black", font="TkHeadingFont")
         self.panel.grid(row=1, columnspan=4, rowspan=2,  sticky="NESW")
 
-        rootWnd.rowconfigure(0, weight=0)  # reserved
+        rootWnd.rowconfigure(0, weight=0)  # model state
         rootWnd.rowconfigure(1, weight=1)  # image
         rootWnd.rowconfigure(2, weight=1)  # image, hald-list
         rootWnd.rowconfigure(3, weight=0)  # buttons, gamma-scale
@@ -159,85 +178,105 @@ class AhViewerGUI:
         self.halds = self.controller.get_haldid_list()
         print(f"-I- Available HALDs: ({self.halds})")
         self.haldsStringVar.set(self.halds)
+        self.controller.set_display_size(self.maxImgWidth, self.maxImgHeight)
+        self.poll_model_state()
+
+
+    # Reflects state of auto-choice model; re-checks until loading is over
+    def poll_model_state(self):
+        self.modelState = self.controller.get_model_state()
+        self.modelStateLbl.config(
+            text=_MODEL_STATE_TEXTS.get(self.modelState, self.modelState))
+        self._update_auto_button()
+        if ( self.modelState == "loading" ):
+            self.rootWnd.after(MODEL_POLL_MSEC, self.poll_model_state)
+
+
+    def _update_auto_button(self):
+        if ( self.imgOpened and (self.modelState != "loading") ):
+            self.btnAuto.config(state=tk.NORMAL)
+        else:
+            self.btnAuto.config(state=tk.DISABLED)
         
         
-    # Select SBS image file unless provided, show its anaglyph, return the anaglyph path
+    # Select SBS image file unless provided; its anaglyph is shown when ready.
+    # Returns the SBS path or "" if none chosen.
     def open_img(self, sbsPath=None):
-        oldState_btnPreview = self.btnPreview["state"]
-        self.btnPreview.config(state=tk.DISABLED)  # nothing to apply upon show
         if ( sbsPath is None ):
             # Select the Imagename  from a folder 
             sbsPath = AhViewerGUI._openfilename()
         if ( sbsPath == "" ):
-            self.btnPreview.config(state=oldState_btnPreview)  #
-            self.progress.config(text="Idle"); self.rootWnd.update_idletasks()
             return("")  # assume dialog was canceled
+        self.btnPreview.config(state=tk.DISABLED)  # nothing to apply upon show
+        self._moveFuture = self.controller.point_at_image_async(sbsPath)
+        self._when_done(self._moveFuture,
+                        lambda res: self._on_image_opened(sbsPath, *res))
+        return(sbsPath)
+
 
-        self.progress.config(text="Working..."); self.rootWnd.update_idletasks()
-        # Command to make anaglyph
-        anaPath, haldId, gamma = self.controller.point_at_image(sbsPath)
-        if ( anaPath == "" ):
+    def _on_image_opened(self, sbsPath, previewImg, haldId, gamma):
+        if ( not isinstance(previewImg, Image.Image) ):
             #print(f"-E- Failed processing '{sbsPath}'")
             tk.messagebox.showerror("Viewer error",
                                     f"Failed processing '{sbsPath}'")
-            self.btnPreview.config(oldState_btnPreview)  #
-            self.progress.config(text="Idle"); self.rootWnd.update_idletasks()
-            return("")
-        else:
-            self.btnAuto.config(state=tk.NORMAL)  #
-
-        return(self.show_new_image_anaglyph(anaPath))
+            return
+        self.imgOpened = True
+        self._update_auto_button()
+        self.show_new_image_anaglyph(previewImg)
 
 
-    # Reset processing controls and show the given anaglyph image
-    def show_new_image_anaglyph(self, anaPath):
+    # Reset processing controls and show the given anaglyph preview image
+    def show_new_image_anaglyph(self, previewImg):
         currSelect = self.haldListbox.curselection()
         if ( len(currSelect) > 0 ):
             self.haldListbox.selection_clear(currSelect[0])
         self.haldListbox.selection_set(0)        # reset HALD to "ahg_oleg_id"
         self.haldListbox.see(0)
         self.gammaValVar.set(1.0);  self.reset_gamma_label() # reset gamma to 1.0
-        ret = self.show_image(anaPath)
-        self.progress.config(text="Idle"); self.rootWnd.update_idletasks()
+        ret = self.show_image(previewImg)
+        self._shownPreviewKey = ("ahg_oleg_id", 1.0, False)
         self.btnSave.config(state=tk.NORMAL)  #
         return(ret)
 
     
     def prev_img(self):
-        anaPath = self.controller.goto_prev()
-        if ( anaPath == 0 ):
-            tk.messagebox.showerror("Viewer error",
-                                    f"Cannot switch to the previous image")
-            return("")
-        print(f"-D- Viewer got prev image '{anaPath}'")
-        if ( (anaPath == "") or (anaPath == 0) ):    # at end or error
-            return("")
-        return(self.show_new_image_anaglyph(anaPath))
+        self._moveFuture = self.controller.goto_prev_async()
+        self._when_done(self._moveFuture,
+                        lambda res: self._on_image_switched(res, "previous"))
 
     def next_img(self):
-        anaPath = self.controller.goto_next()
-        if ( anaPath == 0 ):
+        self._moveFuture = self.controller.goto_next_async()
+        self._when_done(self._moveFuture,
+                        lambda res: self._on_image_switched(res, "next"))
+
+
+    # Tells whether image open/switch is not yet shown; HALD and gamma chosen
+    #   meanwhile refer to the old image and are reset once the new one shows
+    def _is_moving(self):
+        return(self._moveFuture is not None)
+
+
+    # 'res' is preview image, "" at end or 0 on error
+    def _on_image_switched(self, res, whichStr):
+        if ( isinstance(res, Image.Image) ):
+            print(f"-D- Viewer got {whichStr} image '{self.controller.get_preview_name()}'")
+            self.show_new_image_anaglyph(res)
+        elif ( res == 0 ):
             tk.messagebox.showerror("Viewer error",
-                                    f"Cannot switch to the next image")
-            return("")
-        print(f"-D- Viewer got next image '{anaPath}'")
-        if ( (anaPath == "") or (anaPath == 0) ):    # at end or error
-            return("")
-        return(self.show_new_image_anaglyph(anaPath))
+                                    f"Cannot switch to the {whichStr} image")
 
     
-    def show_image(self, anaPath):
-        # open the anaglyph image
-        img = Image.open(anaPath)
-    
-        # resize the image and apply a high-quality down sampling filter
-        newW, newH = AhViewerGUI._fit_image_size(img.width, img.height,
-                                     self.maxImgWidth, self.maxImgHeight)
-        print(f"Image view size: {newW}x{newH}")
-        img = img.resize((newW, newH), Image.LANCZOS)
+    # Shows anaglyph preview - PIL image rendered to fit the image area
+    def show_image(self, previewImg):
+        newW, newH = AhViewerGUI._fit_image_size(previewImg.width,
+                         previewImg.height, self.maxImgWidth, self.maxImgHeight)
+        # resize only what was rendered for other size (e.g. by ImageMagick)
+        if ( max(abs(newW - previewImg.width), abs(newH - previewImg.height)) > 1 ):
+            print(f"Image view size: {newW}x{newH}")
+            previewImg = previewImg.resize((newW, newH), Image.LANCZOS)
 
         # PhotoImage class is used to add image to widgets, icons etc
-        img = ImageTk.PhotoImage(img)
+        img = ImageTk.PhotoImage(previewImg)
 
         # set the panel image to 'img'
         self.panel.image = img
@@ -245,33 +284,103 @@ class AhViewerGUI:
 
         
         #self.btnPreview.config(state=tk.DISABLED)  # nothing to apply upon show
-        self.rootWnd.title(f"{APP_NAME}:  {os.path.basename(anaPath)}")
-        return(anaPath)
+        self.rootWnd.title(f"{APP_NAME}:  {self.controller.get_preview_name()}")
+        return(previewImg)
     ####
 
 
     def apply_hald_and_gamma(self, isPreview):
-        haldIdIdxList = self.haldListbox.curselection()
-        haldIdIdx = haldIdIdxList[0]  if  ( len(haldIdIdxList) > 0 )  else  0
-        haldId = self.halds[haldIdIdx]
-        self.progress.config(text="Working...")
-        self.rootWnd.update_idletasks()
-        gamma = self.gammaValVar.get()
-        anaPath = self.controller.apply_hald_and_gamma(haldId, gamma, isPreview)
-        self.progress.config(text="Idle")
-        self.rootWnd.update_idletasks()
-        if ( isPreview and (anaPath != "") ):
+        (haldId, gamma) = self._selected_hald_and_gamma()
+        if ( isPreview and self._is_moving() ):
+            return
+        if ( isPreview ):
             self.btnPreview.config(state=tk.DISABLED)
-            return(self.show_image(anaPath))
+        future = self.controller.apply_hald_and_gamma_async(haldId, gamma,
+                                                            isPreview)
+        # a save completes even if the user moved on
+        self._when_done(future, lambda res: self._on_hald_applied(
+                                        res, isPreview, haldId, gamma),
+                        dropIfStale=isPreview)
+    ####
+
+
+    # 'res' is preview image if 'isPreview', otherwise path of the saved image;
+    #   "" on error
+    def _on_hald_applied(self, res, isPreview, haldId, gamma, isDraft=False):
+        if ( isinstance(res, str) and (res == "") ):
+            if ( isDraft ):   # ticks while dragging - reported once, for the final render
+                print(f"-W- Failed draft preview with HALD '{haldId}', gamma {gamma:.2f}")
+                self.schedule_live_preview(LIVE_PREVIEW_SETTLE_MSEC, isDraft=False)
+                return
+            tk.messagebox.showerror("Viewer error",
+                        f"Failed applying HALD '{haldId}' with gamma {gamma:.2f}")
+            if ( isPreview ):
+                self.btnPreview.config(state=tk.NORMAL)
+            return
+        if ( isPreview ):
+            self.show_image(res)
+            self._shownPreviewKey = (haldId, gamma, isDraft)
+            if ( isDraft ):   # follow with full resolution unless changed again
+                self.schedule_live_preview(LIVE_PREVIEW_SETTLE_MSEC, isDraft=False)
+            else:
+                self.btnPreview.config(state=tk.DISABLED)
         else:
-            return("")
+            print(f"-I- Saved '{res}'")
+    ####
+
+
+    def _selected_hald_and_gamma(self):
+        haldIdIdxList = self.haldListbox.curselection()
+        haldIdIdx = haldIdIdxList[0]  if  ( len(haldIdIdxList) > 0 )  else  0
+        # the scale variable may carry float noise beyond its resolution
+        return(self.halds[haldIdIdx], round(self.gammaValVar.get(), 2))
+
+
+    def _is_live_preview(self):
+        return(AhConfig.LIVE_PREVIEW and (AhConfig.HALD_ENGINE == "numpy") and
+               self.imgOpened)
+
+
+    # Schedules preview re-render for the selected HALD and gamma;
+    #   calls within 'delayMsec' from each other merge into one render
+    def schedule_live_preview(self, delayMsec=LIVE_PREVIEW_DEBOUNCE_MSEC,
+                              isDraft=True):
+        if ( not self._is_live_preview() ):
+            return
+        if ( self._liveJob is not None ):
+            self.rootWnd.after_cancel(self._liveJob)
+        self._liveJob = self.rootWnd.after(delayMsec, self._live_preview, isDraft)
+
+
+    def _live_preview(self, isDraft):
+        self._liveJob = None
+        (haldId, gamma) = self._selected_hald_and_gamma()
+        if ( self._shownPreviewKey in [(haldId, gamma, False),
+                                       (haldId, gamma, isDraft)] ):
+            return  # already shown
+        if ( self._is_moving() ):
+            return  # the new image will come with reset HALD and gamma
+        if ( (self._liveFuture is not None) and (not self._liveFuture.done()) ):
+            # one render at a time - otherwise requests pile up while dragging
+            self.schedule_live_preview(isDraft=isDraft)
+            return
+        self._liveFuture = self.controller.apply_hald_and_gamma_async(
+                                            haldId, gamma, True, isDraft)
+        self._when_done(self._liveFuture, lambda res: self._on_hald_applied(
+                                            res, True, haldId, gamma, isDraft),
+                        onError=(lambda e: self._on_hald_applied(
+                                            "", True, haldId, gamma, True))
+                                if  ( isDraft )  else  None)
     ####
 
 
     def auto_choose_hald_and_gamma(self):
-        self.progress.config(text="Working...")
-        haldId, gamma = self.controller.auto_choose_hald_and_gamma()
-        self.progress.config(text="Idle")
+        self._when_done(self.controller.auto_choose_hald_and_gamma_async(),
+                        lambda res: self._on_auto_chosen(*res))
+
+
+    def _on_auto_chosen(self, haldId, gamma):
+        self.poll_model_state()   # model could have been reloaded or failed
         if ( haldId == "" ):
             tk.messagebox.showwarning("Auto-choice unavailable", "Auto-choice is not properly configured")
             return
@@ -289,10 +398,62 @@ class AhViewerGUI:
         self.btnPreview.config(state=tk.NORMAL)
 ####
 
-    
+
+    # Calls 'onResult(result)' on the Tk thread once 'future' completes;
+    #   shows progress meanwhile. Results of stale requests are dropped
+    #   unless 'dropIfStale' is False. A failed request is reported by
+    #   'onError(exception)' if given, otherwise in a message box.
+    def _when_done(self, future, onResult, dropIfStale=True, onError=None):
+        self._show_progress()
+        if ( not future.done() ):
+            self.rootWnd.after(FUTURE_POLL_MSEC, self._when_done,
+                               future, onResult, dropIfStale, onError)
+            return
+        if ( future is self._moveFuture ):
+            self._moveFuture = None   # the view catches up with the model below
+        if ( future.cancelled() or
+             (dropIfStale and self.controller.is_stale(future)) ):
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            if ( onError is not None ):
+                onError(e)
+                return
+            print(f"-E- Viewer request failed: {e}")
+            tk.messagebox.showerror("Viewer error", f"Request failed: {e}")
+            return
+        onResult(result)
+        self._show_progress()
+
+
+    def _show_progress(self):
+        (text, elapsed, numQueued) = self.controller.get_progress()
+        if ( text == "" ):
+            self.progress.config(text="Idle"  if  (numQueued == 0)  else  "Queued...")
+            return
+        queuedStr = f" (+{numQueued-1} queued)"  if  (numQueued > 1)  else  ""
+        self.progress.config(text=f"{text}... {elapsed:.1f}s{queuedStr}")
+
+
+    # Allows preview of the selected HALD and starts rendering it in background;
+    #   with live preview shows it once rendered
+    def on_hald_selected(self, event):
+        self.btnPreview.config(state=tk.NORMAL)
+        if ( self._is_live_preview() ):
+            self.schedule_live_preview()
+            return
+        haldIdIdxList = self.haldListbox.curselection()
+        if ( self.imgOpened and (len(haldIdIdxList) > 0) ):
+            self.controller.prefetch_preview(self.halds[haldIdIdxList[0]],
+                                             self.gammaValVar.get())
+    ####
+
+
     def update_gamma_label(self, val):
         self.gammaLbl.config(text=f"Current Gamma: {float(val):.2f}")
         self.btnPreview.config(state=tk.NORMAL)  # change in gamma - allow preview
+        self.schedule_live_preview()
     ####
 
     def reset_gamma_label(self):